@@ -25,9 +25,13 @@ from __future__ import absolute_import
 from copy import copy
 import json
 import re
+import os
 import sys
 import random
 import datetime
+import threading
+import bisect
+from collections import OrderedDict
 import folia.main as folia
 
 OPERATORS = ('=','==','!=','>','<','<=','>=','CONTAINS','NOTCONTAINS','MATCHES','NOTMATCHES')
@@ -35,6 +39,9 @@ MASK_NORMAL = 0
 MASK_LITERAL = 1
 MASK_EXPRESSION = 2
 MAXEXPANSION = 99
+QUERYCACHESIZE = 512
+STREAMSCOPES = (folia.Sentence, folia.Paragraph) #structure elements that are read one at a time when a query is confined to them (see Query.stream)
+VOLATILE = re.compile(r'\b(datetime|begindatetime|enddatetime)\s+"?now\b') #queries that resolve values at parse time, these are never cached
 
 FOLIAVERSION = folia.FOLIAVERSION
 FQLVERSION = '0.6.0'
@@ -187,14 +194,16 @@ class UnparsedQuery(object):
 
 
 class Filter(object): #WHERE ....
-    def __init__(self, filters, negation=False,disjunction=False):
+    def __init__(self, filters, negation=False,disjunction=False, equalities=None):
         self.filters = filters
         self.negation = negation
         self.disjunction = disjunction
+        self.equalities = equalities if equalities else [] #(attribute, value function, value) for all equality conditions, used by the query planner
 
     @staticmethod
     def parse(q, i=0):
         filters = []
+        equalities = []
         negation = False
         logop = ""
 
@@ -239,6 +248,7 @@ class Filter(object): #WHERE ....
                     cnv =  lambda x: x
                 if operator == '=' or operator == '==':
                     filters.append( lambda x,y=q[i+2],v=v : v(x) == y )
+                    equalities.append( (q[i], v, q[i+2]) )
                 elif operator == '!=':
                     filters.append( lambda x,y=q[i+2],v=v : v(x) != y )
                 elif operator == '>':
@@ -280,7 +290,24 @@ class Filter(object): #WHERE ....
         if negation and len(filters) > 1:
             raise SyntaxError("Expecting parentheses when NOT is used with multiple conditions")
 
-        return Filter(filters, negation, logop == "OR"), i
+        return Filter(filters, negation, logop == "OR", equalities), i
+
+    def islocal(self):
+        """Can this filter be tested on an element without looking outside of it? This is not the case for context expressions (such as ``PARENT``, ``NEXT`` and ``PREVIOUS``) and references by ID."""
+        for filter in self.filters:
+            if isinstance(filter, tuple):
+                modifier, selector, subfilter = filter
+                if modifier != "CHILD" or selector.id or (selector.filter and not selector.filter.islocal()) or (subfilter and not subfilter.islocal()):
+                    return False
+            elif isinstance(filter, Filter) and not filter.islocal():
+                return False
+        return True
+
+    def pushdown(self):
+        """Returns an equality condition (attribute, value function, value) that every matching element must satisfy, or None if there is no such condition. The query planner uses it for index lookups."""
+        if self.equalities and not self.negation and (not self.disjunction or len(self.filters) == 1):
+            return self.equalities[0]
+        return None
 
     def __call__(self, query, element, debug=False):
         """Tests the filter on the specified element, returns a boolean"""
@@ -379,6 +406,7 @@ class Selector(object):
         self.filter = filter
         self.nextselector =  nextselector #selectors can be chained
         self.expansion = expansion #{min,max} occurrence interval, allowed only in Span and evaluated there instead of here
+        self.pushdown = filter.pushdown() if filter else None #equality condition the query planner can resolve through the value index
 
 
     def chain(self, targets):
@@ -465,7 +493,6 @@ class Selector(object):
                     if debug: print("[FQL EVALUATION DEBUG] Select - Selecting ID " + selector.id,file=sys.stderr)
                     try:
                         candidate = query.doc[selector.id]
-                        selector.Class = candidate.__class__
                         if not selector.filter or  selector.filter(query,candidate, debug):
                             if debug: print("[FQL EVALUATION DEBUG] Select - Yielding (by ID) ", repr(candidate),file=sys.stderr)
                             yield candidate, e
@@ -477,25 +504,28 @@ class Selector(object):
                         if isinstance(candidate, folia.AbstractElement):
                             yield candidate, e
                 elif selector.Class:
-                    if debug: print("[FQL EVALUATION DEBUG] Select - Selecting Class " + selector.Class.XMLTAG + " with set " + str(selector.set),file=sys.stderr)
+                    #the set is resolved per execution, the selector itself is never modified as it may be shared between queries
                     if selector.Class.XMLTAG in query.defaultsets:
-                        selector.set = query.defaultsets[selector.Class.XMLTAG]
+                        set = query.defaultsets[selector.Class.XMLTAG]
+                    else:
+                        set = selector.set
+                    if debug: print("[FQL EVALUATION DEBUG] Select - Selecting Class " + selector.Class.XMLTAG + " with set " + str(set),file=sys.stderr)
                     isspan = issubclass(selector.Class, folia.AbstractSpanAnnotation)
                     if isinstance(e, tuple): e = e[0]
                     if isspan and (isinstance(e, folia.Word) or isinstance(e, folia.Morpheme)):
-                        for candidate in e.findspans(selector.Class, selector.set, alternatives=alternatives):
+                        for candidate in Selector.findspans(query, e, selector.Class, set, alternatives, debug):
                             if not selector.filter or  selector.filter(query,candidate, debug):
                                 if debug: print("[FQL EVALUATION DEBUG] Select - Yielding span, single reference: ", repr(candidate),file=sys.stderr)
                                 yield candidate, e
                     elif isspan and isinstance(e, SpanSet):
                         #we take the first item of the span to find the candidates
-                        for candidate in e[0].findspans(selector.Class, selector.set, alternatives=alternatives):
+                        for candidate in Selector.findspans(query, e[0], selector.Class, set, alternatives, debug):
                             if not selector.filter or  selector.filter(query,candidate, debug):
                                 #test if all the other elements in the span are in this candidate
                                 matched = True
-                                spanelements = list(candidate.wrefs())
+                                spanelements = folia.identityset(candidate.wrefs())
                                 for e2 in e[1:]:
-                                    if e2 not in spanelements:
+                                    if id(e2) not in spanelements:
                                         matched = False
                                         break
                                 if matched:
@@ -505,21 +535,30 @@ class Selector(object):
                         yield e, e
                     else:
                         #print("DEBUG: doing select " + selector.Class.__name__ + " (recurse=" + str(recurse)+") on " + repr(e))
-                        if alternatives:
-                            extraselector = e.select(folia.Alternative, False, recurse, ignore=False)
-                        else:
-                            extraselector = [e]
-                        for extra in extraselector:
-                            for candidate in extra.select(selector.Class, selector.set, recurse):
-                                try:
-                                    if candidate.changedbyquery is query:
-                                        #this candidate has been added/modified by the query, don't select it again
-                                        continue
-                                except AttributeError:
-                                    pass
-                                if not selector.filter or  selector.filter(query,candidate, debug):
-                                    if debug: print("[FQL EVALUATION DEBUG] Select - Yielding ", repr(candidate), " in ", repr(e),file=sys.stderr)
-                                    yield candidate, e
+                        candidates = None
+                        if recurse and not alternatives and selector.pushdown:
+                            #only value lookups use the index, without one walking the tree under the element is as fast as building it
+                            index = query.getindex(e)
+                            if index is not None:
+                                candidates = index.select(e, selector.Class, set, selector.pushdown)
+                                if debug and candidates is not None: print("[FQL EVALUATION DEBUG] Select - Obtained " + str(len(candidates)) + " candidates from the index",file=sys.stderr)
+                        if candidates is None:
+                            #walk the tree
+                            if alternatives:
+                                extraselector = e.select(folia.Alternative, False, recurse, ignore=False)
+                            else:
+                                extraselector = [e]
+                            candidates = ( candidate for extra in extraselector for candidate in extra.select(selector.Class, set, recurse) )
+                        for candidate in candidates:
+                            try:
+                                if candidate.changedbyquery is query:
+                                    #this candidate has been added/modified by the query, don't select it again
+                                    continue
+                            except AttributeError:
+                                pass
+                            if not selector.filter or  selector.filter(query,candidate, debug):
+                                if debug: print("[FQL EVALUATION DEBUG] Select - Yielding ", repr(candidate), " in ", repr(e),file=sys.stderr)
+                                yield candidate, e
 
                 if selector.nextselector is None:
                     if debug: print("[FQL EVALUATION DEBUG] Select - End of chain",file=sys.stderr)
@@ -529,6 +568,37 @@ class Selector(object):
                     selector = selector.nextselector
 
 
+    @staticmethod
+    def findspans(query, element, Class, set, alternatives, debug=False):
+        """Returns the span annotations of the given class that refer to the element, from the index if possible"""
+        if not alternatives:
+            index = query.getindex(element)
+            if index is not None:
+                spans = index.findspans(element, Class, set)
+                if spans is not None:
+                    if debug: print("[FQL EVALUATION DEBUG] Select - Obtained " + str(len(spans)) + " spans from the index",file=sys.stderr)
+                    return spans
+        return element.findspans(Class, set, alternatives=alternatives)
+
+    def explain(self):
+        """Describes how the query planner evaluates this selector (for read-only queries), returns a string"""
+        if self.id:
+            return "ID lookup in the document index"
+        elif self.Class == "ALL":
+            return "scan of all child elements"
+        elif not self.Class:
+            return "nothing"
+        elif issubclass(self.Class, folia.AbstractSpanAnnotation):
+            return "span index lookup of " + self.Class.XMLTAG + " spans referring to each target word"
+        elif self.pushdown:
+            attribute, _, value = self.pushdown
+            s = "value index lookup of " + self.Class.XMLTAG + " where " + attribute + " = \"" + value + "\""
+        else:
+            s = "walk selecting " + self.Class.XMLTAG + " under each target"
+        if self.filter and not (self.pushdown and len(self.filter.filters) == 1):
+            s += ", then filter WHERE " + str(self.filter)
+        return s
+
     def match(self, query, candidate, debug = False):
         if debug: print("[FQL EVALUATION DEBUG] Select - Matching selector [", str(self), "] on ", repr(candidate),file=sys.stderr)
         if self.id:
@@ -836,6 +906,9 @@ class Target(object): #FOR/IN... expression
         if not targets:
             raise SyntaxError("Expected one or more targets, got " + str(q[i]) + " in: " + str(q))
 
+        if not isinstance(targets[0], Span):
+            targets[0].chain(targets)
+
         return Target(targets,strict,nested,start,end,endinclusive, repeat), i
 
 
@@ -855,8 +928,7 @@ class Target(object): #FOR/IN... expression
                         if debug: print("[FQL EVALUATION DEBUG] Target - Yielding spanset ",file=sys.stderr)
                         yield spanset
             else:
-                selector = self.targets[0]
-                selector.chain(self.targets)
+                selector = self.targets[0] #selectors were chained at parse time
 
                 started = (self.start is None)
                 dobreak = False
@@ -933,8 +1005,9 @@ class Alternative(object):  #AS ALTERNATIVE ... expression
         for key, value in self.subassignments.items():
             subassignments[key] = value
 
+        assignments = copy(self.assignments)
         if action.action == "ADD" or (action.action == "EDIT" and not focus):
-            if self.id: self.assignments['id'] = self.id
+            if self.id: assignments['id'] = self.id
             if not isspan:
                 if self.id and self.id in query.doc:
                     #add to existing alternative
@@ -943,12 +1016,12 @@ class Alternative(object):  #AS ALTERNATIVE ... expression
                 elif focus:
                     #alternative in focus
                     parent = focus.ancestor(folia.AbstractStructureElement)
-                    alternative = folia.Alternative( query.doc, action.focus.Class( query.doc , **subassignments), **self.assignments)
+                    alternative = folia.Alternative( query.doc, action.focus.Class( query.doc , **subassignments), **assignments)
                     parent.append(alternative)
                     yield alternative[0]
                 else:
                     #alternative in target
-                    alternative = folia.Alternative( query.doc, action.focus.Class( query.doc , **subassignments), **self.assignments)
+                    alternative = folia.Alternative( query.doc, action.focus.Class( query.doc , **subassignments), **assignments)
                     target.append(alternative)
                     yield alternative[0]
             else:
@@ -1298,24 +1371,24 @@ class Correction(object): #AS CORRECTION/SUGGESTION expression...
             if 'substitute' in subassignments:
                 #SUBTITUTE (or synonym ADD)
                 action = subassignments['substitute']
-                del subassignments['substitute']
+                subassignments = { key: value for key, value in subassignments.items() if key != 'substitute' } #don't modify the parsed query
             else:
                 #we have a suggested deletion
                 action = None
             if debug: print("[FQL EVALUATION DEBUG] Correction.assemblesuggestions - Adding suggestion",file=sys.stderr)
             while action:
                 subassignments = copy(subassignments) #assignment for the element in the suggestion
-                if isinstance(action.focus, tuple) and len(action.focus) == 2:
-                    action.focus = action.focus[0]
+                focus = action.focus
+                if isinstance(focus, tuple) and len(focus) == 2:
+                    focus = focus[0]
                 for key, value in action.assignments.items():
                     if key == 'class': key = 'cls'
                     subassignments[key] = value
-                if (not 'set' in subassignments or subassignments['set'] is False) and action.focus.Class:
+                if (not 'set' in subassignments or subassignments['set'] is False) and focus.Class:
                     try:
-                        subassignments['set'] = query.defaultsets[action.focus.Class.XMLTAG]
+                        subassignments['set'] = query.defaultsets[focus.Class.XMLTAG]
                     except KeyError:
-                        subassignments['set'] = query.doc.defaultset(action.focus.Class)
-                focus = action.focus
+                        subassignments['set'] = query.doc.defaultset(focus.Class)
                 focus.autodeclare(query.doc)
                 if focus.Class.REQUIRED_ATTRIBS and folia.Attrib.ID in focus.Class.REQUIRED_ATTRIBS:
                     subassignments['id'] = getrandomid(query, "suggestion.")
@@ -1324,6 +1397,7 @@ class Correction(object): #AS CORRECTION/SUGGESTION expression...
 
             if debug: print("[FQL EVALUATION DEBUG] Correction.assemblesuggestions - Suggestionchildren: ", len(suggestionchildren),file=sys.stderr)
 
+            suggestionassignments = copy(suggestionassignments)
             if 'split' in suggestionassignments and suggestionassignments['split']:
                 nextitem = substitution['parent'].next(substitution['parent'].__class__, None)
                 if nextitem:
@@ -1547,6 +1621,13 @@ class Action(object): #Action expression
 
         return action, i
 
+    def instance(self):
+        """Returns a shallow copy of this action to hold the state of a single execution, the parsed action itself is never modified as it may be shared between queries"""
+        action = copy(self)
+        action.assignments = copy(self.assignments)
+        if isinstance(self.focus, Selector):
+            action.focus = copy(self.focus)
+        return action
 
     def __call__(self, query, contextselector, debug=False):
         """Returns a list focusselection after having performed the desired action on each element therein"""
@@ -1559,10 +1640,10 @@ class Action(object): #Action expression
         if debug: print("[FQL EVALUATION DEBUG] Action - Preparing to evaluate action chain starting with ", self.action,file=sys.stderr)
 
         #handles all actions further in the chain, not just this one!!! This actual method is only called once
-        actions = [self]
+        actions = [self.instance()]
         a = self
         while a.nextaction:
-            actions.append(a.nextaction)
+            actions.append(a.nextaction.instance())
             a = a.nextaction
 
         if len(actions) > 1:
@@ -1634,6 +1715,9 @@ class Action(object): #Action expression
                         focusselector = action.focus(query,contextselector, not strict, alternatives=isinstance(action.form,Alternative), debug=debug)
                     if debug: print("[FQL EVALUATION DEBUG] Action - Obtaining focus...",file=sys.stderr)
                     for focus, target in focusselector:
+                        if action.focus.id and not action.focus.Class and isinstance(focus, folia.AbstractElement):
+                            #focus selected by ID, the class is only known now
+                            action.focus.Class = focus.__class__
                         if target and action.action != "SUBSTITUTE":
                             if isinstance(target, SpanSet):
                                 if not target.partof(constrainedtargetselection):
@@ -1909,6 +1993,158 @@ class Action(object): #Action expression
 
 
 
+class DocumentIndex(object):
+    """Indexes on a document, used by the query planner to evaluate read-only queries without walking the entire document.
+
+    Only authoritative elements are indexed, i.e. the elements :meth:`folia.AbstractElement.select` yields by default. The index consists of:
+
+    * the elements in document order, with for each element the range of positions its descendants occupy
+    * a type index, holding the positions of the elements of each type, built per type on first use
+    * value indexes, holding the positions of the elements of a type for each value of an attribute, built on first use
+    * a span index, holding for each word (or other element that can be referred to) the span annotations referring to it, built on first use
+
+    An index reflects the document at the time it was built. By default a query builds a new index during evaluation once it does more than one lookup (see :meth:`Query.getindex`). With the ``planner='cached'`` setting of the
+    :class:`Context`, the index is kept with the document and reused by subsequent queries (see :meth:`DocumentIndex.get`), it is only rebuilt when the document is marked as changed
+    (see :meth:`folia.AbstractElement.markchanged`). Direct changes to attributes of elements (such as ``element.cls = "X"``) are not tracked, so only use this if the document is not edited
+    that way between queries, or call :meth:`folia.AbstractElement.markchanged` after such changes.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.revision = doc.revision
+        self.elements = []
+        self.ranges = {} #id(element) => (position, position of last descendant)
+        self.layers = [] #(position, depth) of all annotation layers
+        self.types = {} #class => positions, including subclasses
+        self.values = {} #(class, attribute) => value => positions, or None if the attribute can not be indexed
+        self.spans = None #id(element) => [ (-depth, layer position, span position, span, layer) ]
+        for e in doc.data:
+            self.add(e, 0)
+
+    @staticmethod
+    def get(doc):
+        """Returns the index for the document, (re)building it if there is none or if the document has changed"""
+        index = doc._queryindex
+        if index is None or index.revision != doc.revision:
+            index = doc._queryindex = DocumentIndex(doc)
+        return index
+
+    def add(self, element, depth):
+        position = len(self.elements)
+        self.elements.append(element)
+        if isinstance(element, folia.AbstractAnnotationLayer):
+            self.layers.append( (position, depth) )
+        for child in element.data:
+            if isinstance(child, folia.AbstractElement):
+                try:
+                    if not child.auth:
+                        continue
+                except AttributeError:
+                    pass
+                self.add(child, depth+1)
+        self.ranges[id(element)] = (position, len(self.elements) - 1)
+
+    def buildspans(self):
+        self.spans = {}
+        for position, depth in self.layers:
+            self.addspans(self.elements[position], position, depth)
+        for entries in self.spans.values():
+            entries.sort(key=lambda x: x[:3]) #spans in the nearest layers come first, like in findspans()
+
+    def addspans(self, layer, position, depth):
+        for i, span in enumerate(layer.select(folia.AbstractSpanAnnotation, False, True, ignore=folia.ignore_wrefables)):
+            if isinstance(span, folia.AbstractSpanRole):
+                continue
+            for wref in span.wrefs():
+                try:
+                    entries = self.spans[id(wref)]
+                except KeyError:
+                    entries = self.spans[id(wref)] = []
+                if not entries or entries[-1][3] is not span:
+                    entries.append( (-depth, position, i, span, layer) )
+
+    def positions(self, Class, equality=None):
+        """Returns the (sorted) positions of all elements of the specified class, optionally constrained by an equality condition (attribute, value function, value)"""
+        try:
+            positions = self.types[Class]
+        except KeyError:
+            positions = self.types[Class] = [ p for p, e in enumerate(self.elements) if isinstance(e, Class) ]
+        if equality is None:
+            return positions
+        attribute, f, value = equality
+        try:
+            values = self.values[(Class, attribute)]
+        except KeyError:
+            values = {}
+            try:
+                for p in positions:
+                    v = f(self.elements[p])
+                    try:
+                        values[v].append(p)
+                    except KeyError:
+                        values[v] = [p]
+            except Exception: #pylint: disable=broad-except
+                values = None #not all elements have a (hashable) value for this attribute, such as words without text, the filter will have to deal with them
+            self.values[(Class, attribute)] = values
+        if values is None:
+            return positions
+        return values.get(value, [])
+
+    def select(self, element, Class, set=False, equality=None):
+        """Returns the elements of the specified class (and set) under the element, like ``element.select(Class, set)`` does.
+
+        Returns:
+            A list of elements, or None if the element is not in the index
+        """
+        try:
+            begin, end = self.ranges[id(element)]
+        except KeyError:
+            return None
+        positions = self.positions(Class, equality)
+        low = bisect.bisect_right(positions, begin)
+        high = bisect.bisect_right(positions, end, low)
+        elements = [ self.elements[p] for p in positions[low:high] ]
+        if set is not False:
+            selection = []
+            for e in elements:
+                try:
+                    if e.set == set:
+                        selection.append(e)
+                except AttributeError:
+                    continue
+            return selection
+        return elements
+
+    def findspans(self, element, Class, set=False):
+        """Returns the span annotations of the specified class (and set) referring to the element, like ``element.findspans(Class, set)`` does.
+
+        Returns:
+            A list of span annotation elements, or None if the element is not in the index
+        """
+        try:
+            position = self.ranges[id(element)][0]
+        except KeyError:
+            return None
+        if self.spans is None:
+            self.buildspans()
+        layerclass = folia.ANNOTATIONTYPE2LAYERCLASS[Class.ANNOTATIONTYPE]
+        spans = []
+        for _, _, _, span, layer in self.spans.get(id(element), []):
+            if not isinstance(span, Class) or not isinstance(layer, layerclass):
+                continue
+            begin, end = self.ranges[id(layer.parent)]
+            if position < begin or position > end:
+                continue #layer is not in an ancestor of the element
+            if set is not False:
+                try:
+                    if layer.set != set or span.set != set:
+                        continue
+                except AttributeError:
+                    continue
+            spans.append(span)
+        return spans
+
+
 class Context(object):
     def __init__(self, **kwargs):
         self.format = kwargs.get("format","python")
@@ -1917,69 +2153,37 @@ class Context(object):
         self.defaults = {}
         self.defaultsets = {}
         self.processor = kwargs.get("processor", None)
+        self.planner = kwargs.get("planner", True) #use the document index for read-only queries (see DocumentIndex): True builds it per evaluation once more than one lookup needs it, 'cached' reuses it for as long as the document is not marked as changed, False disables it
 
-class Query(object):
-    """This class represents an FQL query.
-
-    Selecting a word with a particular text is done as follows, ``doc`` is an instance of :class:`pynlpl.formats.folia.Document`::
-
-        query = fql.Query('SELECT w WHERE text = "house"')
-        for word in query(doc):
-            print(word)  #this will be an instance of folia.Word
-
-    Regular expression matching can be done using the ``MATCHES`` operator::
-
-        query = fql.Query('SELECT w WHERE text MATCHES "^house.*$"')
-        for word in query(doc):
-            print(word)
-
-    The classes of other annotation types can be easily queried as follows::
-
-        query = fql.Query('SELECT w WHERE :pos = "v"' AND :lemma = "be"')
-        for word in query(doc):
-            print(word)
-
-    You can constrain your queries to a particular target selection using the ``FOR`` keyword::
-
-        query = fql.Query('SELECT w WHERE text MATCHES "^house.*$" FOR s WHERE text CONTAINS "sell"')
-        for word in query(doc):
-            print(word)
-
-    This construction also allows you to select the actual annotations. To select all people (a named entity) for words that are not John::
-
-        query = fql.Query('SELECT entity WHERE class = "person" FOR w WHERE text != "John"')
-        for entity in query(doc):
-            print(entity) #this will be an instance of folia.Entity
-
-    **FOR** statement may be chained, and Explicit IDs can be passed using the ``ID`` keyword::
-
-        query = fql.Query('SELECT entity WHERE class = "person" FOR w WHERE text != "John" FOR div ID "section.21"')
-        for entity in query(doc):
-            print(entity)
-
-    Sets are specified using the **OF** keyword, it can be omitted if there is only one for the annotation type, but will be required otherwise::
-
-        query = fql.Query('SELECT su OF "http://some/syntax/set" WHERE class = "np"')
-        for su in query(doc):
-            print(su) #this will be an instance of folia.SyntacticUnit
-
-    We have just covered just the **SELECT** keyword, FQL has other keywords for manipulating documents, such as **EDIT**, **ADD**, **APPEND** and **PREPEND**.
-
-    Note:
-        Consult the FQL documentation at https://github.com/proycon/foliadocserve/blob/master/README.rst for further documentation on the language.
+class QueryPlan(object):
+    """The parsed form of an FQL query string, as produced by the parser.
 
+    A plan holds no state of any particular execution, so a single plan can be shared by many :class:`Query` instances, on different documents and in different threads.
+    Explicit ``RETURN``, ``FORMAT`` and ``REQUEST`` statements are stored as ``returntype``, ``format`` and ``request``, these are ``None`` if the query did not state them.
+    A ``LIMIT`` statement caps the number of results and is stored as ``limit`` (``None`` if unlimited).
     """
-    def __init__(self, q, context=Context()):
+
+    def __init__(self, q, i=0):
         self.action = None
         self.targets = None
         self.declarations = []
-        self.format = context.format
-        self.returntype = context.returntype
-        self.request = copy(context.request)
-        self.defaults = copy(context.defaults)
-        self.defaultsets = copy(context.defaultsets)
         self.processor = None
-        self.parse(q)
+        self.returntype = None
+        self.format = None
+        self.request = None
+        self.limit = None
+        self.explain = False
+        self.parse(q, i)
+        self.readonly = self.isreadonly()
+
+    def isreadonly(self):
+        """Is this a query that only selects, without modifying the document? Only such queries are evaluated using the document index."""
+        action = self.action
+        while action:
+            if action.action != "SELECT" or action.form or action.subactions:
+                return False
+            action = action.nextaction
+        return True
 
     def parse(self, q, i=0):
         if not isinstance(q,UnparsedQuery):
@@ -1987,6 +2191,9 @@ class Query(object):
         self.unparsedquery = q
 
         l = len(q)
+        if q.kw(i,"EXPLAIN"):
+            self.explain = True
+            i += 1
         while i < l:
             if q.kw(i,"DECLARE"):
                 try:
@@ -2035,6 +2242,14 @@ class Query(object):
                 elif q.kw(i,"REQUEST"):
                     self.request = q[i+1].split(",")
                     i+=2
+                elif q.kw(i,"LIMIT"):
+                    try:
+                        self.limit = int(q[i+1])
+                    except (ValueError, TypeError):
+                        raise SyntaxError("LIMIT expects a positive integer, got " + str(q[i+1]) + " in: " + str(q))
+                    if self.limit < 1:
+                        raise SyntaxError("LIMIT expects a positive integer, got " + str(q[i+1]) + " in: " + str(q))
+                    i+=2
                 else:
                     raise SyntaxError("Unexpected " + str(q[i]) + " at position " + str(i) + " in: " + str(q))
 
@@ -2043,10 +2258,177 @@ class Query(object):
             raise SyntaxError("Expected end of query, got " + str(q[i]) + " in: " + str(q))
 
 
+
+class QueryCache(object):
+    """A thread-safe least-recently-used cache of :class:`QueryPlan` instances, keyed by query string.
+
+    Args:
+        maxsize (int): The maximum number of plans to hold, the least recently used plan is discarded when the cache is full.
+    """
+
+    def __init__(self, maxsize=QUERYCACHESIZE):
+        self.maxsize = maxsize
+        self.plans = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, q):
+        """Returns the plan for query string ``q``, parsing and caching it if needed. Raises :class:`SyntaxError` for invalid queries, these are not cached."""
+        with self.lock:
+            try:
+                plan = self.plans.pop(q)
+                self.plans[q] = plan #most recently used goes last
+                self.hits += 1
+                return plan
+            except KeyError:
+                self.misses += 1
+        plan = QueryPlan(q) #parse outside of the lock, another thread may be parsing the same query, which is harmless
+        if VOLATILE.search(q) is None:
+            with self.lock:
+                self.plans[q] = plan
+                while len(self.plans) > self.maxsize:
+                    self.plans.popitem(False)
+        return plan
+
+    def clear(self):
+        """Discards all cached plans"""
+        with self.lock:
+            self.plans.clear()
+
+    def __len__(self):
+        return len(self.plans)
+
+    def __contains__(self, q):
+        return q in self.plans
+
+QUERYCACHE = QueryCache()
+
+def _corpusquery(task):
+    """Internal function, evaluates a query on a single document of a corpus, as run by the corpus processor (see :meth:`Query.corpus`)"""
+    filename, args, kwargs = task
+    q, settings, save, debug = args
+    query = Query(q)
+    for key, value in settings.items():
+        setattr(query, key, value)
+    doc = folia.Document(file=filename, **kwargs)
+    revision = doc.revision
+    responseselection = query.evaluate(doc, debug)
+    if responseselection is None:
+        items = []
+    else:
+        items = [ query.serialize(e, True) for e in responseselection ]
+    if save and (doc.revision != revision or query.declarations or query.processor):
+        #write to a temporary file in the same directory first (keeping the extension so compression is retained), so an interrupted save never leaves a truncated document
+        tmpfilename = os.path.join(os.path.dirname(filename), ".tmp." + os.path.basename(filename))
+        doc.save(tmpfilename)
+        os.replace(tmpfilename, filename)
+        if debug: print("[FQL EVALUATION DEBUG] Query  - Saved " + filename,file=sys.stderr)
+    return items
+
+class Query(object):
+    """This class represents an FQL query.
+
+    Selecting a word with a particular text is done as follows, ``doc`` is an instance of :class:`pynlpl.formats.folia.Document`::
+
+        query = fql.Query('SELECT w WHERE text = "house"')
+        for word in query(doc):
+            print(word)  #this will be an instance of folia.Word
+
+    Regular expression matching can be done using the ``MATCHES`` operator::
+
+        query = fql.Query('SELECT w WHERE text MATCHES "^house.*$"')
+        for word in query(doc):
+            print(word)
+
+    The classes of other annotation types can be easily queried as follows::
+
+        query = fql.Query('SELECT w WHERE :pos = "v"' AND :lemma = "be"')
+        for word in query(doc):
+            print(word)
+
+    You can constrain your queries to a particular target selection using the ``FOR`` keyword::
+
+        query = fql.Query('SELECT w WHERE text MATCHES "^house.*$" FOR s WHERE text CONTAINS "sell"')
+        for word in query(doc):
+            print(word)
+
+    This construction also allows you to select the actual annotations. To select all people (a named entity) for words that are not John::
+
+        query = fql.Query('SELECT entity WHERE class = "person" FOR w WHERE text != "John"')
+        for entity in query(doc):
+            print(entity) #this will be an instance of folia.Entity
+
+    **FOR** statement may be chained, and Explicit IDs can be passed using the ``ID`` keyword::
+
+        query = fql.Query('SELECT entity WHERE class = "person" FOR w WHERE text != "John" FOR div ID "section.21"')
+        for entity in query(doc):
+            print(entity)
+
+    Sets are specified using the **OF** keyword, it can be omitted if there is only one for the annotation type, but will be required otherwise::
+
+        query = fql.Query('SELECT su OF "http://some/syntax/set" WHERE class = "np"')
+        for su in query(doc):
+            print(su) #this will be an instance of folia.SyntacticUnit
+
+    We have just covered just the **SELECT** keyword, FQL has other keywords for manipulating documents, such as **EDIT**, **ADD**, **APPEND** and **PREPEND**.
+
+    Parsed queries are cached (see :class:`QueryCache`), instantiating the same query string again is cheap and the instances can be used independently, also on different documents and in different threads.
+
+    Note:
+        Consult the FQL documentation at https://github.com/proycon/foliadocserve/blob/master/README.rst for further documentation on the language.
+
+    Args:
+        q (str): The query
+        context (:class:`Context`): The context providing defaults for the query
+        cache (bool): Use the global query cache (default: True)
+    """
+    def __init__(self, q, context=Context(), cache=True):
+        self.action = None
+        self.targets = None
+        self.declarations = []
+        self.format = context.format
+        self.returntype = context.returntype
+        self.request = copy(context.request)
+        self.defaults = copy(context.defaults)
+        self.defaultsets = copy(context.defaultsets)
+        self.processor = None
+        self.limit = None
+        self.planner = context.planner
+        self.index = None
+        self.useindex = False
+        self.indexrequests = 0
+        if cache and not isinstance(q, UnparsedQuery):
+            self.adopt(QUERYCACHE.get(q))
+        else:
+            self.parse(q)
+
+    def parse(self, q, i=0):
+        """Parses the query (without consulting the cache) and adopts the resulting plan"""
+        self.adopt(QueryPlan(q, i))
+
+    def adopt(self, plan):
+        """Adopts a parsed :class:`QueryPlan`, explicit statements in the query take precedence over the context"""
+        self.plan = plan
+        self.unparsedquery = plan.unparsedquery
+        self.action = plan.action
+        self.targets = plan.targets
+        self.declarations = plan.declarations
+        self.processor = plan.processor
+        self.limit = plan.limit
+        if plan.returntype is not None:
+            self.returntype = plan.returntype
+        if plan.format is not None:
+            self.format = plan.format
+        if plan.request is not None:
+            self.request = copy(plan.request)
+
     def setprocessor(self, doc, processor, debug=False):
         """Selects and if necessary adds the necessary processor or (nested) processors"""
         if isinstance(processor, folia.Processor):
             processor = processor.json()
+        else:
+            processor = copy(processor) #the parsed processor may be shared between queries, don't modify it
 
         if processor.get('reset'):
             return None
@@ -2115,7 +2497,200 @@ class Query(object):
     def __call__(self, doc, wrap=True,debug=False):
         """Execute the query on the specified document"""
 
+        if self.plan.explain:
+            self.doc = doc
+            return self.explain()
+
+        responseselection = self.evaluate(doc, debug)
+
+        if responseselection is None: #we're done
+            return ""
+
+        #convert response selection to proper format and return
+        return self.assemble([ self.serialize(e) for e in responseselection ], wrap, debug)
+
+    def serialize(self, e, portable=False):
+        """Converts a single element (or :class:`SpanSet`) of the response selection to the format of the query, as used in the output of :meth:`__call__`
+
+        Args:
+            e: The element or span set
+            portable (bool): For the python formats, return the JSON-compatible representation (see :meth:`folia.AbstractElement.json`) rather than the element itself, so it can be passed between processes
+        """
+        if self.format in ("xml", "single-xml"):
+            if isinstance(e, SpanSet):
+                if self.format == "xml":
+                    return "<result>\n" + "".join( e2.xmlstring(True) + "\n" for e2 in e ) + "</result>\n"
+                else:
+                    return "<result>\n" + "".join( e2.xmlstring(True) for e2 in e ) + "</result>\n"
+            elif self.format == "xml":
+                return "<result>\n" + e.xmlstring(True) + "</result>\n"
+            else:
+                return e.xmlstring(True)
+        elif self.format in ("json", "single-json"):
+            if isinstance(e, SpanSet):
+                return json.dumps([ e2.json() for e2 in e ] )
+            else:
+                return json.dumps(e.json())
+        elif portable:
+            if isinstance(e, SpanSet):
+                return [ e2.json() for e2 in e ]
+            else:
+                return e.json()
+        else:
+            return e
+
+    def assemble(self, items, wrap=True, debug=False):
+        """Assembles the output of the query from the serialised elements of the response selection (see :meth:`serialize`)"""
+        if debug: print("[FQL EVALUATION DEBUG] Query  - Returning " + self.format,file=sys.stderr)
+        if self.format.startswith('single'):
+            if len(items) > 1:
+                raise QueryError("A single response was expected, but multiple are returned")
+            if self.format == "single-xml":
+                return items[0] if items else ""
+            elif self.format == "single-json":
+                return items[0] if items else "null"
+            elif self.format == "single-python":
+                return items[0] if items else None
+        elif self.format in ("xml","json"):
+            return "".join(self.serializechunks(items, wrap))
+        else: #python and undefined formats
+            return items
+
+        return QueryError("Invalid format: " + self.format)
+
+    def serializechunks(self, items, wrap=True):
+        """Generator yielding the output of the query in chunks of text, given the serialised elements of the response selection (see :meth:`serialize`). The items may be produced lazily. Joining all chunks gives the same output as :meth:`__call__`. Only for the xml and json formats (and their single variants)."""
+        if self.format in ("single-xml","single-json"):
+            first = None
+            for item in items:
+                if first is not None:
+                    raise QueryError("A single response was expected, but multiple are returned")
+                first = item
+            if first is not None:
+                yield first
+            elif self.format == "single-json":
+                yield "null"
+        elif self.format in ("xml","json"):
+            xml = self.format == "xml"
+            empty = True
+            for item in items:
+                if empty:
+                    if wrap:
+                        yield "<results>\n" if xml else "[ "
+                    empty = False
+                elif not xml:
+                    yield ", "
+                yield item
+            if not wrap:
+                return
+            if empty:
+                yield "<results></results>" if xml else "[]"
+            else:
+                yield "</results>\n" if xml else "]"
+        else:
+            raise QueryError("Results in format " + self.format + " can not be serialised as text, use FORMAT xml or FORMAT json")
+
+    def chunks(self, doc, wrap=True, debug=False):
+        """Execute the query and yield the output in chunks of text, one for each result, rather than returning it as a single string (as :meth:`__call__` does). Elements are serialised only when their chunk is requested, so large outputs are never held in memory in their entirety.
+
+        Args:
+            doc: The document (:class:`folia.Document`), or the filename of a document, which is then read using :meth:`stream`
+            wrap (bool): Wrap the results in a ``results`` element (xml) or list (json), as :meth:`__call__` does
+
+        Raises:
+            :class:`QueryError` if the format of the query is not xml or json (or their single variants)
+        """
+        if not self.format.endswith(("xml","json")):
+            raise QueryError("Results in format " + self.format + " can not be serialised as text, use FORMAT xml or FORMAT json")
+        if isinstance(doc, str):
+            items = self.stream(doc, debug)
+        else:
+            responseselection = self.evaluate(doc, debug)
+            if responseselection is None: #we're done
+                return
+            items = ( self.serialize(e) for e in responseselection )
+        for chunk in self.serializechunks(items, wrap):
+            yield chunk
+
+    def write(self, doc, f, wrap=True, debug=False):
+        """Execute the query and write its output to a file-like object, as it is produced (see :meth:`chunks`).
+
+        Args:
+            doc: The document (:class:`folia.Document`), or the filename of a document, which is then read using :meth:`stream`
+            f: A file-like object opened for writing text
+            wrap (bool): Wrap the results in a ``results`` element (xml) or list (json), as :meth:`__call__` does
+
+        Example::
+
+            query = fql.Query('SELECT w WHERE :pos = "N" FORMAT xml')
+            with open("nouns.xml","w",encoding="utf-8") as f:
+                query.write(doc, f)
+        """
+        for chunk in self.chunks(doc, wrap, debug):
+            f.write(chunk)
+
+    def corpus(self, corpus, threads=None, limit=None, save=True, ordered=True, debug=False):
+        """Execute the query on all documents of a corpus, using parallel worker processes (see :class:`folia.CorpusProcessor`).
+
+        Yields a ``(filename, output)`` tuple for each document, in which output is what calling the query on that document would return, in the requested format. The python formats return the JSON-compatible representation of the elements (see :meth:`folia.AbstractElement.json`) as elements can not be passed between processes.
+
+        Queries that modify documents (or add declarations or a processor) save each modified document in place.
+
+        Args:
+            corpus: A :class:`folia.Corpus` instance or a corpus directory; its extension, collection, pattern, shard and document keyword arguments are respected
+            threads (int): The number of worker processes (defaults to the number of CPU cores)
+            limit (int): The maximum number of results over the entire corpus, defaults to the ``LIMIT`` of the query. When it is reached, a read-only query stops and the remaining documents are not processed. Queries that modify documents are always run on the entire corpus, only their output is capped.
+            save (bool): Save modified documents (default: True)
+            ordered (bool): Yield the documents in corpus order (True), or as soon as they are done (False)
+
+        Example::
+
+            query = fql.Query('SELECT w WHERE text = "house" LIMIT 100 FORMAT xml')
+            for filename, output in query.corpus(folia.Corpus('/path/to/corpus', extension='folia.xml')):
+                print(filename, output)
+        """
+        if not isinstance(corpus, folia.Corpus):
+            corpus = folia.Corpus(corpus)
+        if limit is None:
+            limit = self.limit
+        settings = { 'format': self.format, 'returntype': self.returntype, 'request': self.request, 'defaults': self.defaults, 'defaultsets': self.defaultsets, 'planner': self.planner, 'limit': limit }
+        readonly = self.plan.readonly and not self.declarations and not self.processor
+        processor = folia.CorpusProcessor(corpus.corpusdir, _corpusquery, threads, corpus.extension, corpus.restrict_to_collection, corpus.conditionf, preindex=True, ordered=ordered, chunksize=None, ignoreerrors=corpus.ignoreerrors, pattern=corpus.pattern, shard=corpus.shard, nshards=corpus.nshards)
+        results = processor.results(str(self.unparsedquery), settings, save and not readonly, debug, **corpus.kwargs)
+        count = 0
+        try:
+            for r in results:
+                if r.failed:
+                    print("Error, unable to query " + r.filename + ": " + r.error.__class__.__name__  + " - " + str(r.error),file=sys.stderr)
+                    if not corpus.ignoreerrors:
+                        raise r.error
+                    continue
+                items = r.result
+                if limit is not None:
+                    items = items[:max(limit - count,0)]
+                count += len(items)
+                yield r.filename, self.assemble(items)
+                if limit is not None and count >= limit and readonly:
+                    if debug: print("[FQL EVALUATION DEBUG] Query  - Limit of " + str(limit) + " results reached, stopping",file=sys.stderr)
+                    break
+        finally:
+            results.close() #shuts down the worker processes
+
+    def evaluate(self, doc, debug=False, planner=True):
+        """Execute the query on the specified document and return the elements it responds with, without converting them to the requested format.
+
+        Args:
+            doc (:class:`folia.Document`): The document
+            planner (bool): Allow the use of the document index for read-only queries, subject to the ``planner`` setting of the context
+
+        Returns:
+            A list of elements (or :class:`SpanSet` instances), or None if the query returns nothing (``RETURN nothing``)
+        """
+
         self.doc = doc
+        self.index = None #obtained on first use, see getindex()
+        self.indexrequests = 0
+        self.useindex = planner and self.planner and self.plan.readonly
 
         if debug: print("[FQL EVALUATION DEBUG] Query  - Starting on document ", doc.id, ":", str(self.unparsedquery), file=sys.stderr)
 
@@ -2135,13 +2710,15 @@ class Query(object):
             focusselection, targetselection = self.action(self, targetselector, debug) #selecting focus elements further constrains the target selection (if any), return values will be lists
 
             if self.returntype == "nothing":
-                return ""
+                return None
             elif self.returntype == "focus":
                 responseselection = focusselection
             elif self.returntype == "target" or self.returntype == "inner-target":
                 responseselection = []
+                seen = set()
                 for e in targetselection:
-                    if not any(x is e for x in responseselection): #filter out duplicates
+                    if id(e) not in seen: #filter out duplicates
+                        seen.add(id(e))
                         responseselection.append(e)
             elif self.returntype == "outer-target":
                 raise NotImplementedError
@@ -2178,92 +2755,155 @@ class Query(object):
             responseselection = []
 
         if self.returntype == "nothing": #we're done
-            return ""
+            return None
 
-        #convert response selection to proper format and return
-        if self.format.startswith('single'):
-            if len(responseselection) > 1:
-                raise QueryError("A single response was expected, but multiple are returned")
-            if self.format == "single-xml":
-                if debug: print("[FQL EVALUATION DEBUG] Query  - Returning single-xml",file=sys.stderr)
-                if not responseselection:
-                    return ""
-                else:
-                    if isinstance(responseselection[0], SpanSet):
-                            r = "<result>\n"
-                            for e in responseselection[0]:
-                                r += e.xmlstring(True)
-                            r += "</result>\n"
-                            return r
-                    else:
-                        return responseselection[0].xmlstring(True)
-            elif self.format == "single-json":
-                if debug: print("[FQL EVALUATION DEBUG] Query  - Returning single-json",file=sys.stderr)
-                if not responseselection:
-                    return "null"
-                else:
-                    return json.dumps(responseselection[0].json())
-            elif self.format == "single-python":
-                if debug: print("[FQL EVALUATION DEBUG] Query  - Returning single-python",file=sys.stderr)
-                if not responseselection:
-                    return None
-                else:
-                    return responseselection[0]
-        else:
-            if self.format == "xml":
-                if debug: print("[FQL EVALUATION DEBUG] Query  - Returning xml",file=sys.stderr)
-                if not responseselection:
-                    if wrap:
-                        return "<results></results>"
-                    else:
-                        return ""
-                else:
-                    if wrap:
-                        r = "<results>\n"
-                    else:
-                        r = ""
-                    for e in responseselection:
-                        if isinstance(e, SpanSet):
-                            r += "<result>\n"
-                            for e2 in e:
-                                r += "" + e2.xmlstring(True) + "\n"
-                            r += "</result>\n"
-                        else:
-                            r += "<result>\n" + e.xmlstring(True) + "</result>\n"
-                    if wrap:
-                        r += "</results>\n"
-                    return r
-            elif self.format == "json":
-                if debug: print("[FQL EVALUATION DEBUG] Query  - Returning json",file=sys.stderr)
-                if not responseselection:
-                    if wrap:
-                        return "[]"
-                    else:
-                        return ""
-                else:
-                    if wrap:
-                        s = "[ "
-                    else:
-                        s = ""
-                    for e in responseselection:
-                        if isinstance(e, SpanSet):
-                            s += json.dumps([ e2.json() for e2 in e ] ) + ", "
-                        else:
-                            s += json.dumps(e.json()) + ", "
-                    s = s.strip(", ")
-                    if wrap:
-                        s += "]"
-                    return s
-            else: #python and undefined formats
-                if debug: print("[FQL EVALUATION DEBUG] Query  - Returning python",file=sys.stderr)
-                return responseselection
+        if self.limit is not None:
+            responseselection = responseselection[:self.limit]
+        return responseselection
 
-        return QueryError("Invalid format: " + self.format)
+    def streamscope(self):
+        """Determines whether the query can be evaluated on a single sentence or paragraph at a time, without any knowledge of the rest of the document. This holds for read-only queries whose outermost target is a sentence or paragraph (e.g. ``SELECT w WHERE text = "house" FOR s``), as long as nothing is selected by ID, no context expressions are used and no spans are looked up from words outside of that scope.
+
+        Returns:
+            The structure class (one of ``STREAMSCOPES``) to which the query is confined, or None if the query needs the entire document
+        """
+        if not self.action or not self.plan.readonly or self.plan.explain or self.declarations or self.processor or self.action.nextaction:
+            return None
+        if self.returntype not in ("focus","target","inner-target") or self.format.startswith("single"):
+            return None
+        selectors = []
+        if self.action.focus:
+            selectors.append(self.action.focus)
+        if self.targets:
+            if len(self.targets.targets) != 1 or isinstance(self.targets.targets[0], Span) or self.targets.start or self.targets.end:
+                return None
+            selectors.append(self.targets.targets[0])
+            if self.targets.nested:
+                selectors.append(self.targets.nested)
+        scope = selectors[-1]
+        if scope.Class not in STREAMSCOPES or scope.nextselector:
+            return None
+        for selector in selectors:
+            if selector.id or selector.Class == "ALL" or (selector.filter and not selector.filter.islocal()):
+                return None
+        if len(selectors) > 2 and issubclass(selectors[0].Class, folia.AbstractSpanAnnotation):
+            #spans are looked up from the words they refer to, the span layer may be outside of the scope
+            return None
+        return scope.Class
+
+    def stream(self, filename, debug=False):
+        """Execute the query on the FoLiA document in the specified file and yield the results one by one, each converted to the format of the query (see :meth:`serialize`).
+
+        If the query is confined to sentences or paragraphs (see :meth:`streamscope`), the document is read using :class:`folia.Reader` and the query is evaluated on each of them in turn, so the document is never held in memory in its entirety and results are yielded as soon as they are found. Other queries are evaluated on the full document,
+        as are documents in which the sentences or paragraphs are nested (e.g. a sentence in a quote in a sentence, see :meth:`nestedscope`).
+
+        Example::
+
+            query = fql.Query('SELECT w WHERE :pos = "N" FOR s WHERE text CONTAINS "house" FORMAT xml')
+            for result in query.stream("/path/to/big.folia.xml"):
+                print(result)
+        """
+        Class = self.streamscope()
+        if Class is None or filename.endswith(('.gz','.bz2')) or Query.nestedscope(filename, Class): #nested elements can't be streamed (the reader yields the inner one first and clears it), compressed files are not checked for them
+            if debug: print("[FQL EVALUATION DEBUG] Query  - Query can not be streamed, loading the full document",file=sys.stderr)
+            responseselection = self.evaluate(folia.Document(file=filename), debug)
+            for e in responseselection or []:
+                yield self.serialize(e)
+            return
+
+        if debug: print("[FQL EVALUATION DEBUG] Query  - Streaming the document by " + Class.__name__,file=sys.stderr)
+        reader = folia.Reader(filename, Class)
+        doc = reader.doc
+        body = folia.Text(doc)
+        doc.data = [body] #the document only ever holds the element that is being read
+        indexsize = len(doc.index)
+        count = 0
+        try:
+            for element in reader:
+                body.data = [element]
+                element.parent = body
+                for e in self.evaluate(doc, debug, False): #the document index would have to be rebuilt for every element
+                    yield self.serialize(e)
+                    count += 1
+                    if self.limit is not None and count >= self.limit:
+                        return
+                #forget the IDs of the element, so memory use remains bounded
+                for key in list(doc.index)[indexsize:]:
+                    del doc.index[key]
+        finally:
+            reader.close()
+
+    @staticmethod
+    def nestedscope(filename, Class):
+        """Checks whether elements of the specified class are nested in one another anywhere in the FoLiA document in the specified file. Only the XML is parsed (never held in memory in its entirety), no FoLiA elements are constructed.
+
+        Returns:
+            bool
+        """
+        tag = "{" + folia.NSFOLIA + "}" + Class.XMLTAG
+        depth = 0
+        for action, node in folia.ElementTree.iterparse(filename, events=("start","end"), tag=tag):
+            if action == "start":
+                depth += 1
+                if depth > 1:
+                    return True
+            else:
+                depth -= 1
+                if depth == 0:
+                    node.clear() #clean up children
+                    while node.getprevious() is not None:
+                        del node.getparent()[0]  # clean up preceding siblings
+        return False
+
+    def getindex(self, element):
+        """Returns the :class:`DocumentIndex` to use for a lookup under (or for) the element in the current evaluation, or None if the query is not evaluated using the index.
+
+        Building the index walks the entire document, so a single lookup (such as under a target selected by ID) is cheaper without it. The index is therefore only built once lookups are done for more than one element, or right away with the ``planner='cached'`` setting, where it is reused by subsequent queries.
+        """
+        if self.useindex and self.index is None:
+            self.indexrequests += 1
+            if self.planner == 'cached':
+                self.index = DocumentIndex.get(self.doc)
+            elif self.indexrequests > 1:
+                self.index = DocumentIndex(self.doc)
+        return self.index
+
+    def explain(self):
+        """Returns a description of how the query is evaluated (the plan), this is also what a query starting with ``EXPLAIN`` returns"""
+        lines = [ str(self.unparsedquery) ]
+        if not self.plan.readonly:
+            lines.append("query modifies the document, it is evaluated by walking the document")
+        elif not self.planner:
+            lines.append("query planner disabled, the query is evaluated by walking the document")
+        action = self.action
+        while action:
+            if action.focus:
+                s = "focus " + action.action + " " + str(action.focus)
+                if self.plan.readonly and self.planner:
+                    s += ": " + action.focus.explain()
+                lines.append(s)
+            action = action.nextaction
+        if self.targets:
+            for selector in self.targets.targets:
+                if isinstance(selector, Span):
+                    lines.append("  target SPAN " + " & ".join( str(x) for x in selector.targets))
+                else:
+                    s = "  target " + str(selector)
+                    if self.plan.readonly and self.planner:
+                        s += ": " + selector.explain()
+                    lines.append(s)
+            if self.targets.nested:
+                s = "    within " + str(self.targets.nested)
+                if self.plan.readonly and self.planner:
+                    s += ": " + self.targets.nested.explain()
+                lines.append(s)
+        return "\n".join(lines)
 
     def _touch(self, *args):
         for e in args:
             if isinstance(e, folia.AbstractElement):
                 e.changedbyquery = self
+                e.markchanged()
                 self._touch(*e.data)
 
 
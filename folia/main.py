@@ -22,14 +22,27 @@ import sys
 
 from copy import copy, deepcopy
 from datetime import datetime
-from collections import OrderedDict
+from collections import OrderedDict, Counter, deque
 import inspect
+import array
 import itertools
-import glob
+import fnmatch
+import heapq
+import bisect
 import os
 import re
 import io
 import multiprocessing
+import multiprocessing.connection
+import concurrent.futures
+import asyncio
+import functools
+import queue
+import pickle
+import json
+import sqlite3
+import time
+import traceback
 import bz2
 import gzip
 import random
@@ -45,7 +58,7 @@ from urllib.request import urlopen #pylint: disable=E0611,wrong-import-order,ung
 stderr = sys.stderr
 stdout = sys.stdout
 
-from folia.helpers import u, isstring, sum_to_n
+from folia.helpers import u, isstring
 from folia.foliaset import SetDefinition, DeepValidationError
 from folia import LIBVERSION
 
@@ -87,6 +100,8 @@ DOCSTRING_GENERIC_ATTRIBS = """    id (str): An ID for the element. IDs must be
     contents (list): Alternative for ``*args``, exists for purely syntactic reasons.
 """
 
+STRUCTURALATTRIBS = ('id','set','cls','annotator','annotatortype','confidence','n','datetime','src','speaker','begintime','endtime','auth','textclass','metadata','idref','space','tags','href','type','format','subset','offset','ref','value') #instance attributes that make up the structural hash of an element (see AbstractElement.structhash())
+
 DEFAULT_TEXT_SET = "https://raw.githubusercontent.com/proycon/folia/master/setdefinitions/text.foliaset.ttl"
 DEFAULT_PHON_SET = "https://raw.githubusercontent.com/proycon/folia/master/setdefinitions/phon.foliaset.ttl"
 
@@ -118,6 +133,9 @@ class ProcessorType(AnnotatorType): #superset of AnnotatorType
 class Attrib:
     ID, CLASS, ANNOTATOR, CONFIDENCE, N, DATETIME, BEGINTIME, ENDTIME, SRC, SPEAKER, TEXTCLASS, METADATA, IDREF, SPACE, TAG = range(15)
 
+#Common attributes in the JSON serialisation and the Attrib an element has to support to take them
+JSONATTRIBS = {'id': Attrib.ID, 'set': Attrib.CLASS, 'class': Attrib.CLASS, 'processor': Attrib.ANNOTATOR, 'annotator': Attrib.ANNOTATOR, 'annotatortype': Attrib.ANNOTATOR, 'confidence': Attrib.CONFIDENCE, 'n': Attrib.N, 'datetime': Attrib.DATETIME, 'begintime': Attrib.BEGINTIME, 'endtime': Attrib.ENDTIME, 'src': Attrib.SRC, 'speaker': Attrib.SPEAKER, 'textclass': Attrib.TEXTCLASS, 'metadata': Attrib.METADATA, 'space': Attrib.SPACE }
+
 #foliaspec:annotationtype
 #Defines all annotation types (as part of the AnnotationType enumeration)
 class AnnotationType:
@@ -301,6 +319,20 @@ class Processor:
             return processor
         raise ValueError("Invalid node passed" + node.tag)
 
+    @classmethod
+    def parsejson(Class, node): #pylint: disable=bad-classmethod-argument
+        """Turns a processor serialised to JSON (see :meth:`json`) back into a processor"""
+        begindatetime = node.get('begindatetime', None)
+        if begindatetime: begindatetime = parse_datetime(begindatetime)
+        enddatetime = node.get('enddatetime', None)
+        if enddatetime: enddatetime = parse_datetime(enddatetime)
+        processor = Processor(node['name'], id=node['id'], type=node.get('type', ProcessorType.AUTO), version=node.get('version',None), document_version=node.get('document_version', None), folia_version=node.get('folia_version', None), command=node.get('command', None),host=node.get('host', None),user=node.get('user', None),begindatetime=begindatetime,enddatetime=enddatetime, resourcelink=node.get('resourcelink', None), src=node.get('src',None), format=node.get('format',None))
+        for key, value in node.get('metadata', {}).items():
+            processor.metadata[key] = value
+        for subnode in node.get('processors', []):
+            processor.processors.append(Processor.parsejson(subnode))
+        return processor
+
     def xml(self):
         """Serialises the processor to XML"""
         attribs = {}
@@ -485,24 +517,35 @@ def parsetime(s):
 
 def norm_spaces(s):
     r"""Normalize spaces, splits on all kinds of whitespace and rejoins. Also removes control characters"""
-    #remove control characters
-    s = "".join(c for c in s if unicodedata.category(c)[0]!="C" or c in ('\n','\t'))
-    return " ".join(( x for x in re.split(r"\s+",s) if x))
+    if not s.isprintable(): #(printable strings have no control characters)
+        #remove control characters
+        s = "".join(c for c in s if unicodedata.category(c)[0]!="C" or c in ('\n','\t'))
+    return " ".join(s.split()) #(splits on the same whitespace as \s)
+
+SPACES = frozenset((" ","\n","\r","\t", chr(0x00a0), chr(0x1680), chr(0x2000), chr(0x2001), chr(0x2003),chr(0x2004), chr(0x2005), chr(0x2006), chr(0x2007), chr(0x2008), chr(0x2009), chr(0x200a), chr(0x2028), chr(0x2029), chr(0x202f), chr(0x205f), chr(0x3000)))
 
 def is_space(c):
-    return c in (" ","\n","\r","\t", chr(0x00a0), chr(0x1680), chr(0x2000), chr(0x2001), chr(0x2003),chr(0x2004), chr(0x2005), chr(0x2006), chr(0x2007), chr(0x2008), chr(0x2009), chr(0x200a), chr(0x2028), chr(0x2029), chr(0x202f), chr(0x205f), chr(0x3000))
+    return c in SPACES
 
 def postprocess_spaces(s):
     r"""Postprocessing for spaces, translates temporary \0 bytes to spaces if they are are not preceeded by whitespace"""
-    s2 = ""
-    for i, c in enumerate(s):
-        if c == "\0":
-            if i > 0 and not is_space(s[i-1]):
-                s2 += " "
-            #null byte is dropped otherwise
-        else:
-            s2 += c
-    return s2
+    if "\0" not in s:
+        return s
+    pieces = s.split("\0")
+    s2 = [pieces[0]]
+    for i in range(1, len(pieces)):
+        #the character preceeding this null byte (None at the start of the string)
+        if pieces[i-1]:
+            c = pieces[i-1][-1]
+        elif i > 1:
+            c = "\0"
+        else:
+            c = None
+        if c is not None and not is_space(c):
+            s2.append(" ")
+        #null byte is dropped otherwise
+        s2.append(pieces[i])
+    return "".join(s2)
 
 
 def parse_datetime(s): #source: http://stackoverflow.com/questions/2211362/how-to-parse-xsddatetime-format
@@ -544,7 +587,13 @@ def xmltreefromstring(s):
         return ElementTree.parse(BytesIO(s), ElementTree.XMLParser()) #older lxml, may leak!!!!
 
 def xmltreefromfile(filename):
-    """Internal function to read an XML file"""
+    """Internal function to read an XML file, bzip2 and gzip compressed files (by extension) are decompressed"""
+    if filename[-4:].lower() == '.bz2':
+        with bz2.BZ2File(filename) as f:
+            return xmltreefromstring(f.read())
+    elif filename[-3:].lower() == '.gz':
+        with gzip.GzipFile(filename) as f:
+            return xmltreefromstring(f.read())
     try:
         return ElementTree.parse(filename, ElementTree.XMLParser(collect_ids=False, huge_tree=True))
     except TypeError:
@@ -566,6 +615,17 @@ def str2annotationtype(s):
             return value
     raise ValueError
 
+def isin(element, elements):
+    """Tests whether the element is one of the given elements, by identity.
+
+    Unlike the ``in`` operator, this never invokes :meth:`AbstractElement.__eq__`, which compares elements by value (their attributes and all their children). Use this for membership tests on elements of the same document.
+    """
+    return id(element) in map(id, elements)
+
+def identityset(elements):
+    """Returns a set of the identities (``id()``) of the given elements, for repeated membership tests by identity (``id(element) in s``), see also :func:`isin`"""
+    return set(map(id, elements))
+
 def commonancestors(Class, *args):
     """Generator function to find common ancestors of a particular type for any two or more FoLiA element instances.
 
@@ -585,12 +645,8 @@ def commonancestors(Class, *args):
         if commonancestors is None:
             commonancestors = copy(ancestors)
         else:
-            removeancestors = []
-            for a in commonancestors: #pylint: disable=not-an-iterable
-                if not a in ancestors:
-                    removeancestors.append(a)
-            for a in removeancestors:
-                commonancestors.remove(a)
+            ancestors = identityset(ancestors)
+            commonancestors = [ a for a in commonancestors if id(a) in ancestors ] #pylint: disable=not-an-iterable
     if commonancestors:
         for commonancestor in commonancestors:
             yield commonancestor
@@ -633,6 +689,9 @@ class AbstractElement:
         :meth:`AbstractElement.__init__`
     """
 
+    _structhash = None #cached structural hash, see structhash()
+    _textcache = None #cached text per set of parameters, see text()
+
     def __init__(self, doc, *args, **kwargs):
         """Constructor for most FoLiA elements.
 
@@ -1440,23 +1499,51 @@ class AbstractElement:
 
         Raises:
             :class:`NoSuchText`: if no text is found at all.
+
+        If the document was loaded with ``textcache=True``, the text is rendered only once per combination of parameters and then served from a cache on the element, until the element or anything beneath it changes (see :meth:`markchanged`).
         """
 
+        if strict or not self.doc or not self.doc.textcache or (previousdelimiter and normalize_spaces) or isinstance(self, AbstractSpanAnnotation): #the text of span annotations depends on the referenced words, so is never cached
+            return self.rendertext(cls, retaintokenisation, previousdelimiter, strict, correctionhandling, normalize_spaces, hidden, trim_spaces)
+
+        key = (cls, retaintokenisation, correctionhandling, hidden, normalize_spaces, trim_spaces)
+        if self._textcache is None:
+            self._textcache = {}
+        try:
+            s = self._textcache[key]
+        except KeyError:
+            try:
+                s = self.rendertext(cls, retaintokenisation, "", strict, correctionhandling, normalize_spaces, hidden, trim_spaces)
+            except NoSuchText:
+                s = None
+            self._textcache[key] = s
+        if s is None:
+            raise NoSuchText
+        elif previousdelimiter and not self.TEXTCONTAINER:
+            return previousdelimiter + s
+        else:
+            return s
+
+    def rendertext(self, cls='current', retaintokenisation=False, previousdelimiter="",strict=False, correctionhandling=CorrectionHandling.CURRENT, normalize_spaces=False, hidden=False, trim_spaces=True):
+        """Renders the text associated with this element, without consulting the text cache. There is usually no need to call this directly, invoked implicitly by :meth:`text`, which also describes the parameters."""
+
         if strict:
             return self.textcontent(cls, correctionhandling,hidden=hidden).text(normalize_spaces=normalize_spaces, trim_spaces=trim_spaces)
 
         if self.TEXTCONTAINER:
-            s = ""
+            parts = [] #text fragments, joined only once at the end
+            last = "" #the last character outputted so far
             pendingspace = False
             for e in self:
                 if isstring(e):
                     if pendingspace: #flush the pendingspace buffer
-                        s += " "
+                        parts.append(" ")
+                        last = " "
                         pendingspace = False
                     if trim_spaces:
                         #This implements https://github.com/proycon/folia/issues/88
                         #FoLiA >= v2.5 behaviour (introduced earlier in v2.4.1 but modified thereafter)
-                        l = len(s)
+                        l = len(parts)
                         for j, line in enumerate(e.split("\n")):
                             if self.preservespace:
                                 s2 = unicodedata.normalize('NFC', line.strip("\r")) #strip only artefacts of DOS-style line endings, leave all intact
@@ -1464,32 +1551,43 @@ class AbstractElement:
                                 s2 = unicodedata.normalize('NFC', norm_spaces(line.strip(" \r"))) #strips leading and trailing whitespace per line (proycon/folia#88)
                                                                     #norm_spaces strips multi-spaces in the middle
                                                                     #also strips artefacts of DOS-style line-endings
-                            if j > 0 and s2 and len(s) != l:
+                            if j > 0 and s2 and len(parts) != l:
                                 #insert spaces between lines that used to be newline separated, except if there already is space
-                                s += " "
+                                parts.append(" ")
                             elif s2 and line and (line[0] != "\n" and is_space(line[0])) and not self.preservespace:
                                 #we have leading indentation we may need to collapse or ignore entirely
                                 #we can't be sure yet what to do so we add a temporary placeholder \0
                                 #this will later be handled in postprocess_spaces() (converts to a space only if no space preceeds it)
-                                s += "\0"
-                            s += s2
+                                parts.append("\0")
+                            if s2:
+                                parts.append(s2)
+                                last = s2[-1]
 
-                        if e and is_space(e[-1]) and s and not is_space(s[-1]) and not self.preservespace:
+                        if e and is_space(e[-1]) and last and not is_space(last) and not self.preservespace:
                             #this item has trailing spaces but we stripped them
                             #this may be premature so
                             #we reserve to output them later in case there is a next item
                             pendingspace = True
-                    else:
+                    elif e:
                         #old FoLiA <= v2.4.1 behaviour, we don't trim anything
-                        s += e
+                        parts.append(e)
+                        last = e[-1]
                 elif e.PRINTABLE:
                     if pendingspace:
                         if not e.IMPLICITSPACE:
-                            s += " "
+                            parts.append(" ")
+                            last = " "
                         pendingspace = False
+                    if last:
+                        delimiter = e.gettextdelimiter() #for AbstractMarkup, will usually be "" (but we need it still for <br/>)
+                        if delimiter:
+                            parts.append(delimiter)
+                            last = delimiter[-1]
+                    s = e.text(trim_spaces=trim_spaces) #(no need to propagate normalize_spaces because we handle it on a macro-level below)
                     if s:
-                        s += e.gettextdelimiter() #for AbstractMarkup, will usually be "" (but we need it still for <br/>)
-                    s += e.text(trim_spaces=trim_spaces) #(no need to propagate normalize_spaces because we handle it on a macro-level below)
+                        parts.append(s)
+                        last = s[-1]
+            s = "".join(parts)
 
             if normalize_spaces:
                 return norm_spaces(postprocess_spaces(s))
@@ -1501,34 +1599,130 @@ class AbstractElement:
         elif not self.PRINTABLE or (self.HIDDEN and not hidden): #only printable elements can hold text and hidden elements don't contain text unless explicitly queried
             raise NoSuchText
         else:
-            #Get text from children first
-            delimiter = ""
-            s = ""
-            for e in self:
-                #was: e.PRINTABLE and not isinstance(e, TextContent) and not isinstance(e, String):
-                if isinstance(e, (AbstractStructureElement, Correction, AbstractSpanAnnotation)):   #AbstractSpanAnnotation is needed when requesting text() on nested span annotations
-                    try:
-                        s += e.text(cls,retaintokenisation, delimiter,False,correctionhandling=correctionhandling, hidden=hidden)
+            parts = []
+            if not self.textparts(parts, cls, retaintokenisation, previousdelimiter, correctionhandling, hidden):
+                #No text found at all :`(
+                raise NoSuchText
+            s = "".join(parts)
+            if normalize_spaces:
+                return norm_spaces(s)
+            else:
+                return s
 
-                        #delimiter will be buffered and only printed upon next iteration, this prevents the delimiter being outputted at the end of a sequence and to be compounded with other delimiters
-                        delimiter = e.gettextdelimiter(retaintokenisation)
+    def textparts(self, parts, cls='current', retaintokenisation=False, previousdelimiter="", correctionhandling=CorrectionHandling.CURRENT, hidden=False, offsets=None):
+        """Appends the text of this (non text container) element to a list of text fragments, as :meth:`text` would render it. There is usually no need to call this directly, invoked implicitly by :meth:`text`, which joins the fragments only once so the text is assembled in linear time.
+
+        Parameters:
+            parts (list): The list of text fragments to append to
+            previousdelimiter (str): The delimiter to output before the text, if there is any text
+            offsets (list or None): If set, the position of each word in the fragments will be appended to this list (used by :meth:`offsetmap`)
+
+        See :meth:`text` for the other parameters.
+
+        Returns:
+            ``False`` if there is no text for this element (where :meth:`text` would raise :class:`NoSuchText`), ``True`` otherwise
+        """
+        if not self.PRINTABLE or (self.HIDDEN and not hidden):
+            return False
+        begin = len(parts)
+        if previousdelimiter:
+            parts.append(previousdelimiter)
+        start = len(parts)
+        textcache = self.doc and self.doc.textcache and offsets is None
+        #Get text from children first
+        delimiter = "" #will be buffered and only printed upon next iteration, this prevents the delimiter being outputted at the end of a sequence and to be compounded with other delimiters
+        for e in self:
+            #was: e.PRINTABLE and not isinstance(e, TextContent) and not isinstance(e, String):
+            if isinstance(e, (AbstractStructureElement, Correction, AbstractSpanAnnotation)):   #AbstractSpanAnnotation is needed when requesting text() on nested span annotations
+                if e.__class__.text is AbstractElement.text and not e.TEXTCONTAINER and not textcache:
+                    if not e.textparts(parts, cls, retaintokenisation, delimiter, correctionhandling, hidden, offsets):
+                        #No text, that's okay, just continue
+                        continue
+                else:
+                    #elements with their own text() implementation (or with a text cache)
+                    try:
+                        s = e.text(cls,retaintokenisation, delimiter,False,correctionhandling=correctionhandling, hidden=hidden)
                     except NoSuchText:
                         #No text, that's okay, just continue
                         continue
+                    if s:
+                        if offsets is not None:
+                            #find the words in the text of this element (e.g. a correction)
+                            cursor = len(delimiter)
+                            for word in e._renderedwords(cls, correctionhandling):
+                                try:
+                                    wordtext = word.text(cls, correctionhandling=correctionhandling, hidden=hidden)
+                                except NoSuchText:
+                                    continue
+                                begin = s.find(wordtext, cursor)
+                                if begin != -1:
+                                    cursor = begin + len(wordtext)
+                                    offsets.append( (word, len(parts), begin, len(parts), cursor) )
+                        parts.append(s)
+                delimiter = e.gettextdelimiter(retaintokenisation)
+
+        if len(parts) == start:
+            try:
+                if self.hastext(cls, correctionhandling, hidden=hidden):
+                    s = self.textcontent(cls, correctionhandling, hidden=hidden).text()
+                    if s:
+                        parts.append(s)
+            except NoSuchText:
+                pass
 
-            if not s and self.hastext(cls, correctionhandling, hidden=hidden):
-                s = self.textcontent(cls, correctionhandling, hidden=hidden).text()
+        if len(parts) == start:
+            del parts[begin:] #no text, also drop the delimiter
+            return False
+        if offsets is not None and isinstance(self, Word):
+            offsets.append( (self, start, 0, len(parts), 0) ) #(word, begin fragment, begin offset in fragment, end fragment, end offset in fragment)
+        return True
 
-            if s and previousdelimiter:
-                s = previousdelimiter + s
-            if s:
-                if normalize_spaces:
-                    return norm_spaces(s)
-                else:
-                    return s
-            else:
-                #No text found at all :`(
-                raise NoSuchText
+    def _renderedwords(self, cls='current', correctionhandling=CorrectionHandling.CURRENT):
+        """Generator over the words in the text of this element, following the same branch of corrections as :meth:`text` (so the originals with ``CorrectionHandling.ORIGINAL``)"""
+        children = self
+        if isinstance(self, Correction):
+            if cls == 'original': correctionhandling = CorrectionHandling.ORIGINAL #backward compatibility
+            children = []
+            if correctionhandling in (CorrectionHandling.CURRENT, CorrectionHandling.EITHER):
+                children = next( (e for e in self if isinstance(e, (New, Current))), [])
+            if not isinstance(children, AbstractElement) and correctionhandling in (CorrectionHandling.ORIGINAL, CorrectionHandling.EITHER):
+                children = next( (e for e in self if isinstance(e, Original)), [])
+        for e in children:
+            if isinstance(e, Word):
+                yield e
+            elif isinstance(e, AbstractElement) and not isinstance(e, default_ignore_structure + (ForeignData,)):
+                for word in e._renderedwords(cls, correctionhandling):
+                    yield word
+
+    def offsetmap(self, cls='current', retaintokenisation=False, correctionhandling=CorrectionHandling.CURRENT, hidden=False):
+        """Renders the text of this element once, as :meth:`text` would, and returns a map between character offsets in that text and the words, for instance to align the output of external tools (such as named entity recognisers) that return offsets.
+
+        Parameters:
+            cls (str): The class of the text content to obtain, defaults to ``current``.
+            retaintokenisation (bool): If set, the space attribute on words will be ignored, otherwise it will be adhered to and text will be detokenised as much as possible. Defaults to ``False``.
+            correctionhandling: Specifies what text to retrieve when corrections are encountered (see :meth:`text`)
+            hidden (bool): Include hidden elements, defaults to ``False``.
+
+        Returns:
+            :class:`OffsetMap`
+
+        Raises:
+            :class:`NoSuchText`: if no text is found at all (where :meth:`text` raises it as well).
+
+        Example::
+
+            offsetmap = sentence.offsetmap()
+            for begin, end, cls in ner(offsetmap.text):
+                print(cls, offsetmap.resolve(begin, end))
+        """
+        if self.TEXTCONTAINER:
+            raise ValueError("offsetmap() is not supported on text containers, use it on a structural element")
+        parts = []
+        offsets = []
+        if not self.textparts(parts, cls, retaintokenisation, "", correctionhandling, hidden, offsets):
+            #elements with their own text() implementation (such as empty table cells) may still have an empty text, without words; text() raises NoSuchText otherwise
+            return OffsetMap.fromparts([self.text(cls, retaintokenisation, "", False, correctionhandling, hidden=hidden)], [])
+        return OffsetMap.fromparts(parts, offsets)
 
     def phoncontent(self, cls='current', correctionhandling=CorrectionHandling.CURRENT, hidden=False):
         """Get the phonetic content explicitly associated with this element (of the specified class).
@@ -1840,18 +2034,102 @@ class AbstractElement:
     def copy(self, newdoc=None, idsuffix=""):
         """Make a deep copy of this element and all its children.
 
+        Only the element itself and the elements it contains are copied, immutable attribute values (such as strings) and processors are shared with the original. The copies are added to the index of the new document as they are made.
+        Elements that are referenced but not contained (such as the words in a span annotation) are not copied: the copy refers to the copy of the element if it is part of the copied subtree, otherwise to the element with the same ID (plus suffix) in the new document, if any, or else to the original element.
+
         Parameters:
             newdoc (:class:`Document`): The document the copy should be associated with.
             idsuffix (str or bool): If set to a string, the ID of the copy will be append with this (prevents duplicate IDs when making copies for the same document). If set to ``True``, a random suffix will be generated.
 
         Returns:
             a copy of the element
+
+        See also:
+            :meth:`moveto`
         """
         if idsuffix is True: idsuffix = ".copy." + "%08x" % random.getrandbits(32) #random 32-bit hash for each copy, same one will be reused for all children
-        c = deepcopy(self)
-        c.setdoc(newdoc, idsuffix)
+        return self.clone(newdoc, idsuffix, None, {})
+
+    def clone(self, newdoc, idsuffix, parent, copies):
+        """Copies this element and the elements it contains, recursively. There is usually no need to call this directly, invoked implicitly by :meth:`copy`
+
+        Parameters:
+            newdoc (:class:`Document`): The document the copy should be associated with
+            idsuffix (str): Suffix to append to the IDs of the copies
+            parent (:class:`AbstractElement`): The parent of the copy
+            copies (dict): Maps the python ids of original elements to their copies, shared over the whole copy operation
+        """
+        c = self.__class__.__new__(self.__class__)
+        attribs = c.__dict__
+        for key, value in self.__dict__.items():
+            if isinstance(value, (list, dict, set)):
+                value = copy(value) #e.g. tags, not shared
+            attribs[key] = value
+        attribs.pop('_structhash', None)
+        attribs.pop('_textcache', None)
+        c.doc = newdoc
+        c.parent = parent
+        if c.id and idsuffix: c.id += idsuffix
+        if newdoc is not None and c.id:
+            newdoc.index[c.id] = c
+        copies[id(self)] = c
+        c.data = []
+        for child in self.data:
+            if not isinstance(child, AbstractElement):
+                c.data.append(child)
+            elif child.parent is self:
+                c.data.append(child.clone(newdoc, idsuffix, c, copies))
+            elif id(child) in copies:
+                c.data.append(copies[id(child)])
+            elif newdoc is not None and child.id and child.id + idsuffix in newdoc.index:
+                c.data.append(newdoc.index[child.id + idsuffix])
+            else:
+                c.data.append(child)
         return c
 
+    def moveto(self, newparent, index=None):
+        """Moves this element, and everything it contains, to another parent element, which may be in another document. Unlike :meth:`copy`, nothing is copied: the element is removed from its current parent and added to the new one, and if the document changes, its IDs are moved from the index of the old document to the index of the new one.
+
+        Parameters:
+            newparent (:class:`AbstractElement`): The new parent element
+            index (int or None): The position to insert the element at in the new parent, or ``None`` to append it
+
+        Returns:
+            the element itself
+
+        Raises:
+            :class:`DuplicateIDError` if an ID is already in use in the new document, ``ValueError`` or :class:`DuplicateAnnotationError` if the element can not be added to the new parent
+        """
+        if newparent is not self.parent:
+            self.__class__.addable(newparent, self.set) #raises an exception if not addable
+        olddoc = self.doc
+        newdoc = newparent.doc
+        if newdoc is not olddoc:
+            elements = []
+            stack = [self]
+            while stack:
+                e = stack.pop()
+                if e.id and newdoc is not None and e.id in newdoc.index:
+                    raise DuplicateIDError(e.id)
+                elements.append(e)
+                stack += [ child for child in e.data if isinstance(child, AbstractElement) and child.parent is e ]
+        if self.parent is not None:
+            self.parent.remove(self)
+        if newdoc is not olddoc:
+            for e in elements:
+                if e.id and olddoc is not None and olddoc.index.get(e.id) is e:
+                    del olddoc.index[e.id]
+                e.doc = newdoc
+                if e.id and newdoc is not None:
+                    newdoc.index[e.id] = e
+        elif self.id and newdoc is not None:
+            newdoc.index[self.id] = self #was removed from the index by remove()
+        if index is None:
+            newparent.append(self)
+        else:
+            newparent.insert(index, self)
+        return self
+
     def copychildren(self, newdoc=None, idsuffix=""):
         """Generator creating a deep copy of the children of this element.
 
@@ -1969,6 +2247,75 @@ class AbstractElement:
         """
         self.replace(TextContent, value=text, cls=cls)
 
+    def marktextchanged(self):
+        """Mark the text (or text offsets) of this element as changed. The nearest structural element (this element itself, or an ancestor) will be included in the next incremental text validation.
+
+        This is called automatically when text content is added or changed after parsing, you only need to call it yourself if you manipulate text content attributes directly.
+
+        See also:
+            :meth:`Document.validatetextchanges`
+        """
+        self.markchanged()
+        e = self
+        while e is not None and not isinstance(e, (AbstractStructureElement, String)):
+            e = e.parent
+        if e is not None and self.doc:
+            self.doc.textchangebuffer[id(e)] = e
+
+    def markchanged(self):
+        """Mark this element as changed. This invalidates derived data that the document keeps, such as the token columns (see :meth:`Document.tokencolumns`).
+
+        This is called automatically when elements are added or removed and when text changes, you only need to call it yourself if you change attributes (such as the class of an annotation or the space attribute of a word) directly.
+        """
+        #invalidate the structural hashes of this element and its ancestors, an ancestor without a hash has no hashed ancestors either
+        self._structhash = None
+        e = self.parent
+        while e is not None and e._structhash is not None:
+            e._structhash = None
+            e = e.parent
+        if self.doc and self.doc.textcache:
+            #invalidate the cached text of this element and all its ancestors
+            e = self
+            while e is not None:
+                e._textcache = None
+                e = e.parent
+        if self.doc and self.doc.doneparsing:
+            self.doc.revision += 1
+
+    def structattributes(self):
+        """Returns a tuple of the attributes of this element and its references (such as the words of a span annotation) and text strings, but not the elements it contains. Used for the structural hash (see :meth:`structhash`) and by :class:`DocumentDiff`."""
+        attribs = []
+        instanceattribs = self.__dict__ #not getattr(), we don't want the defaults
+        for key in STRUCTURALATTRIBS:
+            value = instanceattribs.get(key)
+            if value is not None:
+                if isinstance(value, (list, set)):
+                    value = tuple(sorted(value))
+                elif isinstance(value, AbstractElement): #e.g. metadata references
+                    value = value.id
+                attribs.append( (key, value) )
+        if instanceattribs.get('processor') is not None:
+            attribs.append( ('processor', self.processor.id) )
+        for child in self.data:
+            if not isinstance(child, AbstractElement):
+                attribs.append(child)
+            elif child.parent is not self:
+                #a referenced element (such as a word in a span annotation), not contained here
+                attribs.append( ('ref', child.id) )
+        return tuple(attribs)
+
+    def structhash(self):
+        """Returns the structural hash of this element: a hash over its type, its attributes and text, and the structural hashes of all elements it contains (Merkle-style). Referenced elements, such as the words in span annotations, contribute only their ID.
+
+        Two elements with an equal structural hash can be considered identical subtrees. The hash is computed once and then cached, the cache of an element and all its ancestors is invalidated by :meth:`markchanged`. Like all Python hashes of strings, the value is only comparable within the same process.
+
+        See also:
+            :meth:`Document.diff`
+        """
+        if self._structhash is None:
+            self._structhash = hash( (self.__class__.__name__, self.structattributes(), tuple( child.structhash() for child in self.data if isinstance(child, AbstractElement) and child.parent is self ) ) )
+        return self._structhash
+
     def setdocument(self, doc):
         """Associate a document with this element.
 
@@ -2080,6 +2427,8 @@ class AbstractElement:
         if self.doc and self.doc.deepvalidation:
             self.deepvalidation()
 
+        self.markchanged()
+
     def addtoindex(self,norecurse=[]):
         """Makes sure this element (and all subelements), are properly added to the index.
 
@@ -2399,6 +2748,7 @@ class AbstractElement:
                 elif isstring(child):
                     s += child
             self.data = [s]
+            self.markchanged()
 
     def replace(self, child, *args, **kwargs):
         """Appends a child element like ``append()``, but replaces any existing child element of the same type and set. If no such child element exists, this will act the same as append()
@@ -3431,6 +3781,39 @@ class AbstractElement:
 
         return instance
 
+    @classmethod
+    def parsejson(Class, node, doc, **kwargs): #pylint: disable=bad-classmethod-argument
+        """Internal class method used for turning a node of the JSON serialisation (a ``dict``, see :meth:`json`) into an instance of the Class, the counterpart of :meth:`parsexml`.
+
+        Args:
+            * ``node`` - dict
+            * ``doc`` - Document
+
+        Returns:
+            An instance of the current Class.
+        """
+        args = []
+        for child in node.get('children', ()):
+            if isstring(child):
+                if Class.TEXTCONTAINER or Class.PHONCONTAINER:
+                    args.append(child)
+            else:
+                e = doc.parsejson(child, Class)
+                if e is not None:
+                    args.append(e)
+        if Class.PHONCONTAINER and not args and node.get('phon'):
+            args.append(node['phon']) #phonetic content is only serialised here
+
+        supported = (Class.REQUIRED_ATTRIBS or ()) + (Class.OPTIONAL_ATTRIBS or ())
+        for key, value in node.items():
+            if key in ('type', 'children', 'text', 'phon') or key in kwargs: #text and phon are derived from the children
+                continue
+            if key in JSONATTRIBS and JSONATTRIBS[key] not in supported and not (key == 'set' and Class.SETONLY):
+                continue #inherited (e.g. the set of a correction or the annotator from the declaration), the XML serialisation omits these
+            kwargs[key] = value
+
+        return Class(doc, *args, **kwargs)
+
     def resolveword(self, id):
         return None
 
@@ -3438,12 +3821,13 @@ class AbstractElement:
         """Removes the child element"""
         if not isinstance(child, AbstractElement):
             raise ValueError("Expected AbstractElement, got " + str(type(child)))
-        if child.parent == self:
+        if child.parent is self:
             child.parent = None
         self.data.remove(child)
         #delete from index
         if child.id and self.doc and child.id in self.doc.index:
             del self.doc.index[child.id]
+        self.markchanged()
 
     def incorrection(self):
         """Is this element part of a correction? If it is, it returns the Correction element (evaluating to True), otherwise it returns None"""
@@ -3731,6 +4115,8 @@ class AllowCorrections(object):
                 self.append(c)
             else:
                 self.insert(insertindex, c)
+        if self.doc and self.doc.doneparsing:
+            self.marktextchanged()
         return c
 
 
@@ -3955,14 +4341,14 @@ class AbstractWord: #interface grouping elements that act like words
                 for layer in extra.select(layerclass,set,False):
                     if type is layerclass:
                         for e2 in layer.select(AbstractSpanAnnotation,set,recursive=True, ignore=ignore_wrefables):
-                            if not isinstance(e2, AbstractSpanRole) and self in e2.wrefs():
+                            if not isinstance(e2, AbstractSpanRole) and isin(self, e2.wrefs()):
                                 if returnlayers:
                                     yield e2, layer
                                 else:
                                     yield e2
                     else:
                         for e2 in layer.select(type,set,recursive=True, ignore=ignore_wrefables):
-                            if not isinstance(e2, AbstractSpanRole) and self in e2.wrefs():
+                            if not isinstance(e2, AbstractSpanRole) and isin(self, e2.wrefs()):
                                 if returnlayers:
                                     yield e2, layer
                                 else:
@@ -3998,40 +4384,56 @@ class AbstractWord: #interface grouping elements that act like words
 class AllowGenerateID(object):
     """Classes inherited from this class allow for automatic ID generation, using the convention of adding a period, the name of the element , another period, and a sequence number"""
 
+    maxid = None #maps XML tags to the highest sequence number in use by the children, initialised only once IDs are generated (see generate_id())
+
     def _getmaxid(self, xmltag):
-        try:
-            if xmltag in self.maxid:
-                return self.maxid[xmltag]
-            else:
-                return 0
-        except AttributeError:
-            return 0
+        if self.maxid is None:
+            self._initmaxid()
+        return self.maxid.get(xmltag, 0)
 
+    def _initmaxid(self):
+        """Initialises the highest sequence numbers from the IDs of all children, in one pass"""
+        self.maxid = {} #pylint: disable=attribute-defined-outside-init
+        for child in self.data:
+            if isinstance(child, AbstractElement) and child.parent is self:
+                self._updatemaxid(child)
 
     def _setmaxid(self, child):
-        #print "set maxid on " + repr(self) + " for " + repr(child)
-        try:
-            self.maxid
-        except AttributeError:
-            self.maxid = {}#pylint: disable=attribute-defined-outside-init
+        #the sequence numbers are only kept up to date once IDs have been generated, until then (e.g. during parsing) there is no need
+        if self.maxid is not None:
+            self._updatemaxid(child)
+
+    def _updatemaxid(self, child):
         try:
             if child.id and child.XMLTAG:
                 fields = child.id.split(self.doc.IDSEPARATOR)
                 if len(fields) > 1 and fields[-1].isdigit():
-                    if not child.XMLTAG in self.maxid:
+                    if int(fields[-1]) > self.maxid.get(child.XMLTAG, 0):
                         self.maxid[child.XMLTAG] = int(fields[-1])
-                        #print "set maxid on " + repr(self) + ", " + child.XMLTAG + " to " + fields[-1]
-                    else:
-                        if self.maxid[child.XMLTAG] < int(fields[-1]):
-                            self.maxid[child.XMLTAG] = int(fields[-1])
-                            #print "set maxid on " + repr(self) + ", " + child.XMLTAG + " to " + fields[-1]
-
         except AttributeError:
             pass
 
+    def generate_id(self, cls):
+        """Generates a new ID for an element of the specified class that is to be added to this element, the ID consists of the ID of this element (or the closest ancestor with an ID), the XML tag of the class and a sequence number.
+
+        Arguments:
+            cls: The class (derived from :class:`AbstractElement`) or XML tag
 
+        Returns:
+            str
+        """
+        return self.generate_ids(cls, 1)[0]
 
-    def generate_id(self, cls):
+    def generate_ids(self, cls, count):
+        """Generates and reserves a range of new IDs at once, for elements of the specified class that are to be added to this element (see :meth:`generate_id`). Subsequent calls will not return the same IDs again.
+
+        Arguments:
+            cls: The class (derived from :class:`AbstractElement`) or XML tag
+            count (int): The number of IDs to generate
+
+        Returns:
+            list of str
+        """
         if isinstance(cls,str):
             xmltag = cls
         else:
@@ -4058,20 +4460,16 @@ class AllowGenerateID(object):
             if id is None:
                 raise GenerateIDException("Unable to generate ID, no parent ID could be found")
 
-        origid = id
-
-        while True:
+        prefix = id + '.' + xmltag + '.'
+        ids = []
+        while len(ids) < count:
             maxid += 1
-            id = origid + '.' + xmltag + '.' + str(maxid)
-            if not self.doc or id not in self.doc.index: #extra check
-                break
+            id = prefix + str(maxid)
+            if not self.doc or id not in self.doc.index: #extra check, IDs may be in use already if derived from the ID of an ancestor
+                ids.append(id)
 
-        try:
-            self.maxid
-        except AttributeError:
-            self.maxid = {}#pylint: disable=attribute-defined-outside-init
         self.maxid[xmltag] = maxid #Set MAX ID
-        return id
+        return ids
 
 
 class AbstractStructureElement(AbstractElement, AllowInlineAnnotation, AllowGenerateID):
@@ -4220,6 +4618,7 @@ class AbstractTextMarkup(AbstractElement):
         self.data = [text]
         if not self.data:
             raise ValueError("Empty text content elements are not allowed")
+        self.markchanged()
 
     def resolve(self):
         if self.idref:
@@ -4249,6 +4648,16 @@ class AbstractTextMarkup(AbstractElement):
             del node.attrib['id']
         return super(AbstractTextMarkup,Class).parsexml(node, doc, **kwargs)
 
+    @classmethod
+    def parsejson(Class, node, doc, **kwargs):
+        if not kwargs: kwargs ={}
+        #the JSON serialisation has only one id, which is the reference if there is one (an existing element, or the explicit idref of a TextMarkupReference)
+        if 'id' in node and (node['id'] == node.get('idref') or node['id'] in doc.index):
+            kwargs['idref'] = node['id']
+            node = dict(node)
+            del node['id']
+        return super(AbstractTextMarkup,Class).parsejson(node, doc, **kwargs)
+
     @classmethod
     def relaxng(cls, includechildren=True,extraattribs = None, extraelements=None):
         if not extraattribs: extraattribs = []
@@ -4485,12 +4894,36 @@ class TextContent(AbstractContentAnnotation):
         if cls is not None: self.cls = cls
         if not self.data:
             raise ValueError("Empty text content elements are not allowed")
+        if self.doc and self.doc.doneparsing:
+            self.marktextchanged()
         #if isstring(self.data[0]) and (self.data[0] != self.data[0].translate(ILLEGAL_UNICODE_CONTROL_CHARACTERS)):
         #    raise ValueError("There are illegal unicode control characters present in TextContent: " + repr(self.data[0]))
 
 
-    def getreference(self, validate=True, trim_spaces=True):
-        """Returns and validates the Text Content's reference. Raises UnresolvableTextContent when invalid"""
+    def setoffset(self, offset, ref=None):
+        """Set the offset of this text content in the text of its reference.
+
+        Arguments:
+            offset (int or None): The offset (starting at 0), or None to remove the offset
+            ref (str or None): The ID of the reference element, if None, the existing reference (if any) will be retained
+        """
+        if offset is None:
+            self.offset = None
+        else:
+            self.offset = int(offset)
+        if ref is not None:
+            self.ref = ref
+        if self.doc and self.doc.doneparsing:
+            self.marktextchanged()
+
+    def getreference(self, validate=True, trim_spaces=True, reftextcache=None):
+        """Returns and validates the Text Content's reference. Raises UnresolvableTextContent when invalid
+
+        Parameters:
+            validate (bool): Check whether the text actually matches the reference text at the specified offset
+            trim_spaces (bool): Trim leading/trailing spaces of the reference text (the rules since FoLiA v2.4.1)
+            reftextcache (dict or None): Optional dictionary in which the rendered text of reference elements is stored, so it can be reused when validating many text contents against the same reference. (used by :meth:`Document.pendingvalidation`)
+        """
 
         if self.offset is None: return None #nothing to test
         if self.ref:
@@ -4502,11 +4935,18 @@ class TextContent(AbstractContentAnnotation):
             raise UnresolvableTextContent("Default reference for textcontent not found!")
         elif not ref.hastext(self.cls):
             raise UnresolvableTextContent("Reference (ID " + str(ref.id) + ") has no such text (class=" + self.cls+")")
-        elif validate and self.text() != ref.textcontent(self.cls).text(trim_spaces=trim_spaces)[self.offset:self.offset+len(self.data[0])]:
-            raise UnresolvableTextContent("Reference (ID " + str(ref.id) + ", class=" + self.cls+") found but no text match at specified offset ("+str(self.offset)+")! Expected '" + self.text() + "', got '" + ref.textcontent(self.cls).text(trim_spaces=trim_spaces)[self.offset:self.offset+len(self.data[0])] +"', full text: '" + ref.textcontent(self.cls).text(trim_spaces=trim_spaces) + '"')
-        else:
-            #finally, we made it!
-            return ref
+        elif validate:
+            key = (id(ref), self.cls, trim_spaces)
+            if reftextcache is not None and key in reftextcache:
+                reftext = reftextcache[key]
+            else:
+                reftext = ref.textcontent(self.cls).text(trim_spaces=trim_spaces)
+                if reftextcache is not None:
+                    reftextcache[key] = reftext
+            if self.text() != reftext[self.offset:self.offset+len(self.data[0])]:
+                raise UnresolvableTextContent("Reference (ID " + str(ref.id) + ", class=" + self.cls+") found but no text match at specified offset ("+str(self.offset)+")! Expected '" + self.text() + "', got '" + reftext[self.offset:self.offset+len(self.data[0])] +"', full text: '" + reftext + '"')
+        #finally, we made it!
+        return ref
 
 
     def deepvalidation(self):
@@ -4629,6 +5069,8 @@ class TextContent(AbstractContentAnnotation):
                     raise DuplicateAnnotationError("Can not add multiple text content elements with the same class (" + cls + ") to the same structural element!")
                 else:
                     found.add(c.cls)
+        if self.doc and self.doc.doneparsing:
+            self.marktextchanged()
 
 
 class PhonContent(AbstractContentAnnotation):
@@ -5131,6 +5573,10 @@ class Feature(AbstractElement):
         jsonnode['class'] = self.cls
         return jsonnode
 
+    @classmethod
+    def parsejson(Class, node, doc, **kwargs):#pylint: disable=bad-classmethod-argument
+        return Class(doc, subset=node['subset'], cls=node['class'])
+
     @classmethod
     def relaxng(cls, includechildren=True, extraattribs = None, extraelements=None):
         return RXE.define( RXE.element(RXE.attribute(name='subset'), RXE.attribute(name='class'),name=cls.XMLTAG), name=cls.XMLTAG,ns=NSFOLIA)
@@ -5229,6 +5675,7 @@ class AbstractSpanAnnotation(AbstractElement, AllowGenerateID, AllowCorrections)
             except Exception as e:
                 self.data.remove(child)
                 raise e
+            self.markchanged() #the word is not our child, so its postappend() does not invalidate the span
             if needsort and self.doc and self.doc.doneparsing:
                 try:
                     self.doc.layersortbuffer.append(self.layer())
@@ -5246,6 +5693,7 @@ class AbstractSpanAnnotation(AbstractElement, AllowGenerateID, AllowCorrections)
             *args: Instances of :class:`Word`, :class:`Morpheme` or :class:`Phoneme`
         """
         self.data = [ x for x in self.data if not isinstance(x, wrefables) ]
+        self.markchanged()
         for child in args:
             self.append(child)
 
@@ -5361,7 +5809,8 @@ class AbstractSpanAnnotation(AbstractElement, AllowGenerateID, AllowCorrections)
         nonrefdata = [] #data that has no wrefs
         refdata = [] #data that has wrefs
         missingparents = False
-        duplicates = set() #set of potential duplicate wrefs in parent and children
+        duplicates = set() #identities of potential duplicate wrefs in parent and children
+        data = identityset(self.data)
         for e in self.data:
             missingparents = not e.parent or missingparents
             #is this element a word reference?
@@ -5379,8 +5828,8 @@ class AbstractSpanAnnotation(AbstractElement, AllowGenerateID, AllowCorrections)
 
                 #If a child span contains references that the parent span also contains, they will be removed from the parent, as they are already implicit through recursion.
                 for childwref in e.wrefs(recurse=True):
-                    if childwref in self.data:
-                        duplicates.add(childwref)
+                    if id(childwref) in data:
+                        duplicates.add(id(childwref))
 
             elif not isinstance(e, wrefables):
                 reference = False
@@ -5389,7 +5838,7 @@ class AbstractSpanAnnotation(AbstractElement, AllowGenerateID, AllowCorrections)
             else:
                 refdata.append(e)
 
-        refdata = [ w for w in refdata if w not in duplicates ]
+        refdata = [ w for w in refdata if id(w) not in duplicates ]
         self.data = nonrefdata + refdata #everything that is a non-reference will precede everything that is a reference
 
         if missingparents:
@@ -5585,12 +6034,17 @@ class String(AbstractElement, AllowInlineAnnotation):
     def postappend(self):
         if self.doc and self.doc.textvalidation:
             self.doc.textvalidationerrors += int(not self.textvalidation())
+        self.markchanged()
 
 class AbstractCorrectionChild(AbstractElement):
     def generate_id(self, cls):
         #Delegate ID generation to parent
         return self.parent.generate_id(cls)
 
+    def generate_ids(self, cls, count):
+        #Delegate ID generation to parent
+        return self.parent.generate_ids(cls, count)
+
     def deepvalidation(self):
         return True
 
@@ -5706,6 +6160,16 @@ class LinkReference(AbstractElement):
             kwargs['type'] = node.attrib['type']
         return LinkReference(doc,**kwargs)
 
+    @classmethod
+    def parsejson(Class, node, doc, **kwargs):#pylint: disable=bad-classmethod-argument
+        if not kwargs: kwargs = {}
+        kwargs['id'] = node['idref']
+        if 't' in node:
+            kwargs['t'] = node['t']
+        if 'linktype' in node:
+            kwargs['type'] = node['linktype']
+        return LinkReference(doc,**kwargs)
+
     @classmethod
     def relaxng(cls, includechildren=True,extraattribs = None, extraelements=None):
         return RXE.define( RXE.element(RXE.attribute(RXE.text(), name='id'), RXE.optional(RXE.attribute(RXE.text(), name='t')), RXE.optional(RXE.attribute(RXE.text(), name='type')), name=cls.XMLTAG), name=cls.XMLTAG, ns=NSFOLIA)
@@ -6324,6 +6788,16 @@ class WordReference(AbstractElement):
         assert Class is WordReference or issubclass(Class, WordReference)
         #special handling for word references
         id = node.attrib['id']
+        return Class.lookup(id, doc)
+
+    @classmethod
+    def parsejson(Class, node, doc, **kwargs):#pylint: disable=bad-classmethod-argument
+        #span annotations serialise the elements they refer to in full, these are references to elements that have already been parsed
+        return Class.lookup(node['id'], doc)
+
+    @classmethod
+    def lookup(Class, id, doc):#pylint: disable=bad-classmethod-argument
+        """Resolves a reference to an element by ID, returns the element, or a WordReference instance if it can not be resolved and references are not checked"""
         if doc.debug >= 1: print("[FoLiA DEBUG] Found word reference",file=stderr)
         try:
             return doc[id]
@@ -6977,6 +7451,12 @@ class ForeignData(AbstractHigherOrderAnnotation):
     def parsexml(Class, node, doc, **kwargs):
         return ForeignData(doc, node=node)
 
+    def clone(self, newdoc, idsuffix, parent, copies):
+        """Copies this element, the foreign XML node is copied as well"""
+        c = super(ForeignData, self).clone(newdoc, idsuffix, parent, copies)
+        c.node = deepcopy(self.node)
+        return c
+
     def select(self, Class, set=False, recursive=True,  ignore=True, node=None): #pylint: disable=bad-classmethod-argument,redefined-builtin
         """This is a dummy method that returns an empty generator, select() does not work on ForeignData"""
         #select can never descend into ForeignData, empty generator:
@@ -7268,6 +7748,16 @@ class Document(object):
 
             doc = folia.Document(tree=xmltree)
 
+        If the tree was read from a file, pass ``filename`` as well, so it is set on the document and reported in validation errors.
+
+        5) Load a document from its JSON serialisation (see :meth:`json`), passed as a ``dict`` or a string, or read from a file (optionally compressed with gzip or bz2) or from a file-like object::
+
+            doc = folia.Document(json=jsondoc)
+            doc = folia.Document(jsonfile='/path/to/doc.json')
+            doc = folia.Document(jsonstream=sys.stdin)
+
+        The JSON serialisation does not hold the metadata, nor some attributes (such as ``textclass`` and ``speaker``), so these are not restored.
+
         You will often want to associate a :class:`Processor` when you instantiate a document, the processor encapsulates information regarding the tool that is processing a document (i.e. your script), and adds this to the document's provenance chain. Any new annotations you add to this document will be automatically related to the processor::
 
             doc = folia.Document(id="example", processor=Processor.create(name="my-tool", version="0.1"))
@@ -7279,6 +7769,7 @@ class Document(object):
             loadsetdefinitions (bool):  download and load set definitions (default: False)
             deepvalidation (bool): Do deep validation of the document (default: False), implies ``loadsetdefinitions``
             textvalidation (bool): Do validation of text consistency (default: False), this value is always forced to True to FoLiA v1.5 and above``
+            textcache (bool): Cache the text of elements once it is rendered by :meth:`AbstractElement.text`, useful if text is requested repeatedly from a document that changes little. Changes made through the API invalidate the cache, direct changes to attributes require a call to :meth:`AbstractElement.markchanged` (default: False)
             preparsexmlcallback (function):  Callback for a function taking one argument (``node``, an lxml node). Will be called whenever an XML element is parsed into FoLiA. The function should return an instance inherited from folia.AbstractElement, or None to abort parsing this element (and all its children)
             parsexmlcallback (function):  Callback for a function taking one argument (``element``, a FoLiA element). Will be called whenever an XML element is parsed into FoLiA. The function should return an instance inherited from folia.AbstractElement, or None to abort adding this element (and all its children)
             keepversion (bool): attempt to keep the FoLiA version (use with caution)
@@ -7401,8 +7892,13 @@ class Document(object):
         else:
             self.textvalidation = False
         self.textvalidationerrors = 0 #will count the number of text validation errors
+        self.textcache = bool(kwargs.get('textcache', False)) #cache rendered text on elements (see AbstractElement.text())
         self.offsetvalidationbuffer = [] #will hold (AbstractStructureElement, textclass pairs) that need to be validated still (if textvalidation == True), validation will be done when all parsing is complete and/or prior to serialisation
         self.layersortbuffer = [] #will hold instances derived off AbstractAnnotationLayer (i.e. all span annotation layers), so the the span annotations within can be sorted after all parsing is done
+        self.textchangebuffer = OrderedDict() #will hold structural elements (by python id) of which the text or text offsets changed after parsing, these will be checked by validatetextchanges()
+        self.revision = 0 #incremented on every change after parsing (see AbstractElement.markchanged()), used to invalidate derived data
+        self._tokencolumns = None
+        self._queryindex = None #document index for the FQL query planner (see fql.DocumentIndex)
 
         if 'allowadhocsets' in kwargs:
             self.allowadhocsets = bool(kwargs['allowadhocsets'])
@@ -7459,7 +7955,26 @@ class Document(object):
                 #XML Tree is now obsolete (only needed when partially loaded for xpath queries)
                 self.tree = None
         elif 'tree' in kwargs:
+            if 'filename' in kwargs:
+                self.filename = kwargs['filename'] #the file the tree was read from, set before parsing so errors refer to it
             self.parsexml(kwargs['tree'])
+        elif 'json' in kwargs:
+            if isstring(kwargs['json']):
+                self.parsejson(json.loads(kwargs['json']))
+            else:
+                self.parsejson(kwargs['json'])
+        elif 'jsonfile' in kwargs:
+            filename = kwargs['jsonfile'] #not stored in self.filename, save() writes XML
+            if filename[-4:].lower() == '.bz2':
+                f = bz2.BZ2File(filename)
+            elif filename[-3:].lower() == '.gz':
+                f = gzip.GzipFile(filename)
+            else:
+                f = open(filename, 'rb')
+            with f:
+                self.parsejson(json.load(f))
+        elif 'jsonstream' in kwargs:
+            self.parsejson(json.load(kwargs['jsonstream']))
         else:
             raise Exception("No ID, filename or tree specified. Or the argument name is wrong.")
 
@@ -8138,25 +8653,51 @@ class Document(object):
 
 
     def erase(self, Class, annotationset=False):
-        """Erases all annotations of a particular type and annotation set (unless set is False in which case it applies to all elements regardless of set). Also removed the declarations (i.e. the opposite of declare()) """
+        """Erases all annotations of a particular type and annotation set (unless set is False in which case it applies to all elements regardless of set). Also removed the declarations (i.e. the opposite of declare())
+
+        The document is traversed only once, following contained elements only (not the elements span annotations refer to), and the children of each element are filtered in one go. The IDs of the erased elements and everything they contain are removed from the index.
+
+        Returns:
+            int: the number of erased annotations
+        """
         annotationtype = Class.ANNOTATIONTYPE
         count = 0
         ismarkup = issubclass(Class, AbstractTextMarkup)
-        #loop over the entire document recursively and collect all matches (fairly time consuming)
-        matches = []
-        for element in self.select(Class,annotationset,recursive=True, ignore=False):
-            matches.append(element)
-
-
-        #delete all matches
-        for element in matches:
+        #loop over the entire document once and collect all matches, grouped by the element containing them
+        matches = OrderedDict() #python id of the parent => (parent, {python id of the child: child})
+        erased = [] #the erased elements and everything they contain
+        stack = [ (e, self, False) for e in reversed(self.data) ]
+        while stack:
+            element, parent, inerased = stack.pop()
+            if isinstance(element, Class) and (annotationset is False or element.set == annotationset):
+                count += 1
+                if not inerased:
+                    if id(parent) in matches:
+                        matches[id(parent)][1][id(element)] = element
+                    else:
+                        matches[id(parent)] = (parent, {id(element): element})
+                    inerased = True
+            if inerased:
+                erased.append(element)
+            for child in reversed(element.data):
+                if isinstance(child, AbstractElement) and (child.parent is element or child.parent is None):
+                    stack.append( (child, element, inerased) )
+
+        #delete all matches, rebuilding the children of each parent once
+        for parent, children in matches.values():
             if not ismarkup:
-                element.parent.remove(element)
+                parent.data[:] = [ child for child in parent.data if id(child) not in children ]
             else:
-                i = element.parent.getindex(element)
-                if i == -1: raise Exception("Can't find child from parent, this should not happen")
-                element.parent.data[i] = element.text()
-            count += 1
+                parent.data[:] = [ child.text() if id(child) in children else child for child in parent.data ]
+            for child in children.values():
+                child.parent = None
+            if isinstance(parent, AbstractElement):
+                parent.markchanged()
+
+        #delete from index
+        for element in erased:
+            if element.id and self.index.get(element.id) is element:
+                del self.index[element.id]
 
         if annotationset is False:
             #for any set!
@@ -8619,32 +9160,7 @@ class Document(object):
                 else:
                     print("WARNING: FoLiA Document has no version! Assuming an old version (<1.0)",file=sys.stderr)
                     self.version = "0.12"
-                if self.debug >= 1: print("[FoLiA DEBUG] FoLiA version:", self.version,file=stderr)
-                if checkversion(self.version) > 0:
-                    print("WARNING!!! Document uses a newer version of FoLiA than this library! (" + self.version + " vs " + FOLIAVERSION + "). Any possible subsequent failures in parsing or processing may probably be attributed to this. Upgrade foliapy to remedy this.",file=sys.stderr)
-                self.FOLIA2 = checkversion(self.version, "2.0.0") >= 0
-                self.FOLIA1 = checkversion(self.version, "2.0.0") < 0 #also includes FoLiA v0.*
-                if checkversion(self.version,'1.5.0') >= 0:
-                    self.textvalidation = True
-                if self.FOLIA1:
-                    #older FoLiA, add implicit declarations:
-                    if self.autodeclare is None: self.autodeclare = False
-
-                    if self.keepversion:
-                        #Add implicit declaration for TextContent (FoLiA < 2)
-                        self.annotations.append( (AnnotationType.TEXT,'undefined') )
-                        self.annotationdefaults[AnnotationType.TEXT] = {'undefined': {} }
-                        #Add implicit declaration for PhonContent (FoLiA < 2)
-                        self.annotations.append( (AnnotationType.PHON,'undefined') )
-                        self.annotationdefaults[AnnotationType.PHON] = {'undefined': {} }
-                    else:
-                        #use the new default sets
-                        self.annotations.append( (AnnotationType.TEXT,DEFAULT_TEXT_SET) )
-                        self.annotationdefaults[AnnotationType.TEXT] = {DEFAULT_TEXT_SET: {} }
-                        self.annotations.append( (AnnotationType.PHON,DEFAULT_PHON_SET) )
-                        self.annotationdefaults[AnnotationType.PHON] = {DEFAULT_PHON_SET: {} }
-                else:
-                    if self.autodeclare is None: self.autodeclare = True
+                self.parseversion()
                 if 'document_version' in node.attrib:
                     self.document_version = node.attrib['document_version']
 
@@ -8689,6 +9205,105 @@ class Document(object):
         self.doneparsing = True #indicates that the document is still parsing
 
 
+    def parseversion(self):
+        """Internal method, sets up the document for the FoLiA version of the document that is being parsed (``self.version``)"""
+        if self.debug >= 1: print("[FoLiA DEBUG] FoLiA version:", self.version,file=stderr)
+        if checkversion(self.version) > 0:
+            print("WARNING!!! Document uses a newer version of FoLiA than this library! (" + self.version + " vs " + FOLIAVERSION + "). Any possible subsequent failures in parsing or processing may probably be attributed to this. Upgrade foliapy to remedy this.",file=sys.stderr)
+        self.FOLIA2 = checkversion(self.version, "2.0.0") >= 0
+        self.FOLIA1 = checkversion(self.version, "2.0.0") < 0 #also includes FoLiA v0.*
+        if checkversion(self.version,'1.5.0') >= 0:
+            self.textvalidation = True
+        if self.FOLIA1:
+            #older FoLiA, add implicit declarations:
+            if self.autodeclare is None: self.autodeclare = False
+
+            if self.keepversion:
+                #Add implicit declaration for TextContent (FoLiA < 2)
+                self.annotations.append( (AnnotationType.TEXT,'undefined') )
+                self.annotationdefaults[AnnotationType.TEXT] = {'undefined': {} }
+                #Add implicit declaration for PhonContent (FoLiA < 2)
+                self.annotations.append( (AnnotationType.PHON,'undefined') )
+                self.annotationdefaults[AnnotationType.PHON] = {'undefined': {} }
+            else:
+                #use the new default sets
+                self.annotations.append( (AnnotationType.TEXT,DEFAULT_TEXT_SET) )
+                self.annotationdefaults[AnnotationType.TEXT] = {DEFAULT_TEXT_SET: {} }
+                self.annotations.append( (AnnotationType.PHON,DEFAULT_PHON_SET) )
+                self.annotationdefaults[AnnotationType.PHON] = {DEFAULT_PHON_SET: {} }
+        else:
+            if self.autodeclare is None: self.autodeclare = True
+
+    def parsejson(self, node, ParentClass = None):
+        """Internal method.
+
+        This is the main parser for the JSON serialisation of a document (a ``dict``, see :meth:`json`), the counterpart of :meth:`parsexml`, will invoke class-specific JSON parsers."""
+        if ParentClass is None and 'declarations' in node:
+            self.doneparsing = False #indicates that the document is still parsing
+            if self.debug >= 1: print("[FoLiA DEBUG] Found FoLiA document (JSON)",file=stderr)
+            try:
+                self.id = node['id']
+            except KeyError:
+                raise Exception("FoLiA Document has no ID!")
+            if 'version' in node:
+                self.version = node['version']
+            else:
+                print("WARNING: FoLiA Document has no version! Assuming an old version (<1.0)",file=sys.stderr)
+                self.version = "0.12"
+            self.parseversion()
+            if node.get('provenance'):
+                for subnode in node['provenance'].get('processors', []):
+                    self.provenance.append(Processor.parsejson(subnode))
+            self.parsejsondeclarations(node['declarations'])
+            for subnode in node.get('children', []):
+                e = self.parsejson(subnode)
+                if e is not None:
+                    self.data.append(e)
+            self.done()
+            self.doneparsing = True
+            return None
+
+        foliatag = node['type']
+        if foliatag not in XML2CLASS:
+            raise Exception("Unknown FoLiA type: " + foliatag)
+        Class = XML2CLASS[foliatag]
+        if ParentClass is not None:
+            if issubclass(ParentClass, AbstractSpanAnnotation) and (issubclass(Class, AbstractStructureElement) or issubclass(Class, AbstractSubtokenAnnotation)):
+                #a span annotation refers to this element rather than containing it
+                Class = WordReference
+            elif Class is Feature:
+                #predetermined features are serialised as plain features, restore their own class
+                for c in ParentClass.ACCEPTED_DATA:
+                    if issubclass(c, Feature) and c.SUBSET and c.SUBSET == node.get('subset'):
+                        Class = c
+                        break
+        return Class.parsejson(node, self)
+
+    def parsejsondeclarations(self, declarations):
+        """Internal method to parse the declarations in the JSON serialisation (see :meth:`jsondeclarations`)"""
+        self.declareprocessed = True
+        for declaration in declarations:
+            prefix = declaration['annotationtype']
+            if prefix.upper() in vars(AnnotationType):
+                type = vars(AnnotationType)[prefix.upper()]
+            else:
+                raise Exception("Unknown declaration: " + prefix)
+
+            set = declaration.get('set', None)
+            if type is AnnotationType.TEXT and set is None and (checkversion(self.version, "2.0.0") >= 0 or not self.keepversion) :
+                set = DEFAULT_TEXT_SET
+            elif type is AnnotationType.PHON and set is None and (checkversion(self.version, "2.0.0") >= 0 or not self.keepversion) :
+                set = DEFAULT_PHON_SET
+
+            if type not in self.annotators:
+                self.annotators[type] = OrderedDict()
+            if set not in self.annotators[type]:
+                self.annotators[type][set] = []
+            for processor_id in declaration.get('annotators', []):
+                self.annotators[type][set].append(Annotator(processor_id, self))
+
+            self.declare(type, set, **{ key: value for key, value in declaration.items() if key not in ('annotationtype', 'set', 'annotators') })
+
     def pendingsort(self, warnonly=None):
         """Perform any pending sorts on span annotation elements (per layer, in turn recurses into all span annotations)"""
         while self.layersortbuffer:
@@ -8711,33 +9326,95 @@ class Document(object):
             warnonly = (checkversion(self.version, '1.5.0') < 0) #warn only for documents older than FoLiA v1.5
         if self.textvalidation:
             while self.offsetvalidationbuffer:
-                structureelement, textclass = self.offsetvalidationbuffer.pop(0)
-
-                if self.debug: print("[FoLiA DEBUG] Performing offset validation on " + repr(structureelement) + " textclass " + textclass,file=stderr)
+                #take the whole buffer at once rather than popping items off the front one by one
+                buffer = self.offsetvalidationbuffer
+                self.offsetvalidationbuffer = []
+
+                #group the text contents by their reference element, so the text of each reference only needs to be rendered once (per class)
+                groups = OrderedDict()
+                for structureelement, textclass in buffer:
+                    tc = structureelement.textcontent(textclass)
+                    if tc.offset is not None:
+                        if tc.ref:
+                            key = tc.ref
+                        else:
+                            key = id(tc.finddefaultreference())
+                        if key not in groups:
+                            groups[key] = []
+                        groups[key].append( (structureelement, textclass, tc) )
 
-                #validate offsets
-                tc = structureelement.textcontent(textclass)
-                if tc.offset is not None:
-                    try:
-                        tc.getreference(validate=True)
-                    except UnresolvableTextContent as e:
-                        msg = "Text for " + structureelement.__class__.__name__ + ", ID " + str(structureelement.id) + ", textclass " + textclass  + ", has incorrect offset " + str(tc.offset) + " or invalid reference: " + str(e)
+                for group in groups.values():
+                    reftextcache = {}
+                    for structureelement, textclass, tc in group:
+                        if self.debug: print("[FoLiA DEBUG] Performing offset validation on " + repr(structureelement) + " textclass " + textclass,file=stderr)
 
-                        warn_legacy = False
+                        #validate offsets
                         try:
-                            tc.getreference(validate=True, trim_spaces=False)
-                            msg += "\nHowever, according to the older rules (<v2.4.1) the offsets are accepted. So we are treating this as a warning rather than an error. We do recommend fixing this if this is a document you intend to publish."
-                            warn_legacy = True
-                        except UnresolvableTextContent as e2:
-                            msg += "\n(also checked against older rules prior to FoLiA v2.4.1)"
+                            tc.getreference(validate=True, reftextcache=reftextcache)
+                        except UnresolvableTextContent as e:
+                            msg = "Text for " + structureelement.__class__.__name__ + ", ID " + str(structureelement.id) + ", textclass " + textclass  + ", has incorrect offset " + str(tc.offset) + " or invalid reference: " + str(e)
 
-                        if self.filename:
-                            print( self.filename + ": TEXT VALIDATION ERROR: " + msg,file=sys.stderr)
-                        else:
-                            print("TEXT VALIDATION ERROR: " + msg,file=sys.stderr)
-                        if not warnonly and not warn_legacy:
-                            raise
+                            warn_legacy = False
+                            try:
+                                tc.getreference(validate=True, trim_spaces=False, reftextcache=reftextcache)
+                                msg += "\nHowever, according to the older rules (<v2.4.1) the offsets are accepted. So we are treating this as a warning rather than an error. We do recommend fixing this if this is a document you intend to publish."
+                                warn_legacy = True
+                            except UnresolvableTextContent as e2:
+                                msg += "\n(also checked against older rules prior to FoLiA v2.4.1)"
+
+                            if self.filename:
+                                print( self.filename + ": TEXT VALIDATION ERROR: " + msg,file=sys.stderr)
+                            else:
+                                print("TEXT VALIDATION ERROR: " + msg,file=sys.stderr)
+                            if not warnonly and not warn_legacy:
+                                raise
+
+
+    def validatetextchanges(self, warnonly=None):
+        """Perform text validation only on the elements of which the text or text offsets changed since the last call to this method (through e.g. :meth:`AbstractElement.settext` or :meth:`AbstractElement.correct`), rather than on the entire document.
+
+        The changed elements are validated along with their structural ancestors (which contain the changed text) and all structural descendants that carry text offsets.
+
+        Parameters:
+            warnonly (bool): Warn only (True) or raise exceptions (False). If set to None then this value will be determined based on the document's FoLiA version (Warn only before FoLiA v1.5)
+
+        Returns:
+            A dictionary reporting what was checked, with the keys ``elements`` (list of all elements on which text validation was performed), ``offsets`` (list of ``(element, textclass)`` tuples of which the offsets were validated) and ``errors`` (the number of text validation errors found, only relevant if ``warnonly`` is set)
 
+        Raises:
+            :class:`InconsistentText` or :class:`UnresolvableTextContent` if validation fails and ``warnonly`` is not set
+        """
+        if self.debug: print("[FoLiA DEBUG] Validating text changes of " + str(len(self.textchangebuffer)) + " element(s)",file=stderr)
+
+        changed = list(self.textchangebuffer.values()) #the buffer is only cleared once validation succeeded, so nothing is lost if it raises an exception
+
+        selection = OrderedDict()
+        for e in changed:
+            if e.parent is None:
+                continue #element is no longer part of the document
+            for ancestor in reversed(list(e.ancestors((AbstractStructureElement, String)))):
+                selection[id(ancestor)] = ancestor
+            selection[id(e)] = e
+            for descendant in e.select((AbstractStructureElement, String), False, True, False):
+                if any( isinstance(c, TextContent) and c.offset is not None for c in descendant ):
+                    selection[id(descendant)] = descendant
+
+        #offset validations that are pending for other elements are set aside, they remain pending
+        pending = [ (e, cls) for e, cls in self.offsetvalidationbuffer if id(e) not in selection ]
+        self.offsetvalidationbuffer = []
+        report = {'elements': list(selection.values()), 'offsets': [], 'errors': 0 }
+        textvalidation = self.textvalidation
+        try:
+            for e in report['elements']:
+                report['errors'] += int(not e.textvalidation(warnonly))
+            report['offsets'] = list(self.offsetvalidationbuffer)
+            self.textvalidation = True #force offset validation
+            self.pendingvalidation(warnonly)
+        finally:
+            self.textvalidation = textvalidation
+            self.offsetvalidationbuffer = pending + self.offsetvalidationbuffer
+        self.textchangebuffer = OrderedDict()
+        return report
 
     def select(self, Class, set=False, recursive=True,  ignore=True):
         """See :meth:`AbstractElement.select`"""
@@ -8803,9 +9480,81 @@ class Document(object):
                         return e
             raise IndexError
 
+    def offsetmap(self, cls='current', retaintokenisation=False, correctionhandling=CorrectionHandling.CURRENT, hidden=False):
+        """Renders the text of the entire document once, as :meth:`text` would, and returns a map between character offsets in that text and the words (see :meth:`AbstractElement.offsetmap`)
 
+        Returns:
+            :class:`OffsetMap`
+        """
+        parts = []
+        offsets = []
+        for c in self.data:
+            if parts: parts.append("\n\n\n")
+            c.textparts(parts, cls, retaintokenisation, "", correctionhandling, hidden, offsets)
+        return OffsetMap.fromparts(parts, offsets)
 
-    def text(self, cls='current', retaintokenisation=False, hidden=False, trim_spaces=True, correctionhandling=CorrectionHandling.CURRENT):
+    def structhash(self):
+        """Returns the structural hash of the body of the document, over the structural hashes of its text/speech elements (see :meth:`AbstractElement.structhash`)"""
+        return hash( tuple( e.structhash() for e in self.data ) )
+
+    def diff(self, other):
+        """Compares this document to another version of it, such as a corrected version, and returns the differences in the body of the documents (metadata and declarations are not compared).
+
+        Elements are matched by ID, elements without an ID (such as most inline annotations) are matched by their type and set, in order, within their parent. Subtrees that are identical in both versions are recognised by their structural hash (see :meth:`AbstractElement.structhash`) and skipped, as the hashes are cached, comparing a document to a slightly modified version again only visits the modified parts.
+
+        Arguments:
+            other (:class:`Document`): The other (new) version of the document
+
+        Returns:
+            :class:`DocumentDiff`
+
+        Example::
+
+            diff = original.diff(corrected)
+            for old, new in diff.changed:
+                print("changed: ", diff.describe(new))
+        """
+        diff = DocumentDiff()
+        diff.comparechildren(self.data, other.data)
+        return diff
+
+    def merge(self, *others):
+        """Merges other versions of this document into this document, such as the output of several annotation tools that were run in parallel on the same tokenised document.
+
+        Elements are joined on their IDs via the index of this document, elements without an ID (such as inline annotations and annotation layers) are matched by their type and set within the joined parent. Anything this document lacks is copied into it (see :meth:`AbstractElement.copy`), such as inline annotations, annotation layers or span annotations. Subtrees that are identical in both versions are recognised by their structural hash (see :meth:`AbstractElement.structhash`) and skipped, so apart from computing the hashes, only the annotations that are added are visited.
+
+        The declarations and the provenance data of the other versions are added to those of this document. Where this document already has a different annotation of the same type and set (for instance a different part-of-speech tag on a word), or a different version of an element with the same ID, this is reported as a conflict and the version in this document is kept.
+
+        Arguments:
+            *others (:class:`Document`): The other versions of the document
+
+        Returns:
+            :class:`DocumentMerge`
+
+        Example::
+
+            doc = folia.Document(file="tokenised.folia.xml")
+            merge = doc.merge(folia.Document(file="pos.folia.xml"), folia.Document(file="ner.folia.xml"))
+            for element, other in merge.conflicts:
+                print("conflict: ", merge.describe(element))
+        """
+        merge = DocumentMerge(self)
+        for other in others:
+            merge.mergedeclarations(other)
+            merge.mergechildren(self, other)
+        return merge
+
+    def tokencolumns(self):
+        """Returns a columnar view on all active words in the document (see :class:`TokenColumns`).
+
+        The view is kept and reused until the document changes, after which it is rebuilt on the next call.
+        """
+        if self._tokencolumns is None or not self._tokencolumns.isvalid():
+            self._tokencolumns = TokenColumns(self.words(), self)
+        return self._tokencolumns
+
+
+    def text(self, cls='current', retaintokenisation=False, hidden=False, trim_spaces=True, correctionhandling=CorrectionHandling.CURRENT):
         """Returns the text of the entire document, returns a single string
 
         See also:
@@ -8861,86 +9610,546 @@ class Document(object):
 
 
 
+async def aloaddocument(executor=None, **kwargs):
+    """Load a document without blocking the asyncio event loop, the document is loaded in a thread of the specified executor.
+
+    Arguments:
+        executor: The ``concurrent.futures`` executor to load the document in. If None (default), the default executor of the event loop is used. The number of threads of the executor bounds the number of documents that are loaded concurrently.
+        **kwargs: All keyword arguments are passed to :class:`Document`
+
+    Returns:
+        :class:`Document`
+
+    Example::
+
+        doc = await folia.aloaddocument(file='/path/to/document.folia.xml')
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(Document, **kwargs))
+
+async def _awaitfutures(futures):
+    """Internal function, cancels the ``concurrent.futures`` futures that have not started yet and waits for the ones that are still running"""
+    running = [ asyncio.wrap_future(future) for future in futures if not future.cancel() ]
+    if running:
+        await asyncio.wait(running)
+
 #==============================================================================
 
 class Corpus:
-    """A corpus of various FoLiA documents. Yields a Document on each iteration. Suitable for sequential processing."""
+    """A corpus of various FoLiA documents. Yields a Document on each iteration. Suitable for sequential processing.
+
+    The corpus directory is searched recursively, to any depth, and files are visited in a stable order: the files in a directory first, then its subdirectories, both sorted by name. Hidden files and directories are skipped.
+
+    Arguments:
+        corpusdir (str): The corpus directory
+        extension (str): The extension of the files to consider
+        restrict_to_collection (str): Only consider files in this subdirectory (collection) of the corpus directory
+        conditionf: A function taking a filename that returns a bool indicating whether to consider the file
+        ignoreerrors (bool): Print rather than raise errors for documents that can not be loaded
+        pattern (str): Only consider files whose path relative to the corpus directory matches this glob pattern (e.g. ``news/*/*.folia.xml``), wildcards match within a single path component
+        shard (int): Only consider the files in this shard (counting from 0), requires ``nshards``
+        nshards (int): Partition the files in this number of shards that are balanced by total file size, so multiple processes or machines can each process a disjoint part of the corpus. The partitioning is deterministic.
+        **kwargs: All other keyword arguments are passed to :class:`Document`
+    """
 
-    def __init__(self,corpusdir, extension = 'xml', restrict_to_collection = "", conditionf=lambda x: True, ignoreerrors=False, **kwargs):
+    def __init__(self,corpusdir, extension = 'xml', restrict_to_collection = "", conditionf=lambda x: True, ignoreerrors=False, pattern=None, shard=None, nshards=None, **kwargs):
         self.corpusdir = corpusdir
         self.extension = extension
         self.restrict_to_collection = restrict_to_collection
         self.conditionf = conditionf
         self.ignoreerrors = ignoreerrors
+        self.pattern = pattern
+        self.shard = shard
+        self.nshards = nshards
+        if nshards and (shard is None or shard < 0 or shard >= nshards):
+            raise ValueError("shard must be a number from 0 to " + str(nshards - 1))
         self.kwargs = kwargs
 
     def __iter__(self):
-        if not self.restrict_to_collection:
-            for f in glob.glob(os.path.join(self.corpusdir,"*." + self.extension)):
-                if self.conditionf(f):
-                    try:
-                        yield Document(file=f, **self.kwargs )
-                    except Exception as e: #pylint: disable=broad-except
-                        print("Error, unable to parse " + f + ": " + e.__class__.__name__  + " - " + str(e),file=stderr)
-                        if not self.ignoreerrors:
-                            raise
-        for d in glob.glob(os.path.join(self.corpusdir,"*")):
-            if (not self.restrict_to_collection or self.restrict_to_collection == os.path.basename(d)) and (os.path.isdir(d)):
-                for f in glob.glob(os.path.join(d ,"*." + self.extension)):
-                    if self.conditionf(f):
-                        try:
-                            yield Document(file=f, **self.kwargs)
-                        except Exception as e: #pylint: disable=broad-except
-                            print("Error, unable to parse " + f + ": " + e.__class__.__name__  + " - " + str(e),file=stderr)
-                            if not self.ignoreerrors:
-                                raise
+        for f in self.files():
+            try:
+                yield Document(file=f, **self.kwargs )
+            except Exception as e: #pylint: disable=broad-except
+                print("Error, unable to parse " + f + ": " + e.__class__.__name__  + " - " + str(e),file=stderr)
+                if not self.ignoreerrors:
+                    raise
+
+    def __aiter__(self):
+        return self.adocuments()
+
+    async def adocuments(self, concurrency=None, executor=None):
+        """Asynchronous generator yielding the documents of the corpus, in the same order as normal iteration, without blocking the asyncio event loop. Also invoked by ``async for doc in corpus``.
+
+        Documents are loaded ahead in threads. If the consumer stops or is cancelled, documents that have not started loading are cancelled and the ones that are still loading are waited for, so no files are left open.
+
+        Arguments:
+            concurrency (int): The maximum number of documents that are loaded concurrently (defaults to the number of CPU cores, with a maximum of 4)
+            executor: The ``concurrent.futures`` executor to load documents in. If None (default), a thread pool is created.
+
+        Example::
+
+            async for doc in folia.Corpus('/path/to/corpus'):
+                print(doc.id)
+        """
+        if concurrency is None:
+            concurrency = min(4, multiprocessing.cpu_count())
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        ownexecutor = executor is None
+        if ownexecutor:
+            executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+        pending = deque() #(filename, future) pairs, in corpus order
+        try:
+            files = await asyncio.get_running_loop().run_in_executor(executor, list, self.files())
+            for f, future in self._prefetch(files, executor, lambda f: Document(file=f, **self.kwargs), concurrency, pending):
+                try:
+                    doc = await asyncio.wrap_future(future)
+                except Exception as e: #pylint: disable=broad-except
+                    print("Error, unable to parse " + f + ": " + e.__class__.__name__  + " - " + str(e),file=stderr)
+                    if not self.ignoreerrors:
+                        raise
+                    continue
+                yield doc
+        finally:
+            await _awaitfutures([ future for _, future in pending ])
+            if ownexecutor:
+                executor.shutdown(wait=False)
+
+    @staticmethod
+    def _prefetch(files, executor, loadf, ahead, pending):
+        """Internal generator, submits ``loadf(filename)`` to the executor for up to ``ahead`` files in advance and yields the ``(filename, future)`` pairs in order. Pairs that were submitted but not consumed yet are held in the ``pending`` deque, so the caller can clean them up if it stops early"""
+        files = iter(files)
+        while True:
+            #keep the prefetch queue filled
+            for f in files:
+                pending.append( (f, executor.submit(loadf, f)) )
+                if len(pending) >= ahead:
+                    break
+            if not pending:
+                break
+            yield pending[0]
+            pending.popleft()
+
+    def files(self):
+        """Generator yielding the filenames of all files in the corpus (or in the shard), in a stable order"""
+        if self.nshards:
+            for filename, _ in self.manifest():
+                yield filename
+        else:
+            for filename, _ in self._walk(False):
+                yield filename
+
+    def manifest(self):
+        """Returns a list of ``(filename, size)`` tuples for all files in the corpus (or in the shard), in the same stable order as iteration"""
+        files = list(self._walk(True))
+        if self.nshards:
+            #assign the largest files first, each to the shard that is smallest so far
+            shards = [ (0, i) for i in range(self.nshards) ]
+            selected = set()
+            for filename, size in sorted(files, key=lambda x: (-x[1], x[0])):
+                total, shard = heapq.heappop(shards)
+                if shard == self.shard:
+                    selected.add(filename)
+                heapq.heappush(shards, (total + size, shard))
+            files = [ (filename, size) for filename, size in files if filename in selected ]
+        return files
+
+    def savemanifest(self, filename):
+        """Write the manifest (see :meth:`manifest`) to file, as tab-separated filename and size, one file per line"""
+        with io.open(filename,'w',encoding='utf-8') as f:
+            for corpusfile, size in self.manifest():
+                f.write(corpusfile + "\t" + str(size) + "\n")
+
+    def _walk(self, withsize, directory="", visited=None):
+        """Internal generator walking the corpus directory using os.scandir, yields ``(filename, size)`` tuples (size is None if withsize is False)"""
+        if visited is None:
+            visited = set()
+        path = os.path.join(self.corpusdir, directory) if directory else self.corpusdir
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if (st.st_dev, st.st_ino) in visited:
+            return #guard against symlink loops
+        visited.add( (st.st_dev, st.st_ino) )
+
+        files = []
+        subdirs = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name[0] == '.':
+                    continue
+                try:
+                    if entry.is_dir():
+                        if directory or not self.restrict_to_collection or entry.name == self.restrict_to_collection:
+                            subdirs.append(entry.name)
+                    elif (directory or not self.restrict_to_collection) and entry.name.endswith("." + self.extension):
+                        files.append(entry)
+                except OSError:
+                    continue
+
+        for entry in sorted(files, key=lambda x: x.name):
+            relpath = os.path.join(directory, entry.name) if directory else entry.name
+            if self.pattern:
+                #match component by component, so a * does not cross directory boundaries
+                parts = relpath.split(os.sep)
+                patternparts = self.pattern.replace(os.sep, '/').split('/')
+                if len(parts) != len(patternparts) or not all(fnmatch.fnmatch(part, patternpart) for part, patternpart in zip(parts, patternparts)):
+                    continue
+            filename = os.path.join(self.corpusdir, relpath)
+            if self.conditionf(filename):
+                yield filename, (entry.stat().st_size if withsize else None)
+
+        for subdir in sorted(subdirs):
+            for result in self._walk(withsize, os.path.join(directory, subdir) if directory else subdir, visited):
+                yield result
+
+    def mapreduce(self, mapfn, reducefn, combiner=None, initial=None, threads=None, chunksize=None, chunkbytes=1024*1024):
+        """Compute an aggregate over the entire corpus in parallel, e.g. token counts or frequency lists.
+
+        The map function is called on each document in a worker process (documents are loaded with the keyword arguments this corpus was instantiated with). The results of each chunk of files are combined inside the worker, in order, before they are passed back. The results of all chunks are then merged in a balanced tree using the reduce function.
+
+        The chunks only depend on the (sorted) files and their sizes, never on the number of workers, so the outcome is deterministic as long as the reduce function is associative. It does not need to be commutative.
+
+        Arguments:
+            mapfn: A function taking a :class:`Document` and returning a (picklable) value. Must be picklable itself, i.e. defined at the top-level of a module.
+            reducefn: A function taking two values and returning a merged value, must be associative.
+            combiner: The function to combine values inside the worker processes, defaults to ``reducefn``. Must be picklable.
+            initial: The value to return if there are no documents
+            threads (int): The number of worker processes (defaults to the number of CPU cores)
+            chunksize (int or None): The number of files per chunk, if None (default), chunks are composed by file size (see ``chunkbytes``)
+            chunkbytes (int): The approximate total file size of a chunk in bytes, if ``chunksize`` is None
+
+        Returns:
+            The reduced value
+
+        Example::
+
+            def countwords(doc):
+                return collections.Counter( w.text() for w in doc.words() )
+
+            frequencylist = folia.Corpus('/path/to/corpus').mapreduce(countwords, operator.add)
+        """
+        if combiner is None:
+            combiner = reducefn
+        processor = CorpusProcessor(self.corpusdir, _mapreduce_map, threads, self.extension, self.restrict_to_collection, self.conditionf, preindex=True, ordered=True, chunksize=chunksize, chunkbytes=chunkbytes, ignoreerrors=self.ignoreerrors, combiner=combiner, pattern=self.pattern, shard=self.shard, nshards=self.nshards)
+        stack = [] #(level, value) pairs, merging two values of the same level makes the tree balanced
+        for r in processor.results(mapfn, **self.kwargs):
+            if r.failed:
+                print("Error, unable to process " + ", ".join(r.filenames) + ": " + r.error.__class__.__name__  + " - " + str(r.error),file=stderr)
+                if not self.ignoreerrors:
+                    raise r.error
+                continue
+            level = 0
+            value = r.result
+            while stack and stack[-1][0] == level:
+                value = reducefn(stack.pop()[1], value)
+                level += 1
+            stack.append( (level, value) )
+        if not stack:
+            return initial
+        value = stack.pop()[1]
+        while stack:
+            value = reducefn(stack.pop()[1], value)
+        return value
+
+def _mapreduce_map(task):
+    """Internal function, the map step of :meth:`Corpus.mapreduce` as run by the corpus processor"""
+    filename, args, kwargs = task
+    return args[0](Document(file=filename, **kwargs))
 
 
 class CorpusFiles(Corpus):
     """A corpus of various FoLiA documents. Yields the filenames on each iteration."""
 
     def __iter__(self):
-        if not self.restrict_to_collection:
-            for f in glob.glob(os.path.join(self.corpusdir,"*." + self.extension)):
-                if self.conditionf(f):
-                    try:
-                        yield f
-                    except Exception as e: #pylint: disable=broad-except
-                        print("Error, unable to parse " + f+ ": " + e.__class__.__name__  + " - " + str(e),file=stderr)
-                        if not self.ignoreerrors:
-                            raise
-        for d in glob.glob(os.path.join(self.corpusdir,"*")):
-            if (not self.restrict_to_collection or self.restrict_to_collection == os.path.basename(d)) and (os.path.isdir(d)):
-                for f in glob.glob(os.path.join(d, "*." + self.extension)):
-                    if self.conditionf(f):
-                        try:
-                            yield f
-                        except Exception as e: #pylint: disable=broad-except
-                            print("Error, unable to parse " + f+ ": " + e.__class__.__name__  + " - " + str(e),file=stderr)
-                            if not self.ignoreerrors:
-                                raise
+        return self.files()
+
+
+class CorpusLoader(Corpus):
+    """A corpus of various FoLiA documents. Yields a Document on each iteration, in the same order as :class:`Corpus`, but loads documents ahead of time using a pool of threads.
 
+    Reading and decompressing the files and the XML parsing by lxml release the GIL, so they are done in the background threads and overlap with the construction of the FoLiA document in the calling thread. The number of documents that are loaded ahead is bounded by ``prefetch``, which limits the memory that is used for XML trees waiting to be processed.
+
+    Arguments:
+        corpusdir (str): The corpus directory
+        threads (int): The number of threads reading and parsing files (defaults to the number of CPU cores, with a maximum of 4)
+        prefetch (int): The maximum number of documents that are read and parsed ahead (defaults to twice the number of threads)
+
+    All other arguments are as for :class:`Corpus`.
+
+    Example::
+
+        for doc in folia.CorpusLoader('/path/to/corpus', threads=2):
+            print(doc.id)
+    """
 
+    def __init__(self,corpusdir, extension = 'xml', restrict_to_collection = "", conditionf=lambda x: True, ignoreerrors=False, pattern=None, shard=None, nshards=None, threads=None, prefetch=None, **kwargs):
+        super(CorpusLoader, self).__init__(corpusdir, extension, restrict_to_collection, conditionf, ignoreerrors, pattern, shard, nshards, **kwargs)
+        if threads is None:
+            threads = min(4, multiprocessing.cpu_count())
+        if threads < 1:
+            raise ValueError("threads must be at least 1")
+        self.threads = threads
+        self.prefetch = prefetch if prefetch else 2 * threads
 
+    def __iter__(self):
+        executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+        pending = deque() #(filename, future) pairs, in corpus order
+        try:
+            for f, future in self._prefetch(self.files(), executor, xmltreefromfile, self.prefetch, pending):
+                doc = self._build(f, future)
+                if doc is not None:
+                    yield doc
+        finally:
+            #the consumer may stop early, cancel what has not started yet and wait for the rest
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def _build(self, filename, future):
+        """Internal method, builds the document from a parsed XML tree, returns None if an error is ignored"""
+        try:
+            tree = future.result()
+            doc = Document(tree=tree, filename=filename, **self.kwargs)
+            if doc.mode == Mode.XPATH:
+                doc.tree = tree
+            return doc
+        except Exception as e: #pylint: disable=broad-except
+            print("Error, unable to parse " + filename + ": " + e.__class__.__name__  + " - " + str(e),file=stderr)
+            if not self.ignoreerrors:
+                raise
+        return None
+
+
+
+class CorpusResult(object):
+    """The result of processing a single file by a :class:`CorpusProcessor`.
+
+    Attributes:
+        filename (str): The file that was processed
+        result: The value returned by the user-defined function (None if it failed)
+        error (Exception or None): The exception raised by the user-defined function, if any
+        traceback (str or None): The formatted traceback of the error, if any
+        failed (bool): Indicates whether processing this file failed
+        duration (float): Processing time in seconds
+        size (int): The size of the file in bytes
+        tokens (int): The number of tokens processed, as reported by the ``tokenf`` function of the processor (0 otherwise)
+        filenames (list): All files this result covers, this is only more than just ``filename`` if the processor has a ``combiner``
+    """
+
+    def __init__(self, filename, result=None, error=None, traceback=None, duration=0.0, size=0, tokens=0, filenames=None):
+        self.filename = filename
+        self.filenames = filenames if filenames is not None else [filename]
+        self.result = result
+        self.error = error
+        self.traceback = traceback
+        self.failed = error is not None
+        self.duration = duration
+        self.size = size
+        self.tokens = tokens
+
+    def __repr__(self):
+        if self.failed:
+            return "<CorpusResult " + self.filename + " FAILED: " + self.error.__class__.__name__ + " - " + str(self.error) + ">"
+        else:
+            return "<CorpusResult " + self.filename + " (" + str(round(self.duration,3)) + "s)>"
+
+
+class CorpusProcessorStats(object):
+    """Live statistics of a running :class:`CorpusProcessor`, available as its ``stats`` attribute."""
+
+    def __init__(self):
+        self.begintime = time.time()
+        self.endtime = None
+        self.files = 0 #number of processed files (including failures)
+        self.failures = 0
+        self.bytes = 0
+        self.tokens = 0
+        self.inflight = 0 #number of chunks currently submitted but not yet returned
+        self.recycled = 0 #number of worker processes that were recycled (or that died)
+
+    def elapsed(self):
+        """Returns the time in seconds since processing started"""
+        if self.endtime is None:
+            return time.time() - self.begintime
+        else:
+            return self.endtime - self.begintime
+
+    def filespersecond(self):
+        elapsed = self.elapsed()
+        return self.files / elapsed if elapsed else 0.0
+
+    def tokenspersecond(self):
+        elapsed = self.elapsed()
+        return self.tokens / elapsed if elapsed else 0.0
+
+    def __str__(self):
+        return "files: " + str(self.files) + " (" + str(round(self.filespersecond(),2)) + "/s), tokens: " + str(self.tokens) + " (" + str(round(self.tokenspersecond(),2)) + "/s), failures: " + str(self.failures) + ", in flight: " + str(self.inflight) + ", recycled workers: " + str(self.recycled) + ", elapsed: " + str(round(self.elapsed(),2)) + "s"
+
+
+def getrss():
+    """Returns the current resident set size (memory usage) of this process in bytes, or 0 if this can not be determined on this platform"""
+    try:
+        with open('/proc/self/statm','r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource #pylint: disable=import-outside-toplevel
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss #peak rather than current usage, in kilobytes (but bytes on macOS)
+        if sys.platform == 'darwin':
+            return maxrss
+        return maxrss * 1024
+    except (ImportError, AttributeError):
+        return 0
+
+def _corpusprocessor_worker(function, tokenf, combiner, tasks, connection, maxtasks, maxrss):
+    """Internal function, the main loop of a worker process of :class:`CorpusProcessor`. Receives chunks over the tasks queue and sends back the pickled results over the connection"""
+    processed = 0
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        seq, chunk, args, kwargs = task
+        output = []
+        for filename, size in chunk:
+            begintime = time.time()
+            try:
+                result = function( (filename, args, kwargs) )
+                tokens = tokenf(result) if tokenf is not None else 0
+                output.append( CorpusResult(filename, result, duration=time.time() - begintime, size=size, tokens=tokens) )
+            except Exception as e: #pylint: disable=broad-except
+                try:
+                    pickle.dumps(e)
+                except Exception: #pylint: disable=broad-except
+                    e = Exception(e.__class__.__name__ + " - " + str(e)) #not all exceptions can be passed between processes
+                output.append( CorpusResult(filename, None, e, traceback.format_exc(), time.time() - begintime, size) )
+        if combiner is not None:
+            output = _combineresults(combiner, output)
+        processed += len(chunk)
+        recycle = bool((maxtasks and processed >= maxtasks) or (maxrss and getrss() > maxrss))
+        try:
+            payload = pickle.dumps( (seq, output, recycle) )
+        except Exception: #pylint: disable=broad-except
+            #some results can not be pickled, replace them by an error
+            for i, r in enumerate(output):
+                try:
+                    pickle.dumps(r)
+                except Exception as e: #pylint: disable=broad-except
+                    output[i] = CorpusResult(r.filename, None, ValueError("Unable to pass result back to the main process: " + e.__class__.__name__ + " - " + str(e)), None, r.duration, r.size)
+            payload = pickle.dumps( (seq, output, recycle) )
+        connection.send_bytes(payload) #synchronous, so nothing gets lost if the process dies later on
+        if recycle:
+            break
+
+
+def _combineresults(combiner, output):
+    """Internal function, combines all successful results of a chunk into a single result (in order) using the combiner function, failures are retained as they are"""
+    successes = [ r for r in output if not r.failed ]
+    if not successes:
+        return output
+    combined = successes[0].result
+    try:
+        for r in successes[1:]:
+            combined = combiner(combined, r.result)
+    except Exception as e: #pylint: disable=broad-except
+        try:
+            pickle.dumps(e)
+        except Exception: #pylint: disable=broad-except
+            e = Exception(e.__class__.__name__ + " - " + str(e))
+        return [ r for r in output if r.failed ] + [ CorpusResult(successes[0].filename, None, e, traceback.format_exc(), sum(r.duration for r in successes), sum(r.size for r in successes), 0, [ r.filename for r in successes ]) ]
+    return [ r for r in output if r.failed ] + [ CorpusResult(successes[0].filename, combined, None, None, sum(r.duration for r in successes), sum(r.size for r in successes), sum(r.tokens for r in successes), [ r.filename for r in successes ]) ]
+
+
+class _CorpusWorker(object):
+    """Internal class, a worker process of :class:`CorpusProcessor` along with its task queue and result connection"""
+
+    def __init__(self, function, tokenf, combiner, maxtasks, maxrss):
+        self.tasks = multiprocessing.Queue()
+        self.connection, childconnection = multiprocessing.Pipe(False)
+        self.process = multiprocessing.Process(target=_corpusprocessor_worker, args=(function, tokenf, combiner, self.tasks, childconnection, maxtasks, maxrss))
+        self.process.daemon = True
+        self.process.start()
+        childconnection.close()
+        self.assigned = [] #sequence numbers of the chunks assigned to this worker that have not been returned yet
+
+    def submit(self, seq, chunk, args, kwargs):
+        self.assigned.append(seq)
+        self.tasks.put( (seq, chunk, args, kwargs) )
+
+    def shutdown(self):
+        try:
+            while True:
+                self.tasks.get_nowait() #discard work that was not started yet
+        except (queue.Empty, OSError, ValueError):
+            pass
+        self.tasks.put(None)
+
+    def close(self):
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.tasks.cancel_join_thread()
+        self.tasks.close()
+        self.connection.close()
 
 
 class CorpusProcessor(object):
-    """Processes a corpus of various FoLiA documents using a parallel processing. Calls a user-defined function with the three-tuple (filename, args, kwargs) for each file in the corpus. The user-defined function is itself responsible for instantiating a FoLiA document! args and kwargs, as received by the custom function, are set through the run() method, which yields the result of the custom function on each iteration."""
+    """Processes a corpus of various FoLiA documents using a parallel processing. Calls a user-defined function with the three-tuple (filename, args, kwargs) for each file in the corpus. The user-defined function is itself responsible for instantiating a FoLiA document! args and kwargs, as received by the custom function, are set through the run() method, which yields the result of the custom function on each iteration.
+
+    Use :meth:`results` rather than :meth:`run` to obtain a :class:`CorpusResult` for each file instead, which also holds any errors. Live statistics are available in the ``stats`` attribute (a :class:`CorpusProcessorStats` instance) while processing.
+
+    Arguments:
+        corpusdir (str): The corpus directory
+        function: The user-defined function to call for each file, must be picklable (i.e. defined at the top-level of a module)
+        threads (int): The number of worker processes (defaults to the number of CPU cores)
+        extension (str): The extension of the files to process
+        restrict_to_collection (str): Only process files in this subdirectory (collection)
+        conditionf: A function taking a filename that returns a bool indicating whether to process the file
+        maxtasksperchild (int): Recycle a worker process after it processed this many files. This should never be set too high due to lxml leaking memory!
+        preindex (bool): Gather and sort all filenames before processing starts
+        ordered (bool): Yield the results in the order of the files (True), or as soon as they become available (False)
+        chunksize (int or None): The number of files passed to a worker at once, if set to None, chunks will be composed adaptively by file size (see ``chunkbytes``)
+        chunkbytes (int): The approximate total file size of a chunk (in bytes) when chunk sizes are adaptive; larger files will be processed one at a time
+        maxinflight (int): The maximum number of chunks submitted to the workers that have not been returned yet (or, if ordered, that were returned but wait for an earlier chunk). Limits memory consumption when results are consumed slower than they are produced. Defaults to twice the number of workers.
+        maxrss (int): Recycle a worker process when its memory usage (resident set size) exceeds this number of megabytes
+        ignoreerrors (bool): Only print errors rather than raising them in :meth:`run` (errors are always reported and never raised by :meth:`results`)
+        tokenf: A function that takes the result of the user-defined function and returns the number of tokens that were processed, used for statistics only (called in the worker processes, must be picklable)
+        progress: A function that will be called with the ``stats`` (:class:`CorpusProcessorStats`) as sole argument periodically (see ``progressinterval``) and when processing is done
+        progressinterval (float): The minimum interval in seconds between calls to the ``progress`` function
+        pattern (str): Only process files whose path relative to the corpus directory matches this glob pattern
+        shard (int): Only process the files in this shard (counting from 0), see :class:`Corpus`
+        nshards (int): The number of shards, see :class:`Corpus`
+        combiner: A function taking two results of the user-defined function and returning one. If set, the successful results of each chunk are combined into one in the worker process (in order), so only a single :class:`CorpusResult` per chunk is passed back (see its ``filenames`` attribute). Must be picklable. Used by :meth:`Corpus.mapreduce`.
+    """
 
-    def __init__(self,corpusdir, function, threads = None, extension = 'xml', restrict_to_collection = "", conditionf=lambda x: True, maxtasksperchild=100, preindex = False, ordered=True, chunksize = 1):
+    def __init__(self,corpusdir, function, threads = None, extension = 'xml', restrict_to_collection = "", conditionf=lambda x: True, maxtasksperchild=100, preindex = False, ordered=True, chunksize = 1, chunkbytes=1024*1024, maxinflight=None, maxrss=None, ignoreerrors=False, tokenf=None, progress=None, progressinterval=1.0, combiner=None, pattern=None, shard=None, nshards=None):
         self.function = function
         self.threads = threads #If set to None, will use all available cores by default
         self.corpusdir = corpusdir
         self.extension = extension
         self.restrict_to_collection = restrict_to_collection
         self.conditionf = conditionf
-        self.ignoreerrors = True
+        self.ignoreerrors = ignoreerrors
         self.maxtasksperchild = maxtasksperchild #This should never be set too high due to lxml leaking memory!!!
         self.preindex = preindex
         self.ordered = ordered
         self.chunksize = chunksize
+        self.chunkbytes = chunkbytes
+        self.maxinflight = maxinflight
+        self.maxrss = maxrss
+        self.tokenf = tokenf
+        self.progress = progress
+        self.progressinterval = progressinterval
+        self.combiner = combiner
+        self.pattern = pattern
+        self.shard = shard
+        self.nshards = nshards
+        self.stats = CorpusProcessorStats()
         if preindex:
-            self.index = list(CorpusFiles(self.corpusdir, self.extension, self.restrict_to_collection, self.conditionf, True))
+            self.index = list(CorpusFiles(self.corpusdir, self.extension, self.restrict_to_collection, self.conditionf, True, self.pattern, self.shard, self.nshards))
             self.index.sort()
 
 
@@ -8954,24 +10163,330 @@ class CorpusProcessor(object):
         for _ in self.run():
             pass
 
-    def run(self, *args, **kwargs):
+    def chunks(self):
+        """Generator yielding the chunks of files that are passed to the workers, each chunk is a list of ``(filename, size)`` tuples"""
+        chunk = []
+        chunkbytes = 0
+        for filename in self.index:
+            try:
+                size = os.path.getsize(filename)
+            except OSError:
+                size = 0
+            chunk.append( (filename, size) )
+            chunkbytes += size
+            if (self.chunksize and len(chunk) >= self.chunksize) or (not self.chunksize and (chunkbytes >= self.chunkbytes or len(chunk) >= 1000)):
+                yield chunk
+                chunk = []
+                chunkbytes = 0
+        if chunk:
+            yield chunk
+
+    def results(self, *args, **kwargs):
+        """Process the corpus, passing args and kwargs on to the user-defined function, and yield a :class:`CorpusResult` for each file.
+
+        Errors in the user-defined function are never raised here but reported in the results, this includes worker processes that die unexpectedly. Worker processes are shut down when the generator is exhausted or closed.
+        """
         if not self.preindex:
-            self.index = CorpusFiles(self.corpusdir, self.extension, self.restrict_to_collection, self.conditionf, True) #generator
-        pool = multiprocessing.Pool(self.threads,None,None, self.maxtasksperchild)
+            self.index = CorpusFiles(self.corpusdir, self.extension, self.restrict_to_collection, self.conditionf, True, self.pattern, self.shard, self.nshards) #generator
+        threads = self.threads or multiprocessing.cpu_count()
+        maxinflight = self.maxinflight or threads * 2
+        maxrss = self.maxrss * 1024 * 1024 if self.maxrss else None
+        self.stats = CorpusProcessorStats()
+        lastprogress = time.time()
+
+        workers = {} #pid -> CorpusWorker
+        inflight = {} #seq -> chunk
+        done = {} #seq -> list of results (only used if ordered)
+        chunks = self.chunks()
+        seq = 0 #sequence number of the next chunk to submit
+        nextseq = 0 #sequence number of the next chunk to yield (if ordered)
+        exhausted = False
+
+        def spawn():
+            worker = _CorpusWorker(self.function, self.tokenf, self.combiner, self.maxtasksperchild, maxrss)
+            workers[worker.process.pid] = worker
+
+        def submit(chunkseq):
+            #assign to the worker with the least outstanding work
+            worker = min(workers.values(), key=lambda w: len(w.assigned))
+            worker.submit(chunkseq, inflight[chunkseq], args, kwargs)
+
+        def retire(worker):
+            #remove a worker and reassign any work it had not started yet
+            del workers[worker.process.pid]
+            self.stats.recycled += 1
+            worker.close()
+            spawn()
+            for chunkseq in worker.assigned:
+                submit(chunkseq)
+
+        try:
+            for _ in range(threads):
+                spawn()
+
+            while True:
+                #submit work until we reach the in-flight limit (backpressure: we only continue when the consumer asks for more results), chunks that are done but wait for an earlier one (if ordered) count as well
+                while not exhausted and len(inflight) + len(done) < maxinflight:
+                    try:
+                        inflight[seq] = next(chunks)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    submit(seq)
+                    seq += 1
+                self.stats.inflight = len(inflight)
+                if not inflight:
+                    break
+
+                ready = multiprocessing.connection.wait([ w.connection for w in workers.values() ] + [ w.process.sentinel for w in workers.values() ], timeout=self.progressinterval)
+                for worker in list(workers.values()):
+                    died = worker.process.sentinel in ready
+                    retired = False
+                    while worker.connection.poll(): #read all results that are available
+                        try:
+                            chunkseq, output, recycle = pickle.loads(worker.connection.recv_bytes())
+                        except EOFError:
+                            break
+                        worker.assigned.remove(chunkseq)
+                        for r in self._finish(chunkseq, output, inflight, done):
+                            yield r
+                        if recycle:
+                            retire(worker)
+                            retired = True
+                            break
+                    if died and not retired:
+                        #the worker died unexpectedly while processing the first chunk assigned to it
+                        worker.process.join()
+                        if worker.assigned:
+                            chunkseq = worker.assigned.pop(0)
+                            error = Exception("Worker process " + str(worker.process.pid) + " died unexpectedly (exit code " + str(worker.process.exitcode) + ")")
+                            for r in self._finish(chunkseq, [ CorpusResult(filename, None, error, None, 0.0, size) for filename, size in inflight[chunkseq] ], inflight, done):
+                                yield r
+                        retire(worker)
+
+                if self.ordered:
+                    while nextseq in done:
+                        for r in done.pop(nextseq):
+                            yield r
+                        nextseq += 1
+
+                if self.progress is not None and time.time() - lastprogress >= self.progressinterval:
+                    self.progress(self.stats)
+                    lastprogress = time.time()
+        finally:
+            #clean shutdown, any work that has not been started yet is discarded
+            self.stats.endtime = time.time()
+            self.stats.inflight = 0
+            for worker in workers.values():
+                worker.shutdown()
+            for worker in workers.values():
+                worker.close()
+            if self.progress is not None:
+                self.progress(self.stats)
+
+    def _finish(self, seq, output, inflight, done):
+        """Internal method, registers the results of a processed chunk, yields them immediately if processing is unordered"""
+        del inflight[seq]
+        for r in output:
+            self.stats.files += len(r.filenames)
+            self.stats.bytes += r.size
+            self.stats.tokens += r.tokens
+            if r.failed:
+                self.stats.failures += len(r.filenames)
         if self.ordered:
-            return pool.imap( self.function,  ( (filename, args, kwargs) for filename in self.index), self.chunksize)
+            done[seq] = output
         else:
-            return pool.imap_unordered( self.function,  ( (filename, args, kwargs) for filename in self.index), self.chunksize)
-        #pool.close()
+            for r in output:
+                yield r
 
+    def run(self, *args, **kwargs):
+        """Process the corpus, passing args and kwargs on to the user-defined function, and yield its return value for each file.
 
+        Raises the error of the user-defined function if processing a file fails, unless ``ignoreerrors`` is set in which case the error is only printed and the file is skipped. Use :meth:`results` if you want to handle errors yourself.
+        """
+        for r in self.results(*args, **kwargs):
+            if r.failed:
+                if not self.ignoreerrors:
+                    raise r.error
+                print("Error, unable to process " + r.filename + ": " + r.error.__class__.__name__  + " - " + str(r.error),file=stderr)
+            else:
+                yield r.result
 
     def __iter__(self):
         return self.run()
 
 
+class CorpusIndex(object):
+    """A persistent inverted index for word search over a corpus, stored in an sqlite database.
+
+    The index maps the text, lemma and part-of-speech classes (per set) of words to postings: ``(filename, word id, sentence id)`` tuples, the sentence id is None for words that are not in a sentence. Documents (optionally compressed with gzip or bz2) are streamed once, word by word, and queries return postings without opening any documents.
+
+    Arguments:
+        filename (str): The filename of the sqlite database, will be created if it does not exist yet
+        ignoreerrors (bool): Print rather than raise errors for documents that can not be indexed
+
+    Example::
+
+        index = folia.CorpusIndex('corpus.index.sqlite')
+        index.update(folia.Corpus('/path/to/corpus'))
+        for filename, wordid, sentenceid in index.find('huis', folia.AnnotationType.LEMMA):
+            ..
+    """
+
+    INDEXED = (AnnotationType.TEXT, AnnotationType.LEMMA, AnnotationType.POS)
+
+    def __init__(self, filename, ignoreerrors=False):
+        self.filename = filename
+        self.ignoreerrors = ignoreerrors
+        self.db = sqlite3.connect(filename)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, filename TEXT UNIQUE NOT NULL, mtime REAL NOT NULL, size INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, type INTEGER NOT NULL, "set" TEXT NOT NULL, value TEXT NOT NULL, UNIQUE (type, "set", value));
+            CREATE TABLE IF NOT EXISTS postings (term INTEGER NOT NULL, file INTEGER NOT NULL, word TEXT, sentence TEXT, position INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS postings_term ON postings (term);
+            CREATE INDEX IF NOT EXISTS postings_file ON postings (file);
+        """)
+        self.terms = None #(type, set, value) => term id, loaded when updating
+
+    def update(self, corpus):
+        """Bring the index up to date with the corpus. Only files that are new, or whose modification time or size changed, are (re)indexed; files that are no longer in the corpus are removed from the index.
+
+        Arguments:
+            corpus: A :class:`Corpus` instance, or any iterable of filenames
+
+        Returns:
+            A dictionary with the number of files that were ``added``, ``updated``, ``removed``, ``unchanged`` and that ``failed``
+        """
+        if isinstance(corpus, Corpus):
+            corpus = corpus.files()
+        if self.terms is None:
+            self.terms = { (termtype, termset, value): termid for termid, termtype, termset, value in self.db.execute('SELECT id, type, "set", value FROM terms') }
+        indexed = { filename: (fileid, mtime, size) for fileid, filename, mtime, size in self.db.execute("SELECT id, filename, mtime, size FROM files") }
+        stats = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0, 'failed': 0}
+        for filename in corpus:
+            try:
+                st = os.stat(filename)
+            except FileNotFoundError:
+                continue #the file vanished, if it was indexed it is removed below
+            if filename in indexed:
+                fileid, mtime, size = indexed.pop(filename)
+                if mtime == st.st_mtime and size == st.st_size:
+                    stats['unchanged'] += 1
+                    continue
+                self._remove(fileid)
+                key = 'updated'
+            else:
+                key = 'added'
+            added = self._add(filename, st)
+            if added:
+                stats[key] += 1
+            elif added is not None: #None means the file vanished in the meantime
+                stats['failed'] += 1
+        for fileid, _, _ in indexed.values():
+            self._remove(fileid)
+            stats['removed'] += 1
+        self.db.commit()
+        return stats
+
+    def _add(self, filename, st):
+        """Internal method, indexes a single file, returns False if it could not be indexed, or None if the file no longer exists"""
+        postings = []
+        reader = None
+        try:
+            position = 0
+            #words in e.g. the original of a correction are not indexed, like in AbstractElement.words()
+            reader = Reader(filename, Word, context=Sentence, ignore=default_ignore, keepindex=False)
+            for word, sentenceid in reader:
+                try:
+                    postings.append( (self._term(AnnotationType.TEXT, "", word.text()), word.id, sentenceid, position) )
+                except NoSuchText:
+                    pass
+                for annotation in itertools.chain(word.select(LemmaAnnotation, False, False), word.select(PosAnnotation, False, False)):
+                    if annotation.cls is not None:
+                        postings.append( (self._term(annotation.ANNOTATIONTYPE, annotation.set or "", annotation.cls), word.id, sentenceid, position) )
+                position += 1
+        except FileNotFoundError:
+            return None
+        except Exception as e: #pylint: disable=broad-except
+            print("Error, unable to index " + filename + ": " + e.__class__.__name__  + " - " + str(e),file=stderr)
+            if not self.ignoreerrors:
+                self.db.commit()
+                raise
+            return False
+        finally:
+            if reader is not None:
+                reader.close()
+        fileid = self.db.execute("INSERT INTO files (filename, mtime, size) VALUES (?,?,?)", (filename, st.st_mtime, st.st_size)).lastrowid
+        self.db.executemany("INSERT INTO postings (term, file, word, sentence, position) VALUES (?,?,?,?,?)", ( (termid, fileid, wordid, sentenceid, position) for termid, wordid, sentenceid, position in postings ) )
+        self.db.commit() #commit per file, so an interrupted update keeps the work done so far
+        return True
+
+    def _term(self, termtype, termset, value):
+        """Internal method, returns the id of a term, adding it if it is new"""
+        key = (termtype, termset, value)
+        try:
+            return self.terms[key]
+        except KeyError:
+            termid = self.terms[key] = self.db.execute('INSERT INTO terms (type, "set", value) VALUES (?,?,?)', key).lastrowid
+            return termid
+
+    def _remove(self, fileid):
+        """Internal method, removes a file and its postings from the index"""
+        self.db.execute("DELETE FROM postings WHERE file = ?", (fileid,))
+        self.db.execute("DELETE FROM files WHERE id = ?", (fileid,))
 
+    def find(self, value, annotationtype=AnnotationType.TEXT, set=None): #pylint: disable=redefined-builtin
+        """Find all words with the specified text, lemma or part-of-speech class.
 
+        Arguments:
+            value (str): The text or class to search for
+            annotationtype: ``AnnotationType.TEXT`` (default), ``AnnotationType.LEMMA`` or ``AnnotationType.POS``
+            set (str or None): Only consider annotations in this set. If None (default), annotations in any set are considered.
+
+        Yields:
+            ``(filename, word id, sentence id)`` tuples, grouped by file and in document order
+        """
+        if annotationtype not in self.INDEXED:
+            raise ValueError("Annotation type not indexed: " + annotationtype2str(annotationtype))
+        query = 'SELECT files.filename, postings.word, postings.sentence FROM terms JOIN postings ON postings.term = terms.id JOIN files ON files.id = postings.file WHERE terms.type = ? AND terms.value = ?'
+        args = [annotationtype, value]
+        if set is not None:
+            query += ' AND terms."set" = ?'
+            args.append(set)
+        query += ' ORDER BY files.filename, postings.position'
+        for row in self.db.execute(query, args):
+            yield row
+
+    def count(self, value, annotationtype=AnnotationType.TEXT, set=None): #pylint: disable=redefined-builtin
+        """Returns the number of words with the specified text, lemma or part-of-speech class, takes the same arguments as :meth:`find`"""
+        if annotationtype not in self.INDEXED:
+            raise ValueError("Annotation type not indexed: " + annotationtype2str(annotationtype))
+        query = 'SELECT COUNT(*) FROM terms JOIN postings ON postings.term = terms.id WHERE terms.type = ? AND terms.value = ?'
+        args = [annotationtype, value]
+        if set is not None:
+            query += ' AND terms."set" = ?'
+            args.append(set)
+        return self.db.execute(query, args).fetchone()[0]
+
+    def values(self, annotationtype=AnnotationType.TEXT, set=None): #pylint: disable=redefined-builtin
+        """Yields all distinct texts or classes in the index for the specified annotation type (and set, if not None), in sorted order"""
+        query = 'SELECT DISTINCT value FROM terms WHERE type = ? AND EXISTS (SELECT 1 FROM postings WHERE postings.term = terms.id)'
+        args = [annotationtype]
+        if set is not None:
+            query += ' AND "set" = ?'
+            args.append(set)
+        rows = self.db.execute(query + ' ORDER BY value', args)
+        for value, in rows:
+            yield value
+
+    def files(self):
+        """Yields all filenames in the index, in sorted order"""
+        for filename, in self.db.execute("SELECT filename FROM files ORDER BY filename"):
+            yield filename
+
+    def close(self):
+        """Close the index"""
+        self.db.close()
 
 
 
@@ -9138,8 +10653,6 @@ def findwords(doc, worditerator, *args, **kwargs):
     for key in kwargs.keys():
         raise Exception("Unknown keyword parameter: " + key)
 
-    matchcursor = 0
-
     #shortcut for when no Pattern is passed, make one on the fly
     if len(args) == 1 and not isinstance(args[0], Pattern):
         if not isinstance(args[0], list) and not isinstance(args[0], tuple):
@@ -9175,65 +10688,633 @@ def findwords(doc, worditerator, *args, **kwargs):
             if pattern.variablesize():
                 pattern.sequence = [ True if x == '*' else x for x in pattern.sequence ]
 
-    if variablewildcards: #pylint: disable=too-many-nested-blocks
-        #one or more items have a * wildcard, which may span multiple tokens. Resolve this to a wider range of simpler patterns
+    #The patterns are compiled into a single automaton that is run in one pass over the words. Each state is a partial match: the position in the patterns, the words matched so far, and the sizes of the variable wildcard (*) gaps.
+    #A * wildcard matches one or more words; like in earlier versions, the gaps must be of non-increasing size and may not exceed maxgapsize words in total.
+    gaps = set(variablewildcards) if variablewildcards and not unsetwildcards else set()
+    size = prevsize
 
-        #we're not commited to a particular size, expand to various ones
-        for size in range(len(variablewildcards), maxgapsize+1):
-            for distribution in sum_to_n(size, len(variablewildcards)): #gap distributions, (amount) of 'True' wildcards
-                patterns = []
-                for pattern in args:
-                    if pattern.variablesize():
-                        patterns += list(pattern.resolve(size,distribution))
-                    else:
-                        patterns.append( pattern )
-                for match in findwords(doc, worditerator,*patterns, **{'leftcontext':leftcontext,'rightcontext':rightcontext}):
-                    yield match
+    #determine what to match against for each pattern, patterns matching the same thing share the value
+    unavailable = object()
+    sources = []
+    for pattern in args:
+        if not pattern.matchannotation:
+            source = None
+        elif pattern.matchannotationset:
+            source = (pattern.matchannotation, pattern.matchannotationset)
+        else:
+            try:
+                source = (pattern.matchannotation, doc.defaultset(pattern.matchannotation.ANNOTATIONTYPE))
+            except (NoSuchAnnotation, KeyError):
+                source = unavailable
+        sources.append(source)
+
+    states = []
+    for word in worditerator():
+        #find the values to match against
+        values = {}
+        for source in sources:
+            if source is unavailable or source in values:
+                continue
+            if source is None:
+                values[source] = word.text()
+            else:
+                items = list(word.select(source[0], source[1], True, [Original, Suggestion, Alternative]))
+                values[source] = items[0].cls if len(items) == 1 else unavailable
+        patternvalues = []
+        for pattern, source in zip(args, sources):
+            if source is not unavailable and values[source] is not unavailable:
+                patternvalues.append( (pattern, values[source] if pattern.casesensitive else values[source].lower()) )
+
+        matches = {} #cursor => bool, computed at most once per word
+        def match(cursor):
+            if cursor not in matches:
+                #a word only matches if there is at least one pattern with a value to match against
+                matches[cursor] = bool(patternvalues) and all( value == pattern.sequence[cursor] or pattern.sequence[cursor] is True or (isinstance(pattern.sequence[cursor], tuple) and value in pattern.sequence[cursor]) for pattern, value in patternvalues )
+            return matches[cursor]
+
+        newstates = []
+        states.append( (0, (), (), 0) ) #a new state for every word
+        for cursor, buffer, gapsizes, gapsize in states:
+            if cursor in gaps:
+                if not patternvalues:
+                    continue
+                gapsize += 1
+                buffer += (word,)
+                total = sum(gapsizes) + gapsize
+                if total < maxgapsize and (not gapsizes or gapsize < gapsizes[-1]):
+                    newstates.append( (cursor, buffer, gapsizes, gapsize) ) #the gap may grow further
+                if total <= maxgapsize and (not gapsizes or gapsize <= gapsizes[-1]):
+                    gapsizes += (gapsize,) #the gap ends here
+                else:
+                    continue
+            elif match(cursor):
+                buffer += (word,)
+            else:
+                continue
+            if cursor + 1 == size:
+                yield buffer[0].leftcontext(leftcontext) + list(buffer) + buffer[-1].rightcontext(rightcontext)
+            else:
+                newstates.append( (cursor + 1, buffer, gapsizes, 0) )
+        states = newstates
 
-    else:
-        patterns = args
-        buffers = []
-
-        for word in worditerator():
-            buffers.append( [] ) #Add a new empty buffer for every word
-            match = [None] * len(buffers)
-            for pattern in patterns:
-                #find value to match against
-                if not pattern.matchannotation:
-                    value = word.text()
+class OffsetMap(object):
+    """Maps character offsets in a rendered text to the words in it, as returned by :meth:`AbstractElement.offsetmap` and :meth:`Document.offsetmap`. Offsets are zero-indexed and the end is non-inclusive.
+
+    Attributes:
+        text (str): The rendered text
+        words (list): The words, in order of occurrence in the text
+        begins (list): The begin offset of each word
+        ends (list): The end offset of each word
+    """
+
+    def __init__(self, text, words, begins, ends):
+        self.text = text
+        self.words = words
+        self.begins = begins
+        self.ends = ends
+        self.wordindex = None #python id of word to index, computed when needed
+
+    @staticmethod
+    def fromparts(parts, offsets):
+        """Builds the map from text fragments and word positions as collected by :meth:`AbstractElement.textparts`"""
+        fragmentoffsets = [0] #character offset of each fragment
+        length = 0
+        for part in parts:
+            length += len(part)
+            fragmentoffsets.append(length)
+        offsets.sort(key=lambda x: fragmentoffsets[x[1]] + x[2]) #words in corrections etc are collected after the element
+        return OffsetMap("".join(parts), [ x[0] for x in offsets ], [ fragmentoffsets[x[1]] + x[2] for x in offsets ], [ fragmentoffsets[x[3]] + x[4] for x in offsets ])
+
+    def __len__(self):
+        return len(self.words)
+
+    def __iter__(self):
+        """Iterates over all words as ``(word, begin, end)`` tuples"""
+        return zip(self.words, self.begins, self.ends)
+
+    def offsets(self, word):
+        """Returns the ``(begin, end)`` offsets of the specified word, raises ``KeyError`` if the word is not in the text"""
+        if self.wordindex is None:
+            self.wordindex = { id(w): i for i, w in enumerate(self.words) }
+        i = self.wordindex[id(word)]
+        return self.begins[i], self.ends[i]
+
+    def at(self, offset):
+        """Returns the word at the specified character offset, or ``None`` if there is no word at that offset (e.g. a space)"""
+        i = bisect.bisect_right(self.begins, offset) - 1
+        if i >= 0 and offset < self.ends[i]:
+            return self.words[i]
+        return None
+
+    def resolve(self, begin, end, strict=False):
+        """Returns the words that overlap with the specified offset range.
+
+        Arguments:
+            begin (int): The begin offset
+            end (int): The end offset (non-inclusive)
+            strict (bool): Require the range to begin and end exactly on word boundaries, raises :class:`InconsistentText` otherwise
+
+        Returns:
+            list of :class:`Word`
+        """
+        i = bisect.bisect_right(self.ends, begin)
+        j = bisect.bisect_left(self.begins, end)
+        if strict and (i >= j or self.begins[i] != begin or self.ends[j-1] != end):
+            raise InconsistentText("Supplied offset range (" + str(begin) + "," + str(end) + ") does not match the word boundaries in the text: \"" + self.text[begin:end] + "\"")
+        return self.words[i:j]
+
+    def addspans(self, Class, spans, set=None, strict=True, **kwargs):
+        """Adds span annotations over the words covered by the specified offset ranges, for instance the output of a named entity recogniser.
+
+        Arguments:
+            Class: The span annotation class to add, e.g. :class:`Entity`
+            spans: An iterable of ``(begin, end, cls)`` tuples, the class may be ``None``
+            set (str or None): The set of the span annotations
+            strict (bool): Require the ranges to begin and end exactly on word boundaries (raises :class:`InconsistentText` otherwise), if not set, ranges are extended to cover all words they overlap with. Ranges without any words are skipped.
+            **kwargs: Other keyword arguments are passed to the span annotations (see :meth:`AbstractElement.add`)
+
+        Returns:
+            list of the added span annotations
+        """
+        if set is not None:
+            kwargs['set'] = set
+        added = []
+        for begin, end, cls in spans:
+            words = self.resolve(begin, end, strict)
+            if words:
+                if cls is not None:
+                    kwargs['cls'] = cls
+                elif 'cls' in kwargs:
+                    del kwargs['cls']
+                added.append( words[0].add(Class, *words, **kwargs) )
+        return added
+
+
+class DocumentDiff(object):
+    """The differences between two versions of a document, as returned by :meth:`Document.diff`. Differences in the children of an element are reported for those children, so each difference is reported only once, on the element closest to it.
+
+    Attributes:
+        added (list): Elements that only occur in the new version (their contents are not reported separately)
+        removed (list): Elements that only occur in the old version (their contents are not reported separately)
+        changed (list): ``(old, new)`` tuples of elements that occur in both versions but differ in their attributes, text, references (for span annotations), or in the order of their children with an ID
+        skipped (int): The number of identical subtrees that were skipped
+    """
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.changed = []
+        self.skipped = 0
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    def compare(self, old, new):
+        """Compares two versions of an element, recursively"""
+        if old.structhash() == new.structhash():
+            self.skipped += 1
+            return
+        if type(old) is not type(new) or old.structattributes() != new.structattributes(): #pylint: disable=unidiomatic-typecheck
+            self.changed.append( (old, new) )
+        elif self.comparechildren(old.data, new.data):
+            self.changed.append( (old, new) ) #same children, different order
+            return
+        else:
+            return
+        self.comparechildren(old.data, new.data)
+
+    def comparechildren(self, olddata, newdata):
+        """Compares the children of two versions of an element (or the bodies of two documents), returns True if the order of the children with an ID that occur in both versions differs"""
+        oldchildren = DocumentDiff.keyed(olddata)
+        newchildren = DocumentDiff.keyed(newdata)
+        for key, e in oldchildren.items():
+            if key not in newchildren:
+                self.removed.append(e)
+        for key, e in newchildren.items():
+            if key in oldchildren:
+                self.compare(oldchildren[key], e)
+            else:
+                self.added.append(e)
+        #only the order of elements with an ID (such as structure elements) is significant
+        return [ key for key in oldchildren if key in newchildren and isinstance(key, str) ] != [ key for key in newchildren if key in oldchildren and isinstance(key, str) ]
+
+    @staticmethod
+    def keyed(data):
+        """Returns an ordered dictionary of the contained elements in data, keyed by ID, or by type, set and occurrence for elements without an ID"""
+        keyed = OrderedDict()
+        counter = Counter()
+        for e in data:
+            if isinstance(e, AbstractElement) and (e.parent is None or e.parent.data is data):
+                if e.id:
+                    keyed[e.id] = e
                 else:
-                    if pattern.matchannotationset:
-                        items = list(word.select(pattern.matchannotation, pattern.matchannotationset, True, [Original, Suggestion, Alternative]))
-                    else:
-                        try:
-                            set = doc.defaultset(pattern.matchannotation.ANNOTATIONTYPE)
-                            items = list(word.select(pattern.matchannotation, set, True, [Original, Suggestion, Alternative] ))
-                        except (NoSuchAnnotation, KeyError):
-                            continue
-                    if len(items) == 1:
-                        value = items[0].cls
-                    else:
-                        continue
+                    key = (e.__class__.__name__, e.set)
+                    keyed[key + (counter[key],)] = e
+                    counter[key] += 1
+        return keyed
 
-                if not pattern.casesensitive:
-                    value = value.lower()
+    @staticmethod
+    def describe(e):
+        """Returns a string describing the element by type and ID, elements without an ID are described by their type and set and the ID of the nearest ancestor that has one"""
+        tag = e.XMLTAG if e.XMLTAG else e.__class__.__name__ #predetermined features have no tag of their own
+        if e.id:
+            return tag + " " + e.id
+        s = tag
+        if e.set:
+            s += " (set " + e.set + ")"
+        ancestor = e.parent
+        while isinstance(ancestor, AbstractElement) and not ancestor.id:
+            ancestor = ancestor.parent
+        if isinstance(ancestor, AbstractElement):
+            s += " in " + ancestor.XMLTAG + " " + ancestor.id
+        return s
 
+    def __str__(self):
+        lines = []
+        for e in self.removed:
+            lines.append("- " + DocumentDiff.describe(e))
+        for e in self.added:
+            lines.append("+ " + DocumentDiff.describe(e))
+        for _, e in self.changed:
+            lines.append("~ " + DocumentDiff.describe(e))
+        return "\n".join(lines)
+
+
+class DocumentMerge(object):
+    """The outcome of merging other versions of a document into it, as returned by :meth:`Document.merge`.
+
+    Attributes:
+        doc (:class:`Document`): The document the other versions were merged into
+        added (list): The elements that were copied into the document (their contents are not reported separately)
+        conflicts (list): ``(element, other)`` tuples of elements in the document and the corresponding elements in another version that differ from them, the element in the document was kept
+        skipped (int): The number of identical subtrees that were skipped
+    """
 
-                for i, buffer in enumerate(buffers):
-                    if match[i] is False:
-                        continue
-                    matchcursor = len(buffer)
-                    match[i] = (value == pattern.sequence[matchcursor] or pattern.sequence[matchcursor] is True or (isinstance(pattern.sequence[matchcursor], tuple) and value in pattern.sequence[matchcursor]))
+    def __init__(self, doc):
+        self.doc = doc
+        self.added = []
+        self.conflicts = []
+        self.skipped = 0
+        self.processors = {} #processor ID => processor in the document
+
+    def mergedeclarations(self, other):
+        """Adds the declarations and provenance data of another document that the document lacks"""
+        doc = self.doc
+        for processor in other.provenance:
+            self.mergeprocessor(processor, doc.provenance)
+        for annotationtype, set in other.annotations:
+            if (annotationtype, set) not in doc.annotations:
+                doc.annotations.append( (annotationtype, set) )
+                if set in other.setdefinitions and set not in doc.setdefinitions:
+                    doc.setdefinitions[set] = other.setdefinitions[set]
+            for attr in ('annotationdefaults', 'groupannotations', 'setdefinitionformat'):
+                source = getattr(other, attr)
+                target = getattr(doc, attr)
+                if annotationtype not in target:
+                    target[annotationtype] = {}
+                if annotationtype in source and set in source[annotationtype] and set not in target[annotationtype]:
+                    target[annotationtype][set] = copy(source[annotationtype][set])
+            if annotationtype in other.set_alias and set in other.set_alias[annotationtype]:
+                alias = other.set_alias[annotationtype][set]
+                if annotationtype not in doc.set_alias:
+                    doc.set_alias[annotationtype] = {}
+                    doc.alias_set[annotationtype] = {}
+                if set not in doc.set_alias[annotationtype] and alias not in doc.alias_set[annotationtype]:
+                    doc.set_alias[annotationtype][set] = alias
+                    doc.alias_set[annotationtype][alias] = set
+            if annotationtype not in doc.annotators:
+                doc.annotators[annotationtype] = OrderedDict()
+            if set not in doc.annotators[annotationtype]:
+                doc.annotators[annotationtype][set] = []
+            annotators = doc.annotators[annotationtype][set]
+            if annotationtype in other.annotators and set in other.annotators[annotationtype]:
+                for annotator in other.annotators[annotationtype][set]:
+                    if all( a.processor_id != annotator.processor_id for a in annotators ):
+                        annotators.append(Annotator(annotator.processor_id, doc))
+
+    def mergeprocessor(self, processor, context):
+        """Adds a processor of another document, and its subprocessors, to the provenance chain of the document if it is not in it yet. The context is the parent processor (or the provenance chain) in the document."""
+        try:
+            existing = self.doc.provenance[processor.id]
+        except KeyError:
+            existing = copy(processor)
+            existing.processors = []
+            existing.metadata = NativeMetaData(**dict(processor.metadata.items()))
+            existing.parent = None
+            context.append(existing)
+        for subprocessor in processor:
+            self.mergeprocessor(subprocessor, existing)
+
+    def getprocessor(self, processor):
+        """Returns the processor in the document with the same ID as the processor of another document"""
+        try:
+            return self.processors[processor.id]
+        except KeyError:
+            self.processors[processor.id] = self.doc.provenance[processor.id]
+            return self.processors[processor.id]
+
+    def mergeelement(self, element, other):
+        """Merges an element of another document into the element with the same ID in the document, recursively"""
+        if element.structhash() == other.structhash():
+            self.skipped += 1
+        elif type(element) is not type(other): #pylint: disable=unidiomatic-typecheck
+            self.conflicts.append( (element, other) )
+        else:
+            if element.structattributes() != other.structattributes():
+                self.conflicts.append( (element, other) )
+            self.mergechildren(element, other)
+
+    def mergechildren(self, target, other):
+        """Merges the children of an element of another document (or the body of another document) into the corresponding element (or the body) of the document"""
+        doc = self.doc
+        children = None #children of the target without an ID, by key, only gathered when needed
+        for e in other.data:
+            if not isinstance(e, AbstractElement) or (e.parent is not None and e.parent.data is not other.data):
+                continue
+            if e.id:
+                if e.id in doc.index:
+                    self.mergeelement(doc.index[e.id], e)
+                else:
+                    self.add(target, e)
+                continue
+            if children is None:
+                children = {}
+                for c in target.data:
+                    if isinstance(c, AbstractElement) and not c.id and (c.parent is None or c.parent.data is target.data):
+                        key = DocumentMerge.key(c)
+                        if key in children:
+                            children[key].append(c)
+                        else:
+                            children[key] = [c]
+            counterparts = children.get(DocumentMerge.key(e), ())
+            structhash = e.structhash()
+            if any( c.structhash() == structhash for c in counterparts ):
+                self.skipped += 1
+            elif counterparts and isinstance(e, AbstractAnnotationLayer):
+                self.mergechildren(counterparts[0], e)
+            elif counterparts and isinstance(e, (AbstractInlineAnnotation, AbstractContentAnnotation)):
+                #only one such annotation is allowed
+                self.conflicts.append( (counterparts[0], e) )
+            else:
+                self.add(target, e)
+
+    def add(self, target, other):
+        """Copies an element of another document into the target element in the document"""
+        doc = self.doc
+        stack = [other]
+        while stack:
+            e = stack.pop()
+            if e.id and e.id in doc.index:
+                self.conflicts.append( (doc.index[e.id], e) )
+                return
+            stack += [ child for child in e.data if isinstance(child, AbstractElement) and child.parent is e ]
+        if not isinstance(target, Document):
+            other.__class__.addable(target, other.set) #raises an exception if not addable
+        e = other.clone(doc, "", None, {})
+        stack = [e]
+        while stack:
+            c = stack.pop()
+            if c.processor:
+                c.processor = self.getprocessor(c.processor)
+            stack += [ child for child in c.data if isinstance(child, AbstractElement) and child.parent is c ]
+        target.append(e)
+        self.added.append(e)
 
+    @staticmethod
+    def key(e):
+        """Returns the key by which elements without an ID are matched: their type and set, and the class for text and phonetic content"""
+        if isinstance(e, AbstractContentAnnotation):
+            return (e.__class__, e.set, e.cls)
+        return (e.__class__, e.set)
+
+    @staticmethod
+    def describe(e):
+        """Returns a string describing the element (see :meth:`DocumentDiff.describe`)"""
+        return DocumentDiff.describe(e)
 
-            for buffer, matches in list(zip(buffers, match)):
-                if matches:
-                    buffer.append(word) #add the word
-                    if len(buffer) == len(pattern.sequence):
-                        yield buffer[0].leftcontext(leftcontext) + buffer + buffer[-1].rightcontext(rightcontext)
-                        buffers.remove(buffer)
+    def __str__(self):
+        lines = []
+        for e in self.added:
+            lines.append("+ " + DocumentDiff.describe(e))
+        for e, _ in self.conflicts:
+            lines.append("! " + DocumentDiff.describe(e))
+        return "\n".join(lines)
+
+class TokenColumns(object):
+    """A columnar view on the tokens (words) of a document: parallel arrays with one entry per word, suitable for fast pattern matching and frequency counts over many tokens.
+
+    The texts and the classes of part-of-speech and lemma annotations are interned in a single lexicon, the columns hold their ids (``-1`` if a word has no text, or no single annotation of that set, which is the same condition under which :meth:`Document.findwords` can not match on it). The columns are ``array.array`` instances, which can be turned into NumPy arrays without copying (see :meth:`numpy`), NumPy is not required otherwise.
+
+    Attributes:
+        words (list): The words, in order
+        lexicon (list): The interned strings, the ids in the columns are indices in this list
+        text (array): Column with the ids of the texts of the words
+        pos (dict): Maps sets to columns with the ids of the part-of-speech classes in that set
+        lemma (dict): Maps sets to columns with the ids of the lemma classes in that set
+        sentence (array): Column with the index of the sentence (in ``sentences``) each word is part of, or -1
+        paragraph (array): Column with the index of the paragraph (in ``paragraphs``) each word is part of, or -1
+        sentences (list): The sentences, in order
+        paragraphs (list): The paragraphs, in order
+
+    The view is built in a single pass and is not updated when the document changes, use :meth:`Document.tokencolumns` to obtain a view that is rebuilt when needed. A view can also be built directly from any sequence of words, such as the words in a batch of sentences obtained from a :class:`Reader`::
+
+        columns = folia.TokenColumns( word for sentence in batch for word in sentence.words() )
+    """
+
+    def __init__(self, words, doc=None):
+        self.words = list(words)
+        if doc is None and self.words:
+            doc = self.words[0].doc
+        self.doc = doc
+        self.revision = doc.revision if doc else 0
+        self.lexicon = []
+        self.ids = {} #string => id
+        self.sentences = []
+        self.paragraphs = []
+        self.pos = {}
+        self.lemma = {}
+        n = len(self.words)
+        self.text = array.array('l', [-1]) * n
+        self.sentence = array.array('l', [-1]) * n
+        self.paragraph = array.array('l', [-1]) * n
+
+        sentences = {} #python id of the sentence => index
+        paragraphs = {}
+        ancestors = {} #python id of the parent => (sentence index, paragraph index), words usually share their parent
+        for i, word in enumerate(self.words):
+            try:
+                self.text[i] = self.intern(word.text())
+            except NoSuchText:
+                pass
+
+            parent = word.parent
+            if id(parent) not in ancestors:
+                sentence = paragraph = None
+                for ancestor in word.ancestors((Sentence, Paragraph)):
+                    if sentence is None and paragraph is None and isinstance(ancestor, Sentence):
+                        sentence = ancestor
+                    elif paragraph is None and isinstance(ancestor, Paragraph):
+                        paragraph = ancestor
+                        break
+                if sentence is not None and id(sentence) not in sentences:
+                    sentences[id(sentence)] = len(self.sentences)
+                    self.sentences.append(sentence)
+                if paragraph is not None and id(paragraph) not in paragraphs:
+                    paragraphs[id(paragraph)] = len(self.paragraphs)
+                    self.paragraphs.append(paragraph)
+                ancestors[id(parent)] = (sentences[id(sentence)] if sentence is not None else -1, paragraphs[id(paragraph)] if paragraph is not None else -1)
+            self.sentence[i], self.paragraph[i] = ancestors[id(parent)]
+
+            found = {} #(class, set) => annotation class, or None if ambiguous
+            for annotation in word.select((PosAnnotation, LemmaAnnotation), False, True, [Original, Suggestion, Alternative]):
+                key = (annotation.__class__, annotation.set)
+                found[key] = None if key in found else annotation.cls
+            for (Class, set), cls in found.items():
+                if cls is not None:
+                    columns = self.pos if Class is PosAnnotation else self.lemma
+                    if set not in columns:
+                        columns[set] = array.array('l', [-1]) * n
+                    columns[set][i] = self.intern(cls)
+
+    def __len__(self):
+        return len(self.words)
+
+    def intern(self, s):
+        """Returns the id of a string in the lexicon, adding it if it is new"""
+        try:
+            return self.ids[s]
+        except KeyError:
+            self.ids[s] = len(self.lexicon)
+            self.lexicon.append(s)
+            return self.ids[s]
+
+    def isvalid(self):
+        """Is this view still up to date with the document?"""
+        return self.doc is None or self.doc.revision == self.revision
+
+    def column(self, Class=None, set=None): #pylint: disable=redefined-builtin
+        """Returns a column.
+
+        Arguments:
+            Class: ``None`` for the text (default), or :class:`PosAnnotation` or :class:`LemmaAnnotation`
+            set (str or None): The set of the annotation, if None, the default set of the document is used
+
+        Raises:
+            :class:`NoSuchAnnotation` if no word has annotations of this set
+        """
+        if Class is None:
+            return self.text
+        elif Class is PosAnnotation:
+            columns = self.pos
+        elif Class is LemmaAnnotation:
+            columns = self.lemma
+        else:
+            raise ValueError("No column for " + Class.__name__)
+        if set is None and self.doc:
+            try:
+                set = self.doc.defaultset(Class.ANNOTATIONTYPE)
+            except KeyError:
+                raise NoSuchAnnotation
+        try:
+            return columns[set]
+        except KeyError:
+            raise NoSuchAnnotation
+
+    def numpy(self, Class=None, set=None): #pylint: disable=redefined-builtin
+        """Returns a column (see :meth:`column`) as a NumPy array, sharing the memory of the column. Requires NumPy."""
+        import numpy #pylint: disable=import-outside-toplevel
+        column = self.column(Class, set)
+        return numpy.frombuffer(column, dtype='i' + str(column.itemsize))
+
+    def counts(self, Class=None, set=None): #pylint: disable=redefined-builtin
+        """Returns the frequency of each text or class in a column (see :meth:`column`) as a ``collections.Counter``"""
+        counts = Counter(self.column(Class, set))
+        counts.pop(-1, None)
+        return Counter({ self.lexicon[i]: count for i, count in counts.items() })
+
+    def findwords(self, *patterns, **kwargs):
+        """Find words matching the specified patterns, like :meth:`Document.findwords`, but evaluated on the columns.
+
+        Each element of a pattern is evaluated only once for each distinct string in the lexicon, the words are then matched by id. If NumPy is available, the matching is done with array operations.
+
+        Supports the same patterns and keyword arguments (``leftcontext``, ``rightcontext``), except for variable wildcards (``*``).
+
+        Yields:
+            lists of words
+        """
+        leftcontext = int(kwargs.pop('leftcontext', 0))
+        rightcontext = int(kwargs.pop('rightcontext', 0))
+        for key in kwargs:
+            raise Exception("Unknown keyword parameter: " + key)
+        if not patterns:
+            return
+        size = len(patterns[0])
+        constraints = [] #(column, [allowed ids per position])
+        for pattern in patterns:
+            if not isinstance(pattern, Pattern):
+                raise TypeError("You must pass instances of Pattern to findwords")
+            if len(pattern) != size:
+                raise Exception("If multiple patterns are provided, they must all have the same length!")
+            if pattern.variablesize():
+                raise ValueError("Variable wildcards (*) are not supported on token columns")
+            try:
+                column = self.column(pattern.matchannotation, pattern.matchannotationset)
+            except NoSuchAnnotation:
+                continue #never matches, like in Document.findwords
+            values = [ (i, s if pattern.casesensitive else s.lower()) for i, s in enumerate(self.lexicon) ]
+            allowed = []
+            for element in pattern.sequence:
+                if element is True:
+                    allowed.append(True)
+                else:
+                    allowed.append( [ i for i, value in values if value == element or (isinstance(element, tuple) and value in element) ] )
+            constraints.append( (column, allowed) )
+
+        n = len(self.words) - size + 1
+        if not constraints or n <= 0:
+            return
+        try:
+            import numpy #pylint: disable=import-outside-toplevel
+        except ImportError:
+            numpy = None
+
+        if numpy is not None:
+            matches = numpy.ones(n, dtype=bool)
+            for cursor in range(size):
+                #a word only matches if at least one pattern has a value for it, and all patterns that have one match
+                available = numpy.zeros(n, dtype=bool)
+                for column, allowed in constraints:
+                    values = numpy.frombuffer(column, dtype='i' + str(column.itemsize))[cursor:cursor+n]
+                    available |= values >= 0
+                    if allowed[cursor] is not True:
+                        matches &= (values < 0) | numpy.isin(values, allowed[cursor])
+                matches &= available
+            starts = numpy.flatnonzero(matches).tolist()
+        else:
+            constraints = [ (column, [ allowed if allowed is True else frozenset(allowed) for allowed in allowedpositions ]) for column, allowedpositions in constraints ]
+            starts = []
+            for start in range(n):
+                for cursor in range(size):
+                    available = False
+                    for column, allowed in constraints:
+                        value = column[start+cursor]
+                        if value >= 0:
+                            available = True
+                            if allowed[cursor] is not True and value not in allowed[cursor]:
+                                break
+                    else:
+                        if available:
+                            continue
+                    break
                 else:
-                    buffers.remove(buffer) #remove buffer
+                    starts.append(start)
+
+        for start in starts:
+            match = self.words[start:start+size]
+            yield match[0].leftcontext(leftcontext) + match + match[-1].rightcontext(rightcontext)
 
 class Reader(object):
     """Streaming FoLiA reader.
@@ -9248,6 +11329,10 @@ class Reader(object):
 
             * ``filename``: The filename of the document to read
             * ``target``: The FoLiA element(s) you want to read (with everything contained in its scope). Passed as a class. For example: ``folia.Sentence``, or a tuple of multiple element classes. Can also be set to ``None`` to return all elements, but that would load the full tree structure into memory.
+            * ``batchsize``: The number of elements that are parsed in one go when iterating asynchronously (``async for``), defaults to 100
+            * ``context``: A FoLiA element class (such as ``folia.Sentence``). If set, iteration yields ``(element, id)`` tuples, where ``id`` is the ID of the nearest enclosing element of this class (or None if there is none)
+            * ``ignore``: A tuple of FoLiA element classes, elements inside these are skipped (for example ``folia.default_ignore``, to skip the originals in corrections like :meth:`AbstractElement.select` does)
+            * ``keepindex``: Keep the elements that were read in the index of the document (``reader.doc``), defaults to True. Set to False to keep memory usage constant on large documents, elements can then no longer be looked up by ID after the next one has been read.
 
         """
 
@@ -9256,7 +11341,16 @@ class Reader(object):
             raise ValueError("Target must be subclass of FoLiA element")
         if 'bypassleak' in kwargs:
             self.bypassleak = False
-        self.stream = io.open(filename,'rb')
+        self.batchsize = kwargs.get('batchsize', 100)
+        self.context = kwargs.get('context', None)
+        self.ignore = kwargs.get('ignore', ())
+        self.keepindex = kwargs.get('keepindex', True)
+        if filename[-4:].lower() == '.bz2':
+            self.stream = bz2.BZ2File(filename)
+        elif filename[-3:].lower() == '.gz':
+            self.stream = gzip.GzipFile(filename)
+        else:
+            self.stream = io.open(filename,'rb')
         self.initdoc()
         if self.doc.FOLIA1:
             self.doc.declare(AnnotationType.PHON)
@@ -9313,22 +11407,78 @@ class Reader(object):
         else:
             multitargets = True
 
+        ignoretags = [ "{" + NSFOLIA + "}" + C.XMLTAG for C in self.ignore if C.XMLTAG ]
+        contexttag = "{" + NSFOLIA + "}" + self.context.XMLTAG if self.context else None
+
         for action, node in ElementTree.iterparse(self.stream, events=("end",), tag=target):
             if not multitargets or (multitargets and node.tag.startswith('{' + NSFOLIA + '}')):
                 if not multitargets: Class = XML2CLASS[node.tag[nslen:]]
                 if not multitargets or (multitargets and Class in self.targets):
-                    element = Class.parsexml(node, self.doc)
+                    if ignoretags and any( True for _ in node.iterancestors(*ignoretags) ):
+                        element = None
+                    else:
+                        element = Class.parsexml(node, self.doc)
+                        if contexttag:
+                            contextnode = next(node.iterancestors(contexttag), None)
+                            contextid = contextnode.get('{http://www.w3.org/XML/1998/namespace}id') if contextnode is not None else None
                     node.clear() #clean up children
                     # Also eliminate now-empty references from the root node to
                     # elem (http://www.ibm.com/developerworks/xml/library/x-hiperfparse/)
-                    #for ancestor in node.xpath('ancestor-or-self::*'):
-                    while node.getprevious() is not None:
-                        del node.getparent()[0]  # clean up preceding siblings
+                    for e in itertools.chain((node,), node.iterancestors()):
+                        while e.getprevious() is not None and e.getparent() is not None: #(not the root, it may have siblings such as processing instructions)
+                            del e.getparent()[0]  # clean up preceding siblings (of the element and its ancestors, these have all been read)
+                    if element is None:
+                        continue
+                    if contexttag:
+                        yield element, contextid
+                    else:
+                        yield element
+                    if not self.keepindex:
+                        for e in itertools.chain((element,), element.select(AbstractElement, False, True, False)):
+                            if e.id:
+                                self.doc.index.pop(e.id, None)
+
+    def __aiter__(self):
+        return self.aelements()
+
+    async def aelements(self):
+        """Asynchronous generator yielding instances of the object you specified, without blocking the asyncio event loop. Also invoked by ``async for element in reader``. See :meth:`abatches`."""
+        batches = self.abatches(self.batchsize)
+        try:
+            async for batch in batches:
+                for element in batch:
                     yield element
+        finally:
+            await batches.aclose()
 
-    def __del__(self):
+    async def abatches(self, batchsize=100):
+        """Asynchronous generator yielding lists of (at most ``batchsize``) instances of the object you specified.
+
+        The document is parsed in a worker thread, which parses the next batch while the current one is being processed. The file is closed when the generator is done, closed or cancelled.
+        """
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        elements = iter(self)
+        future = executor.submit(list, itertools.islice(elements, batchsize))
+        try:
+            while True:
+                batch = await asyncio.wrap_future(future)
+                if not batch:
+                    break
+                future = executor.submit(list, itertools.islice(elements, batchsize)) #parse the next batch while this one is processed
+                yield batch
+        finally:
+            await _awaitfutures([future])
+            executor.shutdown(wait=False)
+            elements.close()
+            self.close()
+
+    def close(self):
+        """Close the underlying file"""
         self.stream.close()
 
+    def __del__(self):
+        self.close()
+
 def isncname(name):
     #not entirely according to specs http://www.w3.org/TR/REC-xml/#NT-Name , but simplified:
     for i, c in enumerate(name):
@@ -2,11 +2,13 @@
 
 from __future__ import print_function, unicode_literals, division, absolute_import
 
-from pynlpl.formats import folia, fql, cql
+import folia.main as folia
+from folia import fql
 import time
 import sys
 import os
 import glob
+import json as jsonlib #json is also the name of a benchmark function
 try:
     from pympler import asizeof
 except ImportError:
@@ -50,6 +52,16 @@ def loadfile(**kwargs):
     doc = folia.Document(file=kwargs['filename'],bypassleak=False)
 
 
+@timeit
+def loadstring(**kwargs):
+    """Loading document from XML string"""
+    doc = folia.Document(string=kwargs['xml'])
+
+@timeit
+def loadjson(**kwargs):
+    """Loading document from JSON serialisation"""
+    doc = folia.Document(json=kwargs['json'])
+
 @timeit
 def savefile(**kwargs): #careful with SSDs
     """Saving file"""
@@ -71,6 +83,26 @@ def text(**kwargs):
     """text serialisation"""
     kwargs['doc'].text()
 
+@timeit
+def sentencetext(**kwargs):
+    """Obtaining the text of each sentence"""
+    for sentence in kwargs['doc'].sentences():
+        sentence.text()
+
+@timeit
+def sentencetextcached(**kwargs):
+    """Obtaining the text of each sentence (with text cache)"""
+    for sentence in kwargs['doc'].sentences():
+        sentence.text()
+
+@timeit
+def offsetmap(**kwargs):
+    """Mapping character offsets to words for each sentence, and resolving each word's offsets"""
+    for sentence in kwargs['doc'].sentences():
+        offsetmap = sentence.offsetmap()
+        for word, begin, end in offsetmap:
+            offsetmap.resolve(begin, end)
+
 @timeit
 def countwords(**kwargs):
     """Counting words"""
@@ -133,6 +165,39 @@ def addelement(**kwargs):
         except folia.DuplicateAnnotationError:
             pass
 
+@timeit
+def generateids(**kwargs):
+    """Generating IDs for 100 new words in each sentence, one by one and as a reserved range"""
+    for sentence in kwargs['doc'].sentences():
+        for i in range(0,50):
+            sentence.generate_id(folia.Word)
+        sentence.generate_ids(folia.Word, 50)
+
+
+@timeit
+def erase(**kwargs):
+    """Erasing all part-of-speech annotations"""
+    kwargs['doc'].erase(folia.PosAnnotation)
+
+@timeit
+def findspans(**kwargs):
+    """Finding the span annotations each word is part of"""
+    for word in kwargs['doc'].words():
+        for layerclass in (folia.EntitiesLayer, folia.ChunkingLayer, folia.SyntaxLayer, folia.DependenciesLayer):
+            for span in word.findspans(layerclass):
+                pass
+
+@timeit
+def sortspans(**kwargs):
+    """Sorting the span annotations in all annotation layers"""
+    for layer in kwargs['doc'].select(folia.AbstractAnnotationLayer):
+        layer.sort()
+
+@timeit
+def copyparagraphs(**kwargs):
+    """Copying all paragraphs (with a new ID suffix)"""
+    for paragraph in kwargs['doc'].paragraphs():
+        paragraph.copy(kwargs['doc'], ".copy")
 
 @timeit
 def ancestors(**kwargs):
@@ -148,6 +213,42 @@ def readerwords(**kwargs):
     for word in reader:
         pass
 
+@timeit
+def selectwordsfqlstream(**kwargs):
+    """Selecting words in sentences using FQL on a streamed document (Query.stream)"""
+    query = fql.Query("SELECT w FOR s")
+    for word in query.stream(kwargs['filename']):
+        pass
+
+@timeit
+def diff(**kwargs):
+    """Comparing two versions of a document, with every 1000th word changed (Document.diff)"""
+    kwargs['doc'].diff(kwargs['doc2'])
+
+@timeit
+def merge(**kwargs):
+    """Merging another version of a document, with a description added to every 1000th word (Document.merge)"""
+    kwargs['doc'].merge(kwargs['doc2'])
+
+@timeit
+def loadcorpus(**kwargs):
+    """Loading all documents in a corpus sequentially (Corpus)"""
+    for doc in folia.Corpus(kwargs['dirname'], extension=kwargs['extension']):
+        pass
+
+@timeit
+def loadcorpusthreaded(**kwargs):
+    """Loading all documents in a corpus with prefetching threads (CorpusLoader)"""
+    for doc in folia.CorpusLoader(kwargs['dirname'], extension=kwargs['extension']):
+        pass
+
+@timeit
+def selectwordsfqlcorpus(**kwargs):
+    """Selecting words in a corpus using FQL in parallel (Query.corpus)"""
+    query = fql.Query("SELECT w FORMAT xml")
+    for filename, output in query.corpus(folia.Corpus(kwargs['dirname'], extension=kwargs['extension'])):
+        pass
+
 def main():
     global repetitions, target
     files = []
@@ -189,18 +290,57 @@ def main():
                         files.append(filename)
 
 
-    for f in ('loadfile','loadfileleakbypass','readerwords'):
+    for f in ('loadfile','loadfileleakbypass','readerwords','selectwordsfqlstream'):
         if f in selectedtests or 'all' in selectedtests:
             for filename in files:
                 globals()[f](filename=filename)
 
 
-    for f in ('xml','text','json','countwords','selectwords','nextwords','ancestors','selectwordsfql','selectwordsfqlforp','selectwordsfqlxml','selectwordsfqlwhere','editwordsfql', 'addelement' ):
+    for f in ('loadcorpus','loadcorpusthreaded','selectwordsfqlcorpus'):
+        if f in selectedtests or 'all' in selectedtests:
+            for dirname in filesordirs:
+                if os.path.isdir(dirname):
+                    for extension in ('folia.xml','folia.xml.gz','folia.xml.bz2'):
+                        globals()[f](dirname=dirname, extension=extension)
+
+    for f in ('xml','text','json','sentencetext','offsetmap','countwords','selectwords','nextwords','ancestors','copyparagraphs','findspans','sortspans','selectwordsfql','selectwordsfqlforp','selectwordsfqlxml','selectwordsfqlwhere','editwordsfql', 'addelement', 'generateids', 'erase' ):
+        if f in selectedtests or 'all' in selectedtests:
+            for filename in files:
+                doc = folia.Document(file=filename)
+                globals()[f](doc=doc)
+
+    for f in ('loadstring','loadjson'):
         if f in selectedtests or 'all' in selectedtests:
             for filename in files:
                 doc = folia.Document(file=filename)
+                globals()[f](doc=doc, xml=doc.xmlstring(), json=jsonlib.dumps(doc.json()))
+
+    for f in ('sentencetextcached',):
+        if f in selectedtests or 'all' in selectedtests:
+            for filename in files:
+                doc = folia.Document(file=filename, textcache=True)
                 globals()[f](doc=doc)
 
+    for f in ('diff',):
+        if f in selectedtests or 'all' in selectedtests:
+            for filename in files:
+                doc = folia.Document(file=filename)
+                doc2 = folia.Document(file=filename)
+                for i, word in enumerate(doc2.words()):
+                    if i % 1000 == 0:
+                        word.settext("changed")
+                globals()[f](doc=doc, doc2=doc2)
+
+    for f in ('merge',):
+        if f in selectedtests or 'all' in selectedtests:
+            for filename in files:
+                doc = folia.Document(file=filename)
+                doc2 = folia.Document(file=filename)
+                for i, word in enumerate(doc2.words()):
+                    if i % 1000 == 0:
+                        word.append(folia.Description, value="test")
+                globals()[f](doc=doc, doc2=doc2)
+
     for f in ('memtest',):
         if f in selectedtests or 'all' in selectedtests:
             for filename in files:
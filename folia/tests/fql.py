@@ -16,7 +16,7 @@ from __future__ import unicode_literals
 from __future__ import division
 from __future__ import absolute_import
 from folia.helpers import u, isstring
-from folia.tests.helpers import xmlcheck, xmlnorm
+from folia.tests.helpers import xmlcheck, xmlnorm, TMPDIR
 import sys
 if sys.version < '3':
     from codecs import getwriter
@@ -288,6 +288,50 @@ class Test2ParseQuery(unittest.TestCase):
         self.assertIsInstance(q.action.form, fql.Correction)
         self.assertEqual( len(q.action.form.suggestions),1)
 
+    def test13_cache(self):
+        """Parsing - Reusing cached queries"""
+        q1 = fql.Query(Q1)
+        q2 = fql.Query(Q1)
+        self.assertIs( q1.plan, q2.plan ) #parsed only once
+        self.assertTrue( Q1 in fql.QUERYCACHE )
+        q3 = fql.Query(Q1, cache=False)
+        self.assertIsNot( q1.plan, q3.plan )
+        cache = fql.QueryCache(2)
+        for q in (Q1, Q2, Q1, Qhas):
+            cache.get(q)
+        self.assertEqual( list(cache.plans), [Q1, Qhas] ) #least recently used is discarded
+
+    def test14_explain(self):
+        """Parsing - EXPLAIN"""
+        q = fql.Query("EXPLAIN " + Q1)
+        self.assertTrue( q.plan.explain )
+        self.assertTrue( q.plan.readonly )
+        self.assertFalse( fql.Query(Q2).plan.readonly )
+
+    def test15_streamscope(self):
+        """Parsing - Determining whether a query can be streamed"""
+        self.assertEqual( fql.Query("SELECT w WHERE text = \"de\" FOR s").streamscope(), folia.Sentence )
+        self.assertEqual( fql.Query("SELECT pos FOR w FOR p WHERE text CONTAINS \"de\"").streamscope(), folia.Paragraph )
+        self.assertEqual( fql.Query("SELECT s").streamscope(), folia.Sentence )
+        self.assertEqual( fql.Query("SELECT w").streamscope(), None ) #words need not be in sentences
+        self.assertEqual( fql.Query("SELECT w FOR s ID \"s.1\"").streamscope(), None )
+        self.assertEqual( fql.Query("SELECT w WHERE (NEXT w WHERE text = \"de\") FOR s").streamscope(), None )
+        self.assertEqual( fql.Query("SELECT entity FOR w FOR s").streamscope(), None )
+        self.assertEqual( fql.Query(Q2).streamscope(), None )
+
+    def test16_serializechunks(self):
+        """Serialising results in chunks"""
+        q = fql.Query("SELECT w FORMAT json")
+        self.assertEqual( "".join(q.serializechunks(["1","2"])), "[ 1, 2]" )
+        self.assertEqual( "".join(q.serializechunks([])), "[]" )
+        self.assertEqual( "".join(q.serializechunks(["1","2"], False)), "1, 2" )
+        q = fql.Query("SELECT w FORMAT xml")
+        self.assertEqual( "".join(q.serializechunks(iter(["<result/>\n"]))), "<results>\n<result/>\n</results>\n" )
+        self.assertEqual( "".join(q.serializechunks([])), "<results></results>" )
+        q = fql.Query("SELECT w FORMAT single-json")
+        self.assertEqual( "".join(q.serializechunks([])), "null" )
+        self.assertRaises( fql.QueryError, list, q.serializechunks(["1","2"]) )
+
 
 class Test3Evaluation(unittest.TestCase):
     def setUp(self):
@@ -917,6 +961,142 @@ class Test3Evaluation(unittest.TestCase):
         self.assertEqual(results[0].set, "adhoc")
         self.assertEqual(results[0].feat("value"), "5")
 
+    def test42_cached_reuse(self):
+        """Reusing a cached query on multiple documents"""
+        doc2 = folia.Document(string=FOLIAEXAMPLE)
+        for doc in (self.doc, doc2):
+            q = fql.Query(Qsuggest_split) #the second query reuses the plan of the first
+            results = q(doc)
+            self.assertIsInstance(results[0], folia.Correction)
+            self.assertEqual(results[0].suggestions(0)[0].text(), "weer")
+            self.assertEqual(results[0].suggestions(0)[1].text(), "gegeven")
+
+    def test43_planner(self):
+        """Evaluation using the document index equals evaluation by walking the document"""
+        for query in (Qselect_focus, Qselect_target, Qselect_nestedtargets, Qselect_span, Qselect_span2, Qhas, "SELECT w WHERE text = \"de\"", "SELECT entity FOR w"):
+            results = fql.Query(query)(self.doc)
+            expected = fql.Query(query, fql.Context(planner=False))(self.doc)
+            self.assertEqual( results, expected )
+
+    def test43b_planner_attributechange(self):
+        """Evaluation using the document index reflects direct changes to attributes between queries"""
+        query = "SELECT pos WHERE class = \"blah\""
+        self.assertEqual( len(fql.Query(query)(self.doc)), 0 )
+        pos = list(self.doc.select(folia.PosAnnotation))
+        pos[0].cls = "blah"
+        self.assertEqual( len(fql.Query(query)(self.doc)), 1 )
+        pos[1].cls = "blah"
+        self.assertEqual( len(fql.Query(query)(self.doc)), 2 )
+        self.assertEqual( fql.Query(query)(self.doc), fql.Query(query, fql.Context(planner=False))(self.doc) )
+
+    def test43c_planner_lazy(self):
+        """The document index is only built when lookups benefit from it"""
+        for query in ("SELECT w FOR s ID \"WR-P-E-J-0000000001.p.1.s.2\"", "SELECT w WHERE text = \"de\" FOR s ID \"WR-P-E-J-0000000001.p.1.s.2\"", "SELECT w WHERE text = \"de\""):
+            q = fql.Query(query)
+            self.assertEqual( q(self.doc), fql.Query(query, fql.Context(planner=False))(self.doc) )
+            self.assertIsNone( q.index )
+        for query, context in (("SELECT w WHERE text = \"de\" FOR s", fql.Context()), ("SELECT w WHERE text = \"de\"", fql.Context(planner='cached'))):
+            q = fql.Query(query, context)
+            self.assertEqual( q(self.doc), fql.Query(query, fql.Context(planner=False))(self.doc) )
+            self.assertEqual( list(q.index.types), [folia.Word] )
+            self.assertIsNone( q.index.spans )
+
+    def test44_explain(self):
+        """Explaining the query plan"""
+        plan = fql.Query("EXPLAIN SELECT w WHERE text = \"de\" FOR s ID \"WR-P-E-J-0000000001.p.1.s.2\"")(self.doc)
+        self.assertTrue( "value index lookup of w where text = \"de\"" in plan )
+        self.assertTrue( "ID lookup" in plan )
+        plan = fql.Query("EXPLAIN " + Qedit)(self.doc)
+        self.assertTrue( "walking" in plan )
+
+    def test45_corpus(self):
+        """Running a query over a corpus"""
+        corpusdir = os.path.join(TMPDIR, "fqltest.corpus")
+        if not os.path.exists(corpusdir):
+            os.mkdir(corpusdir)
+        for i in range(0,3):
+            self.doc.save(os.path.join(corpusdir, "doc" + str(i) + ".folia.xml"))
+        corpus = folia.Corpus(corpusdir, extension="folia.xml")
+        results = list(fql.Query("SELECT w WHERE text = \"de\" FORMAT xml").corpus(corpus, threads=2))
+        self.assertEqual( [ os.path.basename(filename) for filename, _ in results ], ["doc0.folia.xml","doc1.folia.xml","doc2.folia.xml"] )
+        self.assertEqual( results[0][1], fql.Query("SELECT w WHERE text = \"de\" FORMAT xml")(self.doc) )
+        #a limit stops processing early
+        results = list(fql.Query("SELECT w WHERE text = \"de\" LIMIT 3").corpus(corpus, threads=2))
+        self.assertEqual( len(results), 1)
+        self.assertEqual( len(results[0][1]), 3)
+        self.assertEqual( results[0][1][0]['type'], 'w')
+        #modified documents are saved
+        results = list(fql.Query(Qedit).corpus(corpus, threads=2))
+        self.assertEqual( len(results), 3)
+        doc = folia.Document(file=os.path.join(corpusdir, "doc2.folia.xml"))
+        results = fql.Query("SELECT lemma OF \"lemmas-nl\" WHERE class = \"blah\" FOR w")(doc)
+        self.assertTrue( len(results) > 0 )
+
+    def test46_stream(self):
+        """Streaming query evaluation"""
+        filename = os.path.join(TMPDIR, "fqltest.stream.folia.xml")
+        self.doc.save(filename)
+        q = fql.Query("SELECT w WHERE text = \"de\" FOR s FORMAT xml")
+        self.assertEqual( q.streamscope(), folia.Sentence )
+        results = list(q.stream(filename))
+        self.assertTrue( len(results) > 1 )
+        self.assertEqual( "".join(results), q(self.doc, False) )
+        q = fql.Query("SELECT w WHERE text = \"de\" FOR s LIMIT 1")
+        results = list(q.stream(filename))
+        self.assertEqual( len(results), 1 )
+        self.assertIsInstance( results[0], folia.Word )
+
+    def test46b_stream_nested(self):
+        """Streaming query evaluation on a document with nested sentences (a sentence in a quote in a sentence)"""
+        doc = folia.Document(string="""<?xml version="1.0" encoding="utf-8"?>
+<FoLiA xmlns="http://ilk.uvt.nl/folia" version="2.5.1" xml:id="example">
+  <metadata type="native">
+    <annotations>
+      <text-annotation/>
+      <token-annotation/>
+      <sentence-annotation/>
+      <paragraph-annotation/>
+      <quote-annotation/>
+    </annotations>
+  </metadata>
+  <text xml:id="example.text">
+    <p xml:id="example.p.1">
+      <s xml:id="example.p.1.s.1">
+        <w xml:id="example.p.1.s.1.w.1"><t>Hij</t></w>
+        <w xml:id="example.p.1.s.1.w.2"><t>zegt</t></w>
+        <quote xml:id="example.p.1.s.1.quote.1">
+          <s xml:id="example.p.1.s.1.quote.1.s.1">
+            <w xml:id="example.p.1.s.1.quote.1.s.1.w.1"><t>de</t></w>
+            <w xml:id="example.p.1.s.1.quote.1.s.1.w.2"><t>kat</t></w>
+          </s>
+        </quote>
+        <w xml:id="example.p.1.s.1.w.3"><t>.</t></w>
+      </s>
+      <s xml:id="example.p.1.s.2">
+        <w xml:id="example.p.1.s.2.w.1"><t>Zie</t></w>
+        <w xml:id="example.p.1.s.2.w.2"><t>de</t></w>
+        <w xml:id="example.p.1.s.2.w.3"><t>hond</t></w>
+      </s>
+    </p>
+  </text>
+</FoLiA>""")
+        filename = os.path.join(TMPDIR, "fqltest.stream.nested.folia.xml")
+        doc.save(filename)
+        self.assertTrue( fql.Query.nestedscope(filename, folia.Sentence) )
+        self.assertFalse( fql.Query.nestedscope(filename, folia.Paragraph) )
+        for query in ("SELECT w FOR s WHERE text CONTAINS \"de\" FORMAT xml", "SELECT s WHERE text CONTAINS \"zegt\" FORMAT xml", "SELECT s FORMAT xml", "SELECT w FOR s FORMAT xml", "SELECT w FOR p FORMAT xml"):
+            q = fql.Query(query)
+            self.assertEqual( "".join(q.stream(filename)), q(doc, False) )
+
+    def test47_write(self):
+        """Writing query results to a stream"""
+        for format in ("xml","json"):
+            q = fql.Query("SELECT w WHERE text = \"de\" FORMAT " + format)
+            f = io.StringIO()
+            q.write(self.doc, f)
+            self.assertEqual( f.getvalue(), q(self.doc) )
+        self.assertRaises( fql.QueryError, list, fql.Query("SELECT w").chunks(self.doc) )
+
 
 if HAVE_CQL:
     class Test4CQL(unittest.TestCase):
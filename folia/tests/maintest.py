@@ -22,6 +22,12 @@ import unittest
 import gzip
 import bz2
 import re
+import operator
+import json
+import asyncio
+import time
+import tempfile
+import shutil
 from datetime import datetime
 import lxml.objectify
 from folia.helpers import u, isstring
@@ -146,6 +152,35 @@ class Test_E001_Tokens_Structure(unittest.TestCase):
         self.assertEqual( words[0].text() , "an" )
         self.assertEqual( words[1].text() , "example" )
 
+    def test_offsetmap(self):
+        """Simple Token & Structure Test - Map character offsets to words"""
+        s = self.doc['example.p.1.s.2']
+        offsetmap = s.offsetmap()
+        self.assertEqual( offsetmap.text, "This is an example." )
+        self.assertEqual( len(offsetmap), 5 )
+        self.assertEqual( offsetmap.offsets(self.doc['example.p.1.s.2.w.4']), (11,18) )
+        self.assertEqual( offsetmap.resolve(8,18), [self.doc['example.p.1.s.2.w.3'] , self.doc['example.p.1.s.2.w.4'] ] )
+        self.assertEqual( offsetmap.resolve(9,12), [self.doc['example.p.1.s.2.w.3'] , self.doc['example.p.1.s.2.w.4'] ] )
+        self.assertRaises( folia.InconsistentText, offsetmap.resolve, 9, 12, True )
+        self.assertTrue( offsetmap.at(12) is self.doc['example.p.1.s.2.w.4'] )
+        self.assertTrue( offsetmap.at(10) is None ) #space
+        #offsets in the text of the whole document
+        offsetmap = self.doc.offsetmap()
+        self.assertEqual( offsetmap.text, self.doc.text() )
+        for word, begin, end in offsetmap:
+            self.assertEqual( offsetmap.text[begin:end], word.text() )
+
+    def test_offsetmap_addspans(self):
+        """Simple Token & Structure Test - Add span annotations from character offsets"""
+        self.doc.declare(folia.Entity, "https://example.org/entities")
+        offsetmap = self.doc['example.p.1.s.2'].offsetmap()
+        entities = offsetmap.addspans(folia.Entity, [(8,18,"example"), (0,4,None)], set="https://example.org/entities")
+        self.assertEqual( len(entities), 2 )
+        self.assertEqual( entities[0].wrefs(), [self.doc['example.p.1.s.2.w.3'] , self.doc['example.p.1.s.2.w.4'] ] )
+        self.assertEqual( entities[0].cls, "example" )
+        self.assertEqual( entities[1].wrefs(), [self.doc['example.p.1.s.2.w.1'] ] )
+        self.assertEqual( entities[1].cls, None )
+
 class Test_Exxx_Hidden_Tokens(unittest.TestCase): #xxx -> replace with a number at some point when there are more new tests
     """Hidden token tests"""
 
@@ -1110,6 +1145,16 @@ class Test02Sanity(unittest.TestCase):
                 t.append(word.text())
         self.assertEqual(t, ['Maarten','van','Gompel'])
 
+    def test041d_identity(self):
+        """Sanity check - Membership of elements by identity"""
+        word = self.doc["WR-P-E-J-0000000001.p.1.s.1.w.4"]
+        entity = next(word.findspans(folia.EntitiesLayer))
+        self.assertTrue( folia.isin(word, entity.wrefs()) )
+        #an equal element of another document is not the same element
+        doc = folia.Document(string=LEGACYEXAMPLE)
+        self.assertTrue( doc["WR-P-E-J-0000000001.p.1.s.1.w.4"] in entity.wrefs() )
+        self.assertFalse( folia.isin(doc["WR-P-E-J-0000000001.p.1.s.1.w.4"], entity.wrefs()) )
+
     def test042_table(self):
         """Sanity check - Table"""
         table = self.doc["example.table.1"]
@@ -1164,6 +1209,10 @@ class Test02Sanity(unittest.TestCase):
         self.assertEqual( len(table[2]), 2) #two cells
         self.assertTrue( isinstance(table[2][0], folia.Cell))
         self.assertEqual( table[2].text(), " | " )
+        #offset maps render the same text, also for empty cells
+        for e in table.select((folia.Row, folia.Cell)):
+            self.assertEqual( e.offsetmap().text, e.text() )
+        self.assertEqual( len(table[2][0].offsetmap()), 0 )
 
 
     def test043_string(self):
@@ -1236,6 +1285,25 @@ class Test02Sanity(unittest.TestCase):
         l = self.doc['sandbox.list.1'] #this is a bit of a malformed paragraph due to the explicit whitespace and linebreaks in it, but makes for a nice test:
         self.assertEqual( l.text(), "Eerste testitem\nTweede testitem")
 
+    def test046c_textcache(self):
+        """Sanity Check - Text serialisation with text cache"""
+        doc = folia.Document(string=LEGACYEXAMPLE, textcache=True)
+        for e in self.doc.select(folia.AbstractStructureElement):
+            for retaintokenisation in (False, True):
+                try:
+                    text = e.text(retaintokenisation=retaintokenisation)
+                except folia.NoSuchText:
+                    self.assertRaises( folia.NoSuchText, doc[e.id].text, retaintokenisation=retaintokenisation )
+                else:
+                    self.assertEqual( doc[e.id].text(retaintokenisation=retaintokenisation), text )
+                    self.assertEqual( doc[e.id].text(retaintokenisation=retaintokenisation), text ) #now from the cache
+        #changes invalidate the cache upward
+        sentence = doc["WR-P-E-J-0000000001.p.1.s.1"]
+        self.assertEqual( sentence.text(), "Stemma is een ander woord voor stamboom.")
+        doc["WR-P-E-J-0000000001.p.1.s.1.w.1"].settext("Stemmata")
+        self.assertEqual( sentence.text(), "Stemmata is een ander woord voor stamboom.")
+        self.assertTrue( doc["WR-P-E-J-0000000001.p.1"].text().startswith("Stemmata is een ander woord voor stamboom."))
+
     def test047_relation(self):
         """Sanity check - Relation"""
         word = self.doc['WR-P-E-J-0000000001.p.1.s.3.w.10']
@@ -2241,6 +2309,29 @@ class Test04Edit(unittest.TestCase):
 
         self.assertTrue( xmlcheck(s.xmlstring(), '<s xmlns="http://ilk.uvt.nl/folia" xml:id="WR-P-E-J-0000000001.p.1.s.9"><w xml:id="WR-P-E-J-0000000001.p.1.s.9.w.1"><t>Dit</t></w><w xml:id="WR-P-E-J-0000000001.p.1.s.9.w.2"><t>is</t></w><w xml:id="WR-P-E-J-0000000001.p.1.s.9.w.3"><t>een</t></w><w xml:id="WR-P-E-J-0000000001.p.1.s.9.w.4"><t>nieuwe</t></w><w xml:id="WR-P-E-J-0000000001.p.1.s.9.w.5"><t>zin</t></w><w xml:id="WR-P-E-J-0000000001.p.1.s.9.w.6" class="PUNCTUATION"><t>.</t></w></s>'))
 
+    def test001d_generateids(self):
+        """Edit Check - Generating and reserving a range of IDs"""
+
+        #grab first paragraph
+        p = self.doc.paragraphs(0)
+
+        #no IDs have been generated yet
+        self.assertIsNone( p.maxid )
+
+        #how many sentences?
+        tmp = len(list(p.sentences()))
+
+        ids = p.generate_ids(folia.Sentence, 3)
+        self.assertEqual( ids, [ p.id + '.s.' + str(tmp + i) for i in range(1,4) ] )
+
+        #reserved IDs are not handed out again
+        s = p.add(folia.Sentence)
+        self.assertEqual( s.id, p.id + '.s.' + str(tmp + 4) )
+
+        #explicitly added IDs are taken into account from now on
+        p.append( folia.Sentence(self.doc, id=p.id + '.s.' + str(tmp + 10)) )
+        self.assertEqual( p.generate_id(folia.Sentence), p.id + '.s.' + str(tmp + 11) )
+
     def test002_addannotation(self):
         """Edit Check - Adding a token annotation (pos, lemma) (pre-generated instances)"""
 
@@ -2592,6 +2683,22 @@ class Test04Edit(unittest.TestCase):
 
         self.assertTrue( xmlcheck(word.xmlstring(), '<w xmlns="http://ilk.uvt.nl/folia" xml:id="WR-P-E-J-0000000001.p.1.s.3.w.14"><t>plaats</t><lemma class="plaats"/></w>'))
 
+    def test015b_erase(self):
+        """Edit Check - Erasing all annotations of a type"""
+        ids = [ entity.id for entity in self.doc.select(folia.Entity, ignore=False) if entity.id ]
+        self.assertTrue( self.doc.erase(folia.EntitiesLayer) > 0 )
+        self.assertEqual( len(list(self.doc.select(folia.EntitiesLayer, ignore=False))), 0 )
+        self.assertFalse( self.doc.declared(folia.Entity) )
+        #the IDs of the contained span annotations are gone from the index too
+        self.assertFalse( any( id in self.doc for id in ids ) )
+
+        #words referred to by span annotations are only counted once
+        self.assertTrue( self.doc.erase(folia.PosAnnotation) > 0 )
+        self.assertEqual( len(list(self.doc.select(folia.PosAnnotation, ignore=False))), 0 )
+        word = self.doc['WR-P-E-J-0000000001.p.1.s.3.w.14']
+        self.assertRaises( folia.NoSuchAnnotation, word.annotation, folia.PosAnnotation )
+        self.assertTrue( xmlcheck(word.xmlstring(), '<w xmlns="http://ilk.uvt.nl/folia" xml:id="WR-P-E-J-0000000001.p.1.s.3.w.14"><t>plaats</t><lemma class="plaats"/></w>'))
+
     def test016_datetime(self):
         """Edit Check - Time stamp"""
         w = self.doc['WR-P-E-J-0000000001.p.1.s.8.w.16']
@@ -2895,6 +3002,31 @@ class Test05Correction(unittest.TestCase):
 
         self.assertTrue( xmlcheck(s.xmlstring(),  '<s xmlns="http://ilk.uvt.nl/folia" xml:id="example.s.1"><w xml:id="example.s.1.w.1"><t>De</t></w><w xml:id="example.s.1.w.2"><t>site</t></w><w xml:id="example.s.1.w.3"><t>staat</t></w><w xml:id="example.s.1.w.4"><t>on</t></w><w xml:id="example.s.1.w.5"><t>line</t></w><correction><current><w xml:id="example.s.1.w.6"><t>.</t></w></current><suggestion merge="example.s.2" auth="no"/></correction></s>'))
 
+    def test007_offsetmap(self):
+        """Correction - Offset map follows the rendered branch of corrections"""
+        self.text.append(
+            folia.Sentence(self.doc,id=self.doc.id + '.s.1', contents=[
+                folia.Word(self.doc,id=self.doc.id + '.s.1.w.1', text="a"),
+                folia.Word(self.doc,id=self.doc.id + '.s.1.w.2', text="bb"),
+                folia.Word(self.doc,id=self.doc.id + '.s.1.w.3', text="a"),
+                folia.Word(self.doc,id=self.doc.id + '.s.1.w.4', text="c"),
+                folia.Word(self.doc,id=self.doc.id + '.s.1.w.5', text="d"),
+                folia.Word(self.doc,id=self.doc.id + '.s.1.w.6', text="d"),
+                folia.Word(self.doc,id=self.doc.id + '.s.1.w.7', text="a")
+            ])
+        )
+        s = self.doc.index[self.doc.id + '.s.1']
+        s.words(1).split( folia.Word(self.doc, id=self.doc.id + '.s.1.w.2a', text="b"), folia.Word(self.doc, id=self.doc.id + '.s.1.w.2b', text="b") )
+        s.mergewords( folia.Word(self.doc, id=self.doc.id + '.s.1.w.5-6', text="dd"), self.doc[self.doc.id + '.s.1.w.5'], self.doc[self.doc.id + '.s.1.w.6'] )
+
+        offsetmap = s.offsetmap()
+        self.assertEqual( offsetmap.text, "a b b a c dd a" )
+        self.assertEqual( [ (word.id, offsetmap.text[begin:end]) for word, begin, end in offsetmap ], [ (self.doc.id + '.s.1.w.' + i, t) for i, t in (('1','a'),('2a','b'),('2b','b'),('3','a'),('4','c'),('5-6','dd'),('7','a')) ] )
+
+        offsetmap = s.offsetmap(correctionhandling=folia.CorrectionHandling.ORIGINAL)
+        self.assertEqual( offsetmap.text, "a bb a c d d a" )
+        self.assertEqual( [ (word.id, offsetmap.text[begin:end]) for word, begin, end in offsetmap ], [ (self.doc.id + '.s.1.w.' + i, t) for i, t in (('1','a'),('2','bb'),('3','a'),('4','c'),('5','d'),('6','d'),('7','a')) ] )
+
 
 
 class Test06Query(unittest.TestCase):
@@ -3040,6 +3172,22 @@ class Test06Query(unittest.TestCase):
         matches = list(doc.findwords( folia.Pattern('a','*', 'c')))
         self.assertEqual( len(matches), 3)
 
+    def test010c_findwords_multiplevariablewildcards(self):
+        """Querying - Find words with multiple variable wildcards in a single pass"""
+        doc = folia.Document(id='test')
+        text = doc.append(folia.Text(doc, id='test.text'))
+        sentence = text.append(folia.Sentence)
+        for word in ('a','b','c','d','a','b','c'):
+            sentence.append(folia.Word, text=word)
+        wordstreams = []
+        def words():
+            wordstreams.append(True)
+            return doc.words()
+        matches = list(folia.findwords(doc, words, folia.Pattern('a','*','d','*','c')))
+        self.assertEqual( len(wordstreams), 1 )
+        self.assertEqual( [ [ w.text() for w in match ] for match in matches ], [['a','b','c','d','a','b','c']] )
+        self.assertEqual( list(folia.findwords(doc, words, folia.Pattern('a','*','d','*','c'), maxgapsize=3)), [] )
+
 
     def test011_findwords_annotation_na(self):
         """Querying - Find words by non existing annotation"""
@@ -4531,6 +4679,91 @@ het    ook   ?
         doc = folia.Document(string=xml, textvalidation=True)
         self.assertEqual( doc['test.s'].text(), "Dit is een rare test.")
 
+    def test016_offset_shared_reference(self):
+        """Validation - Offset validation renders the text of a shared reference only once"""
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<FoLiA xmlns="http://ilk.uvt.nl/folia" xmlns:xlink="http://www.w3.org/1999/xlink" xml:id="test" version="2.5.0" generator="{generator}">
+  <metadata type="native">
+    <annotations>
+      <token-annotation/>
+      <sentence-annotation/>
+    </annotations>
+  </metadata>
+  <text xml:id="test.text">
+    <p xml:id="test.p.1">
+      <t>Hallo wereld. Tot ziens.</t>
+      <s xml:id="test.p.1.s.1">
+        <t offset="0">Hallo wereld.</t>
+        <w xml:id="test.p.1.s.1.w.1"><t offset="0">Hallo</t></w>
+        <w xml:id="test.p.1.s.1.w.2" space="no"><t offset="6">wereld</t></w>
+        <w xml:id="test.p.1.s.1.w.3"><t offset="12">.</t></w>
+      </s>
+      <s xml:id="test.p.1.s.2">
+        <t offset="14">Tot ziens.</t>
+        <w xml:id="test.p.1.s.2.w.1"><t offset="0">Tot</t></w>
+        <w xml:id="test.p.1.s.2.w.2" space="no"><t offset="4">ziens</t></w>
+        <w xml:id="test.p.1.s.2.w.3"><t offset="9">.</t></w>
+      </s>
+    </p>
+  </text>
+</FoLiA>""".format(version=folia.FOLIAVERSION, generator='foliapy-v' + folia.LIBVERSION)
+        doc = folia.Document(string=xml, textvalidation=True)
+        self.assertEqual( doc.offsetvalidationbuffer, [] )
+        reftextcache = {}
+        for word in doc['test.p.1.s.2'].words():
+            self.assertEqual( word.textcontent().getreference(reftextcache=reftextcache), doc['test.p.1.s.2'] )
+        self.assertEqual( list(reftextcache.values()), ["Tot ziens."] )
+        #an invalid offset is still detected in the last item of a group
+        doc['test.p.1.s.2.w.3'].textcontent().offset = 8
+        self.assertRaises( folia.UnresolvableTextContent, doc['test.p.1.s.2.w.3'].textcontent().getreference, True, True, reftextcache)
+
+    def test017_incremental(self):
+        """Validation - Incremental text validation of changed elements only"""
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<FoLiA xmlns="http://ilk.uvt.nl/folia" xmlns:xlink="http://www.w3.org/1999/xlink" xml:id="test" version="2.5.0" generator="{generator}">
+  <metadata type="native">
+    <annotations>
+      <token-annotation/>
+      <sentence-annotation/>
+    </annotations>
+  </metadata>
+  <text xml:id="test.text">
+    <s xml:id="test.s.1">
+      <t>Hallo wereld.</t>
+      <w xml:id="test.s.1.w.1"><t offset="0">Hallo</t></w>
+      <w xml:id="test.s.1.w.2" space="no"><t offset="6">wereld</t></w>
+      <w xml:id="test.s.1.w.3"><t offset="12">.</t></w>
+    </s>
+    <s xml:id="test.s.2">
+      <t>Tot ziens.</t>
+      <w xml:id="test.s.2.w.1"><t offset="0">Tot</t></w>
+      <w xml:id="test.s.2.w.2" space="no"><t offset="4">ziens</t></w>
+      <w xml:id="test.s.2.w.3"><t offset="9">.</t></w>
+    </s>
+  </text>
+</FoLiA>""".format(version=folia.FOLIAVERSION, generator='foliapy-v' + folia.LIBVERSION)
+        doc = folia.Document(string=xml, textvalidation=True)
+        self.assertEqual( len(doc.textchangebuffer), 0 ) #parsing does not count as a change
+        doc['test.s.2.w.2'].textcontent().setoffset(5)
+        self.assertRaises( folia.UnresolvableTextContent, doc.validatetextchanges )
+        doc['test.s.2.w.2'].textcontent().setoffset(4)
+        report = doc.validatetextchanges()
+        self.assertEqual( [ e.id for e in report['elements'] ], ['test.text','test.s.2','test.s.2.w.2'] )
+        self.assertEqual( report['offsets'], [ (doc['test.s.2.w.2'],'current') ] )
+        self.assertEqual( report['errors'], 0 )
+        #nothing changed since the last validation
+        self.assertEqual( doc.validatetextchanges()['elements'], [] )
+        doc['test.s.1.w.2'].settext("aarde")
+        self.assertRaises( folia.InconsistentText, doc.validatetextchanges )
+        self.assertRaises( folia.InconsistentText, doc.validatetextchanges ) #a failed validation does not drop the changed elements
+        doc['test.s.1.w.2'].settext("wereld")
+        doc['test.s.1.w.2'].textcontent().setoffset(6)
+        doc.offsetvalidationbuffer.append( (doc['test.s.2.w.1'], 'current') ) #pending validation of an unrelated element
+        report = doc.validatetextchanges()
+        self.assertEqual( report['errors'], 0 )
+        self.assertEqual( [ (e.id, cls) for e, cls in report['offsets'] ], [ ('test.s.1.w.2','current') ] )
+        self.assertEqual( [ (e.id, cls) for e, cls in doc.offsetvalidationbuffer ], [ ('test.s.2.w.1','current') ] ) #remains pending
+
 class Test88b_Whitespace(unittest.TestCase):
     def setUp(self):
         self.doc = folia.Document(file=os.path.join(FOLIAPATH,"examples/tests/issue88b.2.5.1.folia.xml"))
@@ -4633,6 +4866,213 @@ class Test_Exxx_InvalidReferences(unittest.TestCase):
         doc.save(os.path.join(TMPDIR,'foliatest_refs.xml'))
         doc = folia.Document(file=os.path.join(TMPDIR,"foliatest_refs.xml"))
 
+def corpus_countwords(args):
+    """Function for the corpus processor tests (must be defined at the module level)"""
+    filename, _, _ = args
+    if os.path.basename(filename).startswith('broken'):
+        raise ValueError("Broken document")
+    doc = folia.Document(file=filename)
+    return len(list(doc.words()))
+
+def corpus_slowfirst(args):
+    """Function for the corpus processor tests, the first file (in sorted order) takes long"""
+    filename, _, _ = args
+    if os.path.basename(filename).startswith('broken'):
+        time.sleep(1)
+    return os.path.basename(filename)
+
+def corpus_docid(doc):
+    """Map function for the corpus map-reduce tests (must be defined at the module level)"""
+    return [doc.id]
+
+class Test_Exxx_Corpus(unittest.TestCase):
+    def setUp(self):
+        self.corpusdir = os.path.join(TMPDIR, 'foliatest_corpus')
+        for collection in ('', 'a', 'b', 'b/c'):
+            if not os.path.exists(os.path.join(self.corpusdir, collection)):
+                os.makedirs(os.path.join(self.corpusdir, collection))
+        for i, collection in enumerate(('', '', 'a', 'a', 'b', 'b/c')):
+            doc = folia.Document(id='corpus' + str(i))
+            doc.declare(folia.Sentence)
+            doc.declare(folia.Word)
+            text = doc.append(folia.Text(doc, id='corpus' + str(i) + '.text'))
+            sentence = text.append(folia.Sentence)
+            for j in range(i + 1):
+                sentence.append(folia.Word, text="word" + str(j))
+            doc.save(os.path.join(self.corpusdir, collection, 'corpus' + str(i) + '.folia.xml'))
+        with open(os.path.join(self.corpusdir, 'a', 'broken.folia.xml'),'w',encoding='utf-8') as f:
+            f.write("<FoLiA")
+
+    def test001_processor_results(self):
+        """Corpus - Processor with structured results and statistics"""
+        processor = folia.CorpusProcessor(self.corpusdir, corpus_countwords, threads=2, preindex=True, chunksize=None, tokenf=int)
+        results = list(processor.results())
+        self.assertEqual( [ os.path.basename(r.filename) for r in results ], ['broken.folia.xml','corpus2.folia.xml','corpus3.folia.xml','corpus5.folia.xml','corpus4.folia.xml','corpus0.folia.xml','corpus1.folia.xml']) #sorted by full path
+        self.assertEqual( [ r.result for r in results ], [None,3,4,6,5,1,2])
+        self.assertTrue( results[0].failed )
+        self.assertIsInstance( results[0].error, ValueError )
+        self.assertEqual( processor.stats.files, 7 )
+        self.assertEqual( processor.stats.failures, 1 )
+        self.assertEqual( processor.stats.tokens, 21 )
+
+    def test002_processor_run(self):
+        """Corpus - Processor raises errors, unless ignored"""
+        processor = folia.CorpusProcessor(self.corpusdir, corpus_countwords, threads=2, preindex=True)
+        self.assertRaises( ValueError, list, processor.run() )
+        processor = folia.CorpusProcessor(self.corpusdir, corpus_countwords, threads=2, preindex=True, ignoreerrors=True, ordered=False, maxtasksperchild=1, maxinflight=1)
+        self.assertEqual( sorted(processor.run()), [1,2,3,4,5,6] )
+        self.assertEqual( processor.stats.recycled, 7 )
+
+    def test002b_processor_backpressure(self):
+        """Corpus - Processor does not run ahead of a slow file when results are ordered"""
+        processor = folia.CorpusProcessor(self.corpusdir, corpus_slowfirst, threads=2, preindex=True, maxinflight=2)
+        results = processor.results()
+        self.assertEqual( os.path.basename(next(results).filename), 'broken.folia.xml' )
+        self.assertTrue( processor.stats.files <= 2 )
+        self.assertEqual( [ r.result for r in results ], ['corpus2.folia.xml','corpus3.folia.xml','corpus5.folia.xml','corpus4.folia.xml','corpus0.folia.xml','corpus1.folia.xml'] )
+
+    def test003_mapreduce(self):
+        """Corpus - Map-reduce is deterministic regardless of the number of workers"""
+        corpus = folia.Corpus(self.corpusdir, ignoreerrors=True)
+        expected = ['corpus2','corpus3','corpus5','corpus4','corpus0','corpus1'] #sorted by full path, the broken document is skipped
+        self.assertEqual( corpus.mapreduce(corpus_docid, operator.add, threads=1), expected )
+        self.assertEqual( corpus.mapreduce(corpus_docid, operator.add, threads=3, chunksize=2), expected )
+        self.assertEqual( corpus.mapreduce(corpus_docid, operator.add, threads=2, chunksize=1), expected )
+        self.assertRaises( Exception, folia.Corpus(self.corpusdir).mapreduce, corpus_docid, operator.add )
+        self.assertEqual( folia.Corpus(self.corpusdir, restrict_to_collection='nonexistant').mapreduce(corpus_docid, operator.add, initial=[]), [] )
+
+    def test004_walk(self):
+        """Corpus - Recursive walking of the corpus directory, restrictions and manifest"""
+        self.assertEqual( [ os.path.relpath(f, self.corpusdir) for f in folia.CorpusFiles(self.corpusdir) ], ['corpus0.folia.xml','corpus1.folia.xml','a/broken.folia.xml','a/corpus2.folia.xml','a/corpus3.folia.xml','b/corpus4.folia.xml','b/c/corpus5.folia.xml'] )
+        self.assertEqual( [ os.path.relpath(f, self.corpusdir) for f in folia.CorpusFiles(self.corpusdir, restrict_to_collection='b') ], ['b/corpus4.folia.xml','b/c/corpus5.folia.xml'] )
+        self.assertEqual( [ os.path.relpath(f, self.corpusdir) for f in folia.CorpusFiles(self.corpusdir, pattern='*/corpus*.folia.xml') ], ['a/corpus2.folia.xml','a/corpus3.folia.xml','b/corpus4.folia.xml'] )
+        self.assertEqual( [ os.path.relpath(f, self.corpusdir) for f in folia.CorpusFiles(self.corpusdir, pattern='*/*/corpus*.folia.xml') ], ['b/c/corpus5.folia.xml'] )
+        self.assertEqual( [ os.path.relpath(f, self.corpusdir) for f in folia.CorpusFiles(self.corpusdir, pattern='corpus*.folia.xml') ], ['corpus0.folia.xml','corpus1.folia.xml'] )
+        manifest = folia.Corpus(self.corpusdir).manifest()
+        self.assertEqual( manifest[0], (os.path.join(self.corpusdir,'corpus0.folia.xml'), os.path.getsize(os.path.join(self.corpusdir,'corpus0.folia.xml'))) )
+        self.assertEqual( [ f for f, _ in manifest ], list(folia.CorpusFiles(self.corpusdir)) )
+
+    def test005_shards(self):
+        """Corpus - Sharding partitions the corpus deterministically, balanced by file size"""
+        shards = [ folia.Corpus(self.corpusdir, shard=k, nshards=3).manifest() for k in range(3) ]
+        self.assertEqual( sorted( f for shard in shards for f, _ in shard ), sorted(folia.CorpusFiles(self.corpusdir)) )
+        self.assertEqual( shards, [ folia.Corpus(self.corpusdir, shard=k, nshards=3).manifest() for k in range(3) ] )
+        sizes = [ sum( size for _, size in shard ) for shard in shards ]
+        self.assertTrue( max(sizes) - min(sizes) <= max( size for shard in shards for _, size in shard ) )
+        self.assertRaises( ValueError, folia.Corpus, self.corpusdir, shard=3, nshards=3 )
+
+    def test006_loader(self):
+        """Corpus - Threaded loader yields the same documents in the same order"""
+        self.assertRaises( SyntaxError, list, folia.CorpusLoader(self.corpusdir, threads=2) )
+        expected = [ (doc.id, doc.filename) for doc in folia.Corpus(self.corpusdir, ignoreerrors=True) ]
+        self.assertEqual( len(expected), 6 )
+        for threads, prefetch in ((1,1),(2,None),(3,2)):
+            loader = folia.CorpusLoader(self.corpusdir, ignoreerrors=True, threads=threads, prefetch=prefetch)
+            self.assertEqual( [ (doc.id, doc.filename) for doc in loader ], expected )
+        #the filename is set before the document is parsed, so errors can refer to it
+        filenames = set()
+        def callback(element):
+            filenames.add(element.doc.filename)
+            return element
+        list(folia.CorpusLoader(self.corpusdir, ignoreerrors=True, threads=2, parsexmlcallback=callback))
+        self.assertEqual( filenames, set( filename for _, filename in expected ) )
+
+    def test007_async(self):
+        """Corpus - Asynchronous loading of documents and streaming with the reader"""
+        async def load():
+            docs = [ doc.id async for doc in folia.Corpus(self.corpusdir, ignoreerrors=True).adocuments(concurrency=2) ]
+            doc = await folia.aloaddocument(file=os.path.join(self.corpusdir,'corpus1.folia.xml'))
+            reader = folia.Reader(os.path.join(self.corpusdir,'b','c','corpus5.folia.xml'), folia.Word)
+            batches = [ [ w.text() for w in batch ] async for batch in reader.abatches(4) ]
+            return docs, doc, batches, reader
+        docs, doc, batches, reader = asyncio.run(load())
+        self.assertEqual( docs, [ doc.id for doc in folia.Corpus(self.corpusdir, ignoreerrors=True) ] )
+        self.assertEqual( doc.id, 'corpus1' )
+        self.assertEqual( batches, [['word0','word1','word2','word3'],['word4','word5']] )
+        self.assertTrue( reader.stream.closed )
+
+    def test008_index(self):
+        """Corpus - Persistent inverted index with incremental updates"""
+        #the corpus is modified, so work on a private copy
+        tmpdir = tempfile.mkdtemp(dir=TMPDIR)
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.corpusdir = os.path.join(tmpdir, 'corpus')
+        shutil.copytree(os.path.join(TMPDIR, 'foliatest_corpus'), self.corpusdir)
+        indexfile = os.path.join(tmpdir, 'index.sqlite')
+        index = folia.CorpusIndex(indexfile, ignoreerrors=True)
+        self.assertEqual( index.update(folia.Corpus(self.corpusdir)), {'added': 6, 'updated': 0, 'removed': 0, 'unchanged': 0, 'failed': 1} )
+        self.assertEqual( list(index.find('word5')), [(os.path.join(self.corpusdir,'b','c','corpus5.folia.xml'), 'corpus5.text.s.1.w.6', 'corpus5.text.s.1')] )
+        self.assertEqual( index.count('word0'), 6 )
+
+        doc = folia.Document(id='corpus6')
+        doc.declare(folia.LemmaAnnotation, 'lemmas')
+        sentence = doc.append(folia.Text(doc, id='corpus6.text')).append(folia.Sentence)
+        sentence.append(folia.Word, text="houses").append(folia.LemmaAnnotation, cls="house")
+        doc.save(os.path.join(self.corpusdir, 'b', 'corpus6.folia.xml'))
+        os.unlink(os.path.join(self.corpusdir, 'corpus0.folia.xml'))
+        index = folia.CorpusIndex(indexfile, ignoreerrors=True) #reopen
+        self.assertEqual( index.update(folia.Corpus(self.corpusdir)), {'added': 1, 'updated': 0, 'removed': 1, 'unchanged': 5, 'failed': 1} )
+        self.assertEqual( list(index.find('house', folia.AnnotationType.LEMMA, 'lemmas')), [(os.path.join(self.corpusdir,'b','corpus6.folia.xml'), 'corpus6.text.s.1.w.1', 'corpus6.text.s.1')] )
+        self.assertEqual( list(index.find('house', folia.AnnotationType.LEMMA, 'other')), [] )
+        self.assertEqual( list(index.values(folia.AnnotationType.LEMMA)), ['house'] )
+        self.assertEqual( index.count('word0'), 5 )
+        #files that vanish are skipped
+        self.assertEqual( index.update(list(folia.CorpusFiles(self.corpusdir)) + [os.path.join(self.corpusdir, 'vanished.folia.xml')]), {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 6, 'failed': 1} )
+        index.close()
+
+        #compressed files, words outside of sentences
+        doc = folia.Document(id='corpus7')
+        paragraph = doc.append(folia.Text(doc, id='corpus7.text')).append(folia.Paragraph)
+        paragraph.append(folia.Word, text="loose")
+        paragraph.append(folia.Sentence).append(folia.Word, text="word0")
+        doc.save(os.path.join(self.corpusdir, 'corpus7.folia.xml.gz'))
+        index = folia.CorpusIndex(os.path.join(tmpdir, 'index.gz.sqlite'))
+        self.assertEqual( index.update(folia.Corpus(self.corpusdir, extension='folia.xml.gz')), {'added': 1, 'updated': 0, 'removed': 0, 'unchanged': 0, 'failed': 0} )
+        self.assertEqual( list(index.find('loose')), [(os.path.join(self.corpusdir,'corpus7.folia.xml.gz'), 'corpus7.text.p.1.w.1', None)] )
+        self.assertEqual( list(index.find('word0')), [(os.path.join(self.corpusdir,'corpus7.folia.xml.gz'), 'corpus7.text.p.1.s.1.w.1', 'corpus7.text.p.1.s.1')] )
+        index.close()
+        #the index streams the words with the reader, which reports the sentence and forgets the words it read
+        reader = folia.Reader(os.path.join(self.corpusdir,'corpus7.folia.xml.gz'), folia.Word, context=folia.Sentence, keepindex=False)
+        self.assertEqual( [ (word.id, sentenceid) for word, sentenceid in reader ], [('corpus7.text.p.1.w.1', None), ('corpus7.text.p.1.s.1.w.1', 'corpus7.text.p.1.s.1')] )
+        self.assertFalse( 'corpus7.text.p.1.s.1.w.1' in reader.doc.index )
+        reader.close()
+
+class Test_Exxx_TokenColumns(unittest.TestCase):
+    def setUp(self):
+        self.doc = folia.Document(id='test')
+        self.doc.declare(folia.PosAnnotation, 'pos')
+        text = self.doc.append(folia.Text(self.doc, id='test.text'))
+        for sentencetext in ("the big house", "a big tree", "the House"):
+            sentence = text.append(folia.Paragraph).append(folia.Sentence)
+            for word in sentencetext.split(' '):
+                w = sentence.append(folia.Word, text=word)
+                w.append(folia.PosAnnotation, cls={'the':'det','a':'det','big':'adj'}.get(word,'noun'))
+
+    def test001_columns(self):
+        """Token columns - Columns, boundaries and counts"""
+        columns = self.doc.tokencolumns()
+        self.assertEqual( len(columns), 8 )
+        self.assertEqual( [ columns.lexicon[i] for i in columns.text ], ['the','big','house','a','big','tree','the','House'] )
+        self.assertEqual( list(columns.sentence), [0,0,0,1,1,1,2,2] )
+        self.assertEqual( list(columns.paragraph), [0,0,0,1,1,1,2,2] )
+        self.assertEqual( columns.counts(folia.PosAnnotation), {'det': 3, 'adj': 2, 'noun': 3} )
+        self.assertEqual( columns.counts()['big'], 2 )
+        self.assertIs( self.doc.tokencolumns(), columns )
+
+    def test002_invalidation(self):
+        """Token columns - Invalidated when the document changes"""
+        columns = self.doc.tokencolumns()
+        self.doc['test.text'].append(folia.Sentence).append(folia.Word, text="house")
+        self.assertFalse( columns.isvalid() )
+        self.assertEqual( self.doc.tokencolumns().counts()['house'], 2 )
+
+    def test003_findwords(self):
+        """Token columns - Find words, with the same results as on the document"""
+        for patterns in ( (folia.Pattern('the', True),), (folia.Pattern(True, ('house','tree')),), (folia.Pattern(folia.RegExp('h'), casesensitive=True),), (folia.Pattern('the', True), folia.Pattern('det','noun', matchannotation=folia.PosAnnotation)) ):
+            expected = [ [ w.id for w in match ] for match in self.doc.findwords(*patterns, leftcontext=1) ]
+            self.assertEqual( [ [ w.id for w in match ] for match in self.doc.tokencolumns().findwords(*patterns, leftcontext=1) ], expected )
+        self.assertEqual( len(list(self.doc.tokencolumns().findwords(folia.Pattern('the', True)))), 2 )
+
 
 with open(os.path.join(FOLIAPATH, 'examples/full-legacy.1.5.folia.xml'), 'r',encoding='utf-8') as foliaexample_f:
     LEGACYEXAMPLE = foliaexample_f.read()
@@ -4648,5 +5088,206 @@ LEGACYEXAMPLE = re.sub(r' xmlns:alien="[^"]*" alien:attrib="[^"]*"', '', LEGACYE
 
 PARTIALLEGACYEXAMPLE = re.sub(r' xmlns:alien="[^"]*" alien:attrib="[^"]*"', '', PARTIALLEGACYEXAMPLE, re.MULTILINE)
 
+
+class Test_Exxx_Diff(unittest.TestCase):
+    def setUp(self):
+        self.doc = folia.Document(string=LEGACYEXAMPLE, textvalidation=True)
+
+    def test001_diff(self):
+        """Diff - Structural hash and diff between two versions of a document"""
+        doc = folia.Document(string=LEGACYEXAMPLE)
+        self.assertEqual( self.doc.structhash(), doc.structhash() )
+        self.assertFalse( self.doc.diff(doc) )
+        word = doc["WR-P-E-J-0000000001.p.1.s.1.w.4"]
+        pos = word.annotation(folia.PosAnnotation)
+        pos.cls = "N"
+        pos.markchanged() #direct attribute changes are not tracked automatically
+        word.append(folia.Description, value="test")
+        doc["WR-P-E-J-0000000001.p.1.s.2"].remove(doc["WR-P-E-J-0000000001.p.1.s.2.w.3"])
+        self.assertNotEqual( self.doc.structhash(), doc.structhash() )
+        diff = self.doc.diff(doc)
+        self.assertEqual( len(diff), 3)
+        self.assertEqual( [ new for _, new in diff.changed ], [pos] )
+        self.assertTrue( isinstance(diff.added[0], folia.Description) )
+        self.assertEqual( [ e.id for e in diff.removed ], ["WR-P-E-J-0000000001.p.1.s.2.w.3"] )
+        self.assertTrue( diff.skipped > 0 )
+        self.assertEqual( str(diff).split("\n")[0], "- w WR-P-E-J-0000000001.p.1.s.2.w.3" )
+
+    def test002_span(self):
+        """Diff - Adding a word to a span annotation after hashing"""
+        doc = folia.Document(id='test')
+        doc.declare(folia.Entity, 'entities')
+        sentence = doc.append(folia.Text(doc, id='test.text')).append(folia.Sentence)
+        words = [ sentence.append(folia.Word, text=t) for t in ("New", "York", "City") ]
+        entity = sentence.add(folia.Entity, words[0], cls="loc", set="entities")
+        original = folia.Document(string=doc.xmlstring())
+        self.assertEqual( original.structhash(), doc.structhash() )
+        entity.append(words[1])
+        self.assertNotEqual( original.structhash(), doc.structhash() )
+        diff = original.diff(doc)
+        self.assertEqual( [ new for _, new in diff.changed ], [entity] )
+        self.assertEqual( str(diff), "~ entity (set entities) in s test.text.s.1" )
+
+
+class Test_Exxx_CopyMove(unittest.TestCase):
+    def setUp(self):
+        self.doc = folia.Document(string=LEGACYEXAMPLE, textvalidation=True)
+
+    def test001_copy(self):
+        """Copy and move - Copying an element"""
+        paragraph = self.doc["WR-P-E-J-0000000001.p.1"]
+        copy = paragraph.copy(self.doc, ".copy")
+        self.assertEqual( copy.id, "WR-P-E-J-0000000001.p.1.copy" )
+        word = self.doc["WR-P-E-J-0000000001.p.1.s.1.w.4.copy"]
+        self.assertTrue( word.ancestor(folia.Paragraph) is copy )
+        self.assertTrue( self.doc["WR-P-E-J-0000000001.p.1.s.1.w.4"].ancestor(folia.Paragraph) is paragraph )
+        self.assertEqual( copy.xmlstring().replace('.copy"','"'), paragraph.xmlstring() )
+        self.assertEqual( copy.text(), paragraph.text() )
+        #span annotations in the copy refer to the copied words
+        entity = next(word.findspans(folia.EntitiesLayer))
+        self.assertTrue( folia.isin(word, entity.wrefs()) )
+        self.assertTrue( entity.ancestor(folia.Paragraph) is copy )
+
+    def test002_moveto(self):
+        """Copy and move - Moving an element to another document"""
+        doc = folia.Document(string=LEGACYEXAMPLE)
+        paragraph = doc["WR-P-E-J-0000000001.p.1"]
+        div = self.doc["WR-P-E-J-0000000001.div0.1"]
+        self.assertRaises( folia.DuplicateIDError, paragraph.moveto, div )
+        self.assertTrue( paragraph.parent is doc["WR-P-E-J-0000000001.div0.1"] )
+        original = self.doc["WR-P-E-J-0000000001.p.1"]
+        for e in original.select(folia.AbstractElement, ignore=False):
+            if e.id: self.doc.index.pop(e.id, None)
+        div.remove(original)
+        paragraph.moveto(div)
+        self.assertTrue( div.data[-1] is paragraph )
+        word = self.doc["WR-P-E-J-0000000001.p.1.s.1.w.4"]
+        self.assertTrue( word.ancestor(folia.Paragraph) is paragraph )
+        self.assertTrue( word.doc is self.doc )
+        self.assertFalse( "WR-P-E-J-0000000001.p.1.s.1.w.4" in doc )
+
+
+class Test_Exxx_Merge(unittest.TestCase):
+    def setUp(self):
+        self.doc = folia.Document(string=LEGACYEXAMPLE, textvalidation=True)
+
+    def test001_merge(self):
+        """Merge - Merging the annotations of another version of a document"""
+        doc = folia.Document(string=LEGACYEXAMPLE)
+        word = doc["WR-P-E-J-0000000001.p.1.s.1.w.4"]
+        pos = word.annotation(folia.PosAnnotation)
+        pos.cls = "N"
+        pos.markchanged() #direct attribute changes are not tracked automatically
+        word.append(folia.Description, value="test")
+        doc.declare(folia.SenseAnnotation, "testsenses", folia.Processor("sensetagger", id="proc.sensetagger"))
+        word.append(folia.SenseAnnotation, cls="test", set="testsenses")
+        merge = self.doc.merge(doc)
+        self.assertEqual( len(merge.added), 2 )
+        self.assertEqual( [ (e.cls, other.cls) for e, other in merge.conflicts ], [(self.doc["WR-P-E-J-0000000001.p.1.s.1.w.4"].annotation(folia.PosAnnotation).cls, "N")] )
+        self.assertTrue( merge.skipped > 0 )
+        self.assertTrue( self.doc.declared(folia.SenseAnnotation, "testsenses") )
+        sense = self.doc["WR-P-E-J-0000000001.p.1.s.1.w.4"].annotation(folia.SenseAnnotation, "testsenses")
+        self.assertEqual( sense.cls, "test" )
+        self.assertTrue( sense.doc is self.doc )
+        self.assertTrue( sense.processor is self.doc.provenance["proc.sensetagger"] )
+        self.assertEqual( str(merge).split("\n")[0], "+ desc in w WR-P-E-J-0000000001.p.1.s.1.w.4" )
+        #merging again adds nothing
+        merge = self.doc.merge(doc)
+        self.assertEqual( len(merge.added), 0 )
+
+
+class Test_Exxx_Json(unittest.TestCase):
+    def test001_parsejson(self):
+        """JSON - Loading a document from its JSON serialisation"""
+        doc = folia.Document(
+            string="""<?xml version="1.0" encoding="utf-8"?>
+    <FoLiA xmlns="http://ilk.uvt.nl/folia" version="2.5.1" xml:id="example">
+      <metadata type="native">
+        <annotations>
+          <text-annotation>
+            <annotator processor="p1" />
+          </text-annotation>
+          <token-annotation>
+            <annotator processor="p1" />
+          </token-annotation>
+          <sentence-annotation>
+            <annotator processor="p1" />
+          </sentence-annotation>
+          <pos-annotation set="pos">
+            <annotator processor="p1" />
+          </pos-annotation>
+          <entity-annotation set="entities">
+            <annotator processor="p1" />
+          </entity-annotation>
+          <style-annotation>
+            <annotator processor="p1" />
+          </style-annotation>
+          <correction-annotation set="corrections">
+            <annotator processor="p1" />
+          </correction-annotation>
+        </annotations>
+        <provenance>
+          <processor xml:id="p1" name="tagger" />
+        </provenance>
+      </metadata>
+      <text xml:id="example.text">
+        <s xml:id="example.s.1">
+          <t>Hello <t-style class="emphasis">Nijmegen</t-style>!</t>
+          <w xml:id="example.s.1.w.1">
+            <correction xml:id="example.s.1.w.1.c.1" class="spelling">
+              <new>
+                <t offset="0">Hello</t>
+              </new>
+              <original>
+                <t offset="0">Helo</t>
+              </original>
+            </correction>
+            <pos class="INTJ" confidence="0.9" />
+          </w>
+          <w xml:id="example.s.1.w.2" space="no">
+            <t offset="6">Nijmegen</t>
+            <pos class="PROPN" />
+          </w>
+          <w xml:id="example.s.1.w.3">
+            <t offset="14">!</t>
+            <pos class="PUNCT" />
+            <correction xml:id="example.s.1.w.3.c.1" class="punctuation">
+              <suggestion confidence="0.6">
+                <t>?</t>
+              </suggestion>
+              <suggestion confidence="0.4">
+                <t>.</t>
+              </suggestion>
+            </correction>
+          </w>
+          <entities>
+            <entity xml:id="example.s.1.entity.1" class="loc">
+              <wref id="example.s.1.w.2" t="Nijmegen" />
+            </entity>
+          </entities>
+        </s>
+      </text>
+    </FoLiA>
+    """)
+        jsondoc = json.dumps(doc.json())
+        doc2 = folia.Document(json=jsondoc)
+        self.assertEqual( doc2.id, "example" )
+        self.assertFalse( doc.diff(doc2) )
+        self.assertEqual( doc2.json(), doc.json() )
+        self.assertEqual( doc2.text(), "Hello Nijmegen!" )
+        word = doc2["example.s.1.w.2"]
+        self.assertEqual( word.annotation(folia.PosAnnotation).cls, "PROPN" )
+        self.assertTrue( word.annotation(folia.PosAnnotation).processor is doc2.provenance["p1"] )
+        self.assertEqual( doc2["example.s.1.entity.1"].wrefs(), [word] ) #span annotations refer to the words, they do not contain them
+        self.assertEqual( doc2["example.s.1.w.1"].annotation(folia.PosAnnotation).confidence, 0.9 )
+        correction = doc2["example.s.1.w.1.c.1"]
+        self.assertEqual( correction.set, "corrections" )
+        self.assertEqual( correction.new(0).text(), "Hello" )
+        self.assertEqual( correction.original(0).text(), "Helo" )
+        correction = doc2["example.s.1.w.3.c.1"]
+        self.assertEqual( [ suggestion.text() for suggestion in correction.suggestions() ], ["?", "."] )
+        self.assertEqual( correction.suggestions(0).confidence, 0.6 )
+
+
 if __name__ == '__main__':
     unittest.main()